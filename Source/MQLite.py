@@ -7,17 +7,25 @@ Pattern match JSON like you query Freebase, using a simple MQL dialect.
 """
 
 
-import builtins
+# Only modules needed on every run are imported here.
+# Everything else is imported when used, to keep startup fast
+# (MQLite.py is often called thousands of times from shell scripts).
+
+import io
+import itertools
 import json
 import os
-import random
 import re
 import sys
 
 from collections import OrderedDict
+from collections.abc import Mapping, Sequence, Sized
 from json import JSONDecoder
 
 
+__version__ = '2026.10.18'
+
+
 # Nodes:
 # The MQLite compiler emits various kinds of nodes.
 # All of them implement a "match" method that tests data
@@ -27,6 +35,8 @@ from json import JSONDecoder
 # Matchers:
 # Nodes that return the data or NoMatch depending on a test.
 # Used to implement the basic pattern matching behavior.
+# Matchers also implement a "test" method that returns True or False
+# without building the result.
 
 
 class _NoMatch(object):
@@ -46,6 +56,9 @@ class MatchAny(object):
     def match(self, data):
         return data
 
+    def test(self, data):
+        return True
+
 
 class MatchEqual(object):
     """
@@ -60,6 +73,9 @@ class MatchEqual(object):
         else:
             return NoMatch
 
+    def test(self, data):
+        return self.value == data
+
 
 class MatchEmptyDict(object):
     """
@@ -71,6 +87,9 @@ class MatchEmptyDict(object):
         else:
             return NoMatch
 
+    def test(self, data):
+        return data == {}
+
 
 class MatchEmptyList(object):
     """
@@ -82,6 +101,9 @@ class MatchEmptyList(object):
         else:
             return NoMatch
 
+    def test(self, data):
+        return data == []
+
 
 class MatchDict(object):
     """
@@ -94,17 +116,94 @@ class MatchDict(object):
         - All the matchers match.
 
     The result is a dict containing all the matching keys/values.
+
+    Data loaded with a CompactLoader knows its keys as a bitmask,
+    so records without the required keys are rejected at once.
+
+    When 'limits' is given, each match counts as a step.
+
+    When 'adapt' is True, other mappings and objects with fields
+    (dataclasses, namedtuples, __slots__) are matched too.
+    See adapt_mapping().
+
+    When 'views' is True, the result is a ProjectionView
+    of the data instead of a new dict.
     """
-    def __init__(self, matchers, constraints, directives, additional_keys):
+    def __init__(self, matchers, constraints, directives, additional_keys, limits = None, adapt = False, views = False):
         self.matchers = list(matchers.items())
         self.constraints = list(constraints.items())
         self.directives = directives
         self.additional_keys = additional_keys
+        self.limits = limits
+        self.adapt = adapt
+        self.views = views
+        self.required_keys = tuple(OrderedDict.fromkeys(list(constraints) + list(matchers)))
 
-    def match(self, data):
+        # keys in the results, for views:
+        self.projected_keys = tuple(matchers)
+        self.projected_key_set = frozenset(matchers)
+
+        if additional_keys == '*':
+            self.extra_keys = ()
+        else:
+            self.extra_keys = tuple(key for key in OrderedDict.fromkeys(additional_keys) if not key in self.projected_key_set)
+
+        self.extra_key_set = frozenset(self.extra_keys)
+
+        # can't match anything? (lists don't need to look at the data)
+        self.unsatisfiable = (
+            any(isinstance(constraint, ConstraintNever) for key, constraint in self.constraints) or
+            any(getattr(matcher, 'unsatisfiable', False) for key, matcher in self.matchers))
+
+    def has_required_keys(self, shape):
+        """
+        True when a Shape may have all the required keys.
+        """
+        required = shape.bits.required(self.required_keys)
+        return shape.mask & required == required
+
+    def prepare(self, data):
+        """
+        Count a step and return 'data' as a mapping, or None when
+        it is not one or lacks required keys. (shared by match(),
+        test() and the iterative evaluator)
+        """
+        if self.limits is not None:
+            self.limits.tick(1)
 
         # not a dict?
-        if not isinstance(data, dict):
+        if not isinstance(data, (dict, Row)):
+            data = adapt_mapping(data) if self.adapt else None
+
+            if data is None:
+                return None
+
+        # required keys missing?
+        if type(data) in SHAPED_TYPES and not self.has_required_keys(data._shape):
+            return None
+
+        return data
+
+    def complete(self, data, result):
+        """
+        Add the additional keys in 'data' to a result and return it.
+        (the compiler guarantees that they are either '*' or a list)
+        """
+        if self.additional_keys == '*':
+            for key, value in data.items():
+                if not key in result:
+                    result[key] = value
+        else:
+            for key in self.additional_keys:
+                if key in data and not key in result:
+                    result[key] = data[key]
+
+        return result
+
+    def match(self, data):
+        data = self.prepare(data)
+
+        if data is None:
             return NoMatch
 
         # constraints match?
@@ -112,6 +211,9 @@ class MatchDict(object):
             if not key in data or not constraint.match(data[key]):
                 return NoMatch
 
+        if self.views:
+            return self.match_view(data)
+
         # matchers match?
         result = {}
         for key, matcher in self.matchers:
@@ -126,17 +228,51 @@ class MatchDict(object):
             result[key] = current
 
         # add all the data keys to the result if needed:
-        # (the compiler guarantees that the value is either '*' or a list)
-        if self.additional_keys == '*':
-            for key, value in data.items():
-                if not key in result:
-                    result[key] = value
-        else:
-            for key in self.additional_keys:
-                if key in data and not key in result:
-                    result[key] = data[key]
+        return self.complete(data, result)
 
-        return result
+    def match_view(self, data):
+        """
+        Run the matchers, returning a ProjectionView of 'data'.
+        Keys matched with null are not copied.
+        """
+        values = None
+
+        for key, matcher in self.matchers:
+            if not key in data:
+                return NoMatch
+
+            if type(matcher) is MatchAny:
+                continue
+
+            current = matcher.match(data[key])
+
+            if current is NoMatch:
+                return NoMatch
+
+            if values is None:
+                values = {}
+
+            values[key] = current
+
+        return ProjectionView(data, self, values)
+
+    def test(self, data):
+        data = self.prepare(data)
+
+        if data is None:
+            return False
+
+        # constraints match?
+        for key, constraint in self.constraints:
+            if not key in data or not constraint.match(data[key]):
+                return False
+
+        # matchers match?
+        for key, matcher in self.matchers:
+            if not key in data or not matcher.test(data[key]):
+                return False
+
+        return True
 
 
 class MatchList(object):
@@ -148,31 +284,40 @@ class MatchList(object):
         - Each matcher matches at least one element in the input data.
 
     The result is a list containing all the matches.
+
+    When 'limits' is given, each element tested by each matcher
+    counts as a step.
+
+    When 'adapt' is True, any sequence except strings and bytes
+    is matched too (e.g. tuples).
+
+    Matchers that can't match anything are not run. When one of them
+    has no directives (that could produce results anyway), the whole
+    list can't match and the data is not examined at all.
     """
-    def __init__(self, matchers):
+    def __init__(self, matchers, limits = None, adapt = False):
         self.matchers = matchers
+        self.limits = limits
+        self.adapt = adapt
+
+        self.unsatisfiable = any(getattr(matcher, 'unsatisfiable', False)
+            and len(getattr(matcher, 'directives', [])) == 0 for matcher in matchers)
 
     def match(self, data):
 
+        if self.unsatisfiable:
+            return NoMatch
+
         # not a list?
-        if not isinstance(data, list):
+        if not isinstance(data, list) and not (self.adapt and is_adaptable_sequence(data)):
             return NoMatch
 
+        if self.limits is not None:
+            self.limits.tick(len(data) * len(self.matchers))
+
         result = []
         for matcher in self.matchers:
-
-            # collect results for the current matcher:
-            matcher_results = []
-            for value in data:
-                current = matcher.match(value)
-
-                if current is not NoMatch:
-                    matcher_results.append(current)
-
-            # apply directives for dictionaries:
-            if isinstance(matcher, MatchDict):
-                for directive in matcher.directives:
-                    matcher_results = directive.match(matcher_results)
+            matcher_results = list(self.match_matcher(matcher, data))
 
             # at least one match?
             if len(matcher_results) == 0:
@@ -182,6 +327,317 @@ class MatchList(object):
 
         return result
 
+    def test(self, data):
+
+        if self.unsatisfiable:
+            return False
+
+        # not a list?
+        if not isinstance(data, list) and not (self.adapt and is_adaptable_sequence(data)):
+            return False
+
+        return self.test_values(data)
+
+    def test_values(self, data):
+        """
+        Test that every matcher matches at least one value in 'data',
+        stopping at the first match for each matcher.
+        """
+        if self.unsatisfiable:
+            return False
+
+        data = self.counted(data)
+
+        for matcher in self.matchers:
+
+            # directives can change the results, e.g. __limit__: 0:
+            if isinstance(matcher, MatchDict) and len(matcher.directives) > 0:
+                matcher_results = self.match_matcher(matcher, data)
+
+                if next(iter(matcher_results), NoMatch) is NoMatch:
+                    return False
+
+            elif not any(map(matcher.test, data)):
+                return False
+
+        return True
+
+    def count(self, data):
+        """
+        Count the results for 'data' without building them
+        (unless directives need them). No match counts as 0.
+        """
+        if self.unsatisfiable:
+            return 0
+
+        data = self.counted(data)
+        total = 0
+
+        for matcher in self.matchers:
+
+            if isinstance(matcher, MatchDict) and len(matcher.directives) > 0:
+                matched = sum(1 for result in self.match_matcher(matcher, data))
+            else:
+                matched = sum(map(matcher.test, data))
+
+            # at least one match?
+            if matched == 0:
+                return 0
+
+            total += matched
+
+        return total
+
+    def counted(self, data, steps = None):
+        """
+        Count 'steps' (by default, one for each matcher) for every
+        element in 'data' when there are limits. Lists are counted
+        at once, other iterables (e.g. streams) as they are read.
+        """
+        if self.limits is None:
+            return data
+
+        if steps is None:
+            steps = len(self.matchers)
+
+        if isinstance(data, Sized):
+            self.limits.tick(len(data) * steps)
+            return data
+
+        return self.counted_values(data, steps)
+
+    def counted_values(self, data, steps):
+        tick = self.limits.tick
+
+        for value in data:
+            tick(steps)
+            yield value
+
+    def match_matcher(self, matcher, data):
+        """
+        Lazily match every element in 'data' with a single matcher
+        and apply the matcher directives to the results.
+        """
+        if getattr(matcher, 'unsatisfiable', False):
+            data = ()
+
+        # collect results for the current matcher:
+        matcher_results = (current for current in map(matcher.match, data) if current is not NoMatch)
+
+        return self.apply_directives(matcher, matcher_results)
+
+    def apply_directives(self, matcher, matcher_results):
+        """
+        Apply the directives for a matcher to its results.
+        """
+        # only dictionaries have directives:
+        if isinstance(matcher, MatchDict):
+            for directive in matcher.directives:
+                matcher_results = directive.match(matcher_results)
+
+        return matcher_results
+
+    def stream(self, data):
+        """
+        Match an iterable of values (e.g. records read one by one)
+        yielding results as soon as they are available.
+        Only patterns with a single matcher can be streamed.
+        """
+        if len(self.matchers) != 1:
+            raise CompilerException('streaming requires a list pattern with a single matcher.')
+
+        return self.match_matcher(self.matchers[0], self.counted(data))
+
+
+def match_batch(matcher, batch, execution = None):
+    """
+    Match every value in 'batch' with a matcher, return a list of results.
+    (a module-level function, so that process pools can pickle it)
+
+    When the matcher has limits and an execution is given
+    (see Pattern.start_limits()), the current thread joins it.
+    """
+    limits = getattr(matcher, 'limits', None)
+
+    if limits is not None and execution is not None:
+        limits.start(execution = execution)
+
+    return [current for current in map(matcher.match, batch) if current is not NoMatch]
+
+
+def decode_match_batch(matcher, batch, execution = None):
+    """
+    Like match_batch(), decoding the NDJSON lines (bytes)
+    in 'batch' first. Blank lines are skipped.
+    """
+    values = []
+
+    for value in batch:
+        if isinstance(value, (bytes, bytearray)):
+            text = value.decode('utf-8-sig')
+
+            if not text.strip():
+                continue
+
+            value = json.loads(text)
+
+        values.append(value)
+
+    return match_batch(matcher, values, execution)
+
+
+# Limits:
+# Bound the time and the number of steps (nodes evaluated)
+# used by a pattern. Checked by MatchDict and MatchList nodes.
+
+class LimitException(Exception):
+    """
+    Raised when a pattern exceeds its limits.
+    Contains the statistics at that point.
+    """
+    def __init__(self, message, steps, elapsed):
+        Exception.__init__(self, '{} ({} steps in {:.3f} seconds)'.format(message, steps, elapsed))
+        self.steps = steps
+        self.elapsed = elapsed
+
+
+class LimitsExecution(object):
+    """
+    A single execution of a pattern with limits: its deadline
+    (a time.time() value or None), the steps counted so far
+    and whether it was cancelled. Threads that work on the same
+    execution share it, so they share the step budget too.
+    """
+    def __init__(self, deadline = None):
+        import threading
+        import time
+
+        self.deadline = deadline
+        self.started = time.time()
+        self.steps = 0
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def add(self, steps):
+        """
+        Add steps counted by a thread.
+        """
+        with self.lock:
+            self.steps += steps
+
+
+class Limits(object):
+    """
+    A wall-clock timeout (in seconds) and/or a maximum number of steps
+    for every execution of a pattern. Threads that join an execution
+    share its steps, adding them in batches of 1024, so with many
+    threads the limit can be exceeded by up to 1024 steps per thread.
+
+    cancel() stops the executions that are running
+    the next time they check their limits. Executions
+    started later are not affected.
+    """
+    def __init__(self, timeout = None, max_steps = None):
+        import threading
+        import weakref
+
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.local = threading.local()
+
+        # running executions, for cancel():
+        self.executions = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    # executions are per thread, don't pickle them:
+
+    def __getstate__(self):
+        return self.timeout, self.max_steps
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def start(self, deadline = None, execution = None):
+        """
+        Start counting for an execution in the current thread
+        and return it. 'deadline' (a time.time() value) overrides
+        the timeout. When 'execution' is given, the current thread
+        joins it instead of starting a new one (e.g. in an executor).
+        """
+        import time
+
+        # already counting for it in this thread (e.g. another batch):
+        if execution is not None and getattr(self.local, 'execution', None) is execution:
+            return execution
+
+        if execution is None:
+            if deadline is None and self.timeout is not None:
+                deadline = time.time() + self.timeout
+
+            execution = LimitsExecution(deadline)
+
+            with self.lock:
+                self.executions.add(execution)
+
+        self.local.execution = execution
+        self.local.pending = 0
+
+        return execution
+
+    def deadline(self):
+        """
+        The deadline for the current execution in this thread.
+        """
+        execution = getattr(self.local, 'execution', None)
+        return None if execution is None else execution.deadline
+
+    def cancel(self):
+        """
+        Stop all the running executions.
+        """
+        with self.lock:
+            executions = list(self.executions)
+
+        for execution in executions:
+            execution.cancelled = True
+
+    def tick(self, steps):
+        """
+        Count some steps, raise LimitException when over the limits.
+        Steps are added to the execution (and the clock is checked)
+        every 1024 steps.
+        """
+        local = self.local
+
+        # not started in this thread (e.g. an executor), start now:
+        if not hasattr(local, 'pending'):
+            self.start()
+
+        local.pending += steps
+        execution = local.execution
+
+        if execution.cancelled:
+            self.fail('cancelled')
+
+        if self.max_steps is not None and execution.steps + local.pending > self.max_steps:
+            self.fail('step limit exceeded')
+
+        if local.pending >= 1024:
+            execution.add(local.pending)
+            local.pending = 0
+
+            if execution.deadline is not None:
+                import time
+
+                if time.time() > execution.deadline:
+                    self.fail('timeout exceeded')
+
+    def fail(self, message):
+        import time
+
+        execution = self.local.execution
+        raise LimitException(message, execution.steps + self.local.pending, time.time() - execution.started)
+
 
 # Constraints:
 # Nodes that test a property of the data and return True or False.
@@ -266,21 +722,47 @@ class ConstraintRegex(object):
     """
     def __init__(self, regex):
         self.regex = regex
+        self.compiled = re.compile(regex)
 
     def match(self, data):
-        return re.match(self.regex, data) is not None
+        return self.compiled.match(data) is not None
 
 
 class ConstraintIn(object):
     """
     Tests that the data is equal to at least one element of a list of values.
     (operator "in" in MQLite)
+
+    Hashable values are looked up in a set. Unhashable data
+    or values (lists and dicts) are compared one by one.
     """
     def __init__(self, values):
         self.values = values
+        self.hashable = None
+        self.unhashable = values
+
+        # other iterables (e.g. a string) keep the "in" semantics:
+        if isinstance(values, list):
+            self.hashable = set()
+            self.unhashable = []
+
+            for value in values:
+                try:
+                    self.hashable.add(value)
+                except TypeError:
+                    self.unhashable.append(value)
 
     def match(self, data):
-        return data in self.values
+        if self.hashable is not None:
+            try:
+                if data in self.hashable:
+                    return True
+
+            # unhashable data:
+            except TypeError:
+                pass
+
+        return data in self.unhashable
 
 
 class ConstraintContain(object):
@@ -304,6 +786,7 @@ class ConstraintIs(object):
 
         # a string means a builtin type:
         if isinstance(class_or_classname, str):
+            import builtins
             self.theclass = getattr(builtins, class_or_classname)
 
         # something isinstance already understands
@@ -311,8 +794,11 @@ class ConstraintIs(object):
         else:
             self.theclass = class_or_classname
 
+        # compact rows are dicts too:
+        self.classes = (dict, Row) if self.theclass is dict else self.theclass
+
     def match(self, data):
-        return isinstance(data, self.theclass)
+        return isinstance(data, self.classes)
 
 
 class ConstraintMatch(object):
@@ -324,7 +810,40 @@ class ConstraintMatch(object):
         self.matcher = matcher
 
     def match(self, data):
-        return self.matcher.match(data) is not NoMatch
+        return self.matcher.test(data)
+
+
+class ConstraintRange(object):
+    """
+    Tests that the data is within a lower and an upper bound
+    (either of them can be None). Combines >, >=, < and <=
+    on the same key (see Compiler.optimize_constraints).
+    """
+    def __init__(self, lower, lower_inclusive, upper, upper_inclusive):
+        self.lower = lower
+        self.lower_inclusive = lower_inclusive
+        self.upper = upper
+        self.upper_inclusive = upper_inclusive
+
+    def match(self, data):
+        if self.lower is not None:
+            if not (data >= self.lower if self.lower_inclusive else data > self.lower):
+                return False
+
+        if self.upper is not None:
+            if not (data <= self.upper if self.upper_inclusive else data < self.upper):
+                return False
+
+        return True
+
+
+class ConstraintNever(object):
+    """
+    Never matches. Replaces constraints that contradict each other,
+    e.g. "age >": 30 and "age <": 20 (see Compiler.optimize_constraints).
+    """
+    def match(self, data):
+        return False
 
 
 # Constraint prefixes:
@@ -395,6 +914,7 @@ class ConstraintSuffixOne(object):
 # Directives:
 # Nodes that transform results into something else.
 # Directives must validate their input values.
+# Results are passed as iterables, so directives can be chained lazily.
 
 class DirectiveLimit(object):
     """
@@ -404,54 +924,540 @@ class DirectiveLimit(object):
         self.limit = limit
 
     def match(self, data):
-        return data[0 : self.limit]
+        # not a plain count, keep the slicing semantics:
+        if not isinstance(self.limit, int) or self.limit < 0:
+            return list(data)[0 : self.limit]
 
+        return itertools.islice(data, self.limit)
 
-class DirectiveOrder(object):
+
+class DirectiveOffset(object):
     """
-    Return results in reverse or random order.
+    Skip N elements from the results.
     """
-    def __init__(self, order):
-        if not order in ['random', 'reverse']:
-            raise CompilerException('__order__: expected "random" or "reverse" as argument.')
+    def __init__(self, offset):
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise CompilerException('__offset__: expected a non-negative integer as argument.')
 
-        self.order = order
+        self.offset = offset
 
     def match(self, data):
-        if self.order == 'random':
-            random.shuffle(data)
-            return data
-
-        if self.order == 'reverse':
-            data.reverse()
-            return data
+        return itertools.islice(data, self.offset, None)
 
 
-class DirectiveSort(object):
+class DirectiveJoin(object):
     """
-    Sort results by a given key.
+    Join results with the records of another dataset, using a hash join.
+    The argument is a dict:
+
+        - "with": the dataset name (see Compiler(datasets = ...)).
+        - "on": a key in the results.
+        - "to": a key in the dataset records (default: "on").
+        - "as": the key that gets the list of matching records (default: "with").
+        - "pattern": a pattern that the dataset records must match,
+          its results are added instead of the records (default: null).
+        - "optional": keep results without matching records (default: false).
+
+    The hash table is built on the smaller side: results are buffered
+    until there are more of them than dataset records, so memory
+    is bounded by the size of the dataset.
     """
-    def __init__(self, key):
-        self.key = key
+    arguments = set(['with', 'on', 'to', 'as', 'pattern', 'optional'])
+
+    def __init__(self, options):
+        if (not isinstance(options, dict) or len(set(options) - self.arguments) > 0
+            or not isinstance(options.get('with'), str) or not isinstance(options.get('on'), str)
+            or not isinstance(options.get('to', ''), str) or not isinstance(options.get('as', ''), str)
+            or not isinstance(options.get('optional', False), bool)):
+            raise CompilerException('__join__: expected { "with": dataset, "on": key, "to": key, "as": key, "pattern": pattern, "optional": bool } as argument.')
+
+        self.name = options['with']
+        self.on = options['on']
+        self.to = options.get('to', self.on)
+        self.key = options.get('as', self.name)
+        self.pattern = options.get('pattern')
+        self.optional = options.get('optional', False)
+
+        # set by the compiler:
+        self.datasets = None
+        self.matcher = None
 
     def match(self, data):
-        return sorted(data, key = lambda value: value[self.key])
+        records = self.datasets[self.name]
 
+        # buffer results until we know which side is smaller:
+        iterator = iter(data)
+        results = list(itertools.islice(iterator, len(records) + 1))
 
-# Wrappers:
-# Take nodes as arguments and modify/combine their behaviour.
+        if len(results) <= len(records):
+            return self.join_results(results, records)
 
-class WrapConstraintsAnd(object):
+        return self.join_records(itertools.chain(results, iterator), records)
+
+    def result_key(self, result):
+        """
+        Return the join key for a result or None when missing.
+        Keys are tuples, so that a null value is not a missing key.
+        """
+        if not isinstance(result, Mapping) or not self.on in result:
+            return None
+
+        return (result[self.on],)
+
+    def record_key(self, record):
+        """
+        Return the join key for a dataset record or None when missing.
+        """
+        if not isinstance(record, Mapping) or not self.to in record:
+            return None
+
+        return (record[self.to],)
+
+    def joined(self, result, matches):
+        """ A copy of 'result' with the matching records. """
+        result = result.materialize() if type(result) is ProjectionView else dict(result)
+        result[self.key] = matches
+        return result
+
+    def join_results(self, results, records):
+        """
+        Fewer results than records: hash the results, scan the records.
+        Only records with a matching key are tested with the pattern.
+        """
+        table = {}
+        matches = [[] for result in results]
+
+        for position, result in enumerate(results):
+            key = self.result_key(result)
+
+            try:
+                if key is not None:
+                    table.setdefault(key, []).append(position)
+
+            # unhashable values can't be joined:
+            except TypeError:
+                pass
+
+        for record in records:
+            key = self.record_key(record)
+
+            try:
+                positions = table.get(key) if key is not None else None
+            except TypeError:
+                positions = None
+
+            if positions is not None:
+                current = self.matcher.match(record)
+
+                if current is not NoMatch:
+                    for position in positions:
+                        matches[position].append(current)
+
+        for result, current in zip(results, matches):
+            if len(current) > 0 or self.optional:
+                yield self.joined(result, current)
+
+    def join_records(self, results, records):
+        """
+        More results than records: hash the records, stream the results.
+        """
+        table = {}
+
+        for record in records:
+            key = self.record_key(record)
+
+            if key is None:
+                continue
+
+            current = self.matcher.match(record)
+
+            if current is not NoMatch:
+                try:
+                    table.setdefault(key, []).append(current)
+                except TypeError:
+                    pass
+
+        for result in results:
+            key = self.result_key(result)
+
+            try:
+                current = table.get(key, []) if key is not None else []
+            except TypeError:
+                current = []
+
+            if len(current) > 0 or self.optional:
+                yield self.joined(result, list(current))
+
+
+class DirectiveOrder(object):
+    """
+    Return results in reverse or random order.
+    """
+    def __init__(self, order):
+        if not order in ['random', 'reverse']:
+            raise CompilerException('__order__: expected "random" or "reverse" as argument.')
+
+        self.order = order
+
+    def match(self, data):
+        data = list(data)
+
+        if self.order == 'random':
+            import random
+            random.shuffle(data)
+            return data
+
+        if self.order == 'reverse':
+            data.reverse()
+            return data
+
+
+class DirectiveSample(object):
+    """
+    Take N random elements from the results, in random order.
+    The argument is N or { "size": N, "seed": value }.
+
+    Uses reservoir sampling, so only N results are kept in memory.
+    (the compiler also uses it for __order__: random + __limit__)
+    """
+    def __init__(self, size_or_options):
+        options = size_or_options
+
+        if not isinstance(options, dict):
+            options = { 'size': size_or_options }
+
+        size = options.get('size')
+        seed = options.get('seed')
+
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0 or len(set(options) - set(['size', 'seed'])) > 0:
+            raise CompilerException('__sample__: expected N or { "size": N, "seed": value } as argument.')
+
+        if not isinstance(seed, (int, str, type(None))):
+            raise CompilerException('__sample__: the seed must be a number or a string.')
+
+        self.size = size
+        self.seed = seed
+
+    def match(self, data):
+        import math
+        import random
+
+        generator = random.Random(self.seed)
+
+        iterator = iter(data)
+        reservoir = list(itertools.islice(iterator, self.size))
+
+        # not enough results or nothing to take:
+        if len(reservoir) < self.size or self.size == 0:
+            generator.shuffle(reservoir)
+            return reservoir
+
+        # Algorithm L, skip a random number of results between replacements:
+        weight = math.exp(math.log(1.0 - generator.random()) / self.size)
+
+        while True:
+            skip = int(math.log(1.0 - generator.random()) / math.log(1.0 - weight))
+
+            for value in itertools.islice(iterator, skip, skip + 1):
+                reservoir[generator.randrange(self.size)] = value
+                break
+            else:
+                break
+
+            weight *= math.exp(math.log(1.0 - generator.random()) / self.size)
+
+        generator.shuffle(reservoir)
+        return reservoir
+
+
+class DirectiveSort(object):
+    """
+    Sort results by a given key.
+
+    When 'buffer_size' is set, at most that many results are sorted
+    in memory at once. Bigger inputs are split into sorted runs stored
+    in temporary files that are merged lazily.
+
+    The compiler fuses a following reverse order or limit
+    into 'reverse' and 'limit'.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.buffer_size = None
+        self.reverse = False
+        self.limit = None
+
+    def sort_key(self, value):
+        return value[self.key]
+
+    def match(self, data):
+
+        # top N results, no need to keep everything:
+        if self.limit is not None and (self.buffer_size is None or self.limit <= self.buffer_size):
+            return self.match_top(data)
+
+        runs = []
+        buffer = []
+
+        if self.buffer_size is not None:
+            for value in data:
+                buffer.append(value)
+
+                if len(buffer) >= self.buffer_size:
+                    runs.append(self.spill(buffer))
+                    buffer = []
+        else:
+            buffer = list(data)
+
+        buffer.sort(key = self.sort_key)
+        if self.reverse:
+            buffer.reverse()
+
+        # everything fits in memory:
+        if len(runs) == 0:
+            result = buffer
+        else:
+            result = self.merge(runs, buffer)
+
+        if self.limit is not None:
+            result = itertools.islice(result, self.limit)
+
+        return result
+
+    def match_top(self, data):
+        """
+        Sort and limit in a single pass, using O(limit) memory.
+        """
+        import heapq
+
+        if not self.reverse:
+            return heapq.nsmallest(self.limit, data, key = self.sort_key)
+
+        # reversing a stable sort puts later elements first on ties:
+        pairs = heapq.nlargest(self.limit, enumerate(data),
+            key = lambda pair: (self.sort_key(pair[1]), pair[0]))
+
+        return [value for position, value in pairs]
+
+    def spill(self, buffer):
+        """
+        Sort 'buffer' and write it to a temporary file.
+        """
+        import pickle
+        import tempfile
+
+        buffer.sort(key = self.sort_key)
+        if self.reverse:
+            buffer.reverse()
+
+        run = tempfile.TemporaryFile()
+        for value in buffer:
+            pickle.dump(value, run, pickle.HIGHEST_PROTOCOL)
+
+        run.seek(0)
+        return run
+
+    def read_run(self, run):
+        """
+        Iterate the values in a run, closing (and deleting) it when done.
+        """
+        import pickle
+
+        try:
+            while True:
+                try:
+                    yield pickle.load(run)
+                except EOFError:
+                    break
+        finally:
+            run.close()
+
+    def merge(self, runs, buffer):
+        """
+        K-way merge of the spilled runs and the remaining buffer.
+        """
+        import heapq
+
+        sources = [self.read_run(run) for run in runs] + [buffer]
+
+        # keep ties stable, later runs go first when reversing:
+        if self.reverse:
+            sources.reverse()
+
+        return heapq.merge(*sources, key = self.sort_key, reverse = self.reverse)
+
+
+class DirectiveAggregate(object):
+    """
+    Replace the results with a summary computed by some aggregate
+    directives, optionally one summary for each distinct value of a key.
+    Results are consumed one at a time and never stored.
+    (the compiler builds it from __group__, __count__, __sum__, ...)
+    """
+    def __init__(self, group, aggregates):
+        self.group = group
+        self.aggregates = aggregates
+
+    def start(self, group_value):
+        summary = { aggregate: aggregate.start() for aggregate in self.aggregates }
+        return group_value, summary
+
+    def match(self, data):
+        groups = {}
+        unhashable_groups = []
+
+        for value in data:
+            group_value = None
+
+            if self.group is not None:
+                group_value = value.get(self.group)
+
+            # find the group for the current value:
+            try:
+                if not group_value in groups:
+                    groups[group_value] = self.start(group_value)
+
+                group = groups[group_value]
+
+            # lists and dicts, compare them one by one:
+            except TypeError:
+                for group in unhashable_groups:
+                    if group[0] == group_value:
+                        break
+                else:
+                    group = self.start(group_value)
+                    unhashable_groups.append(group)
+
+            for aggregate, state in group[1].items():
+                aggregate.add(state, value)
+
+        # no grouping, always summarize even without results:
+        if self.group is None and len(groups) == 0:
+            groups[None] = self.start(None)
+
+        result = []
+        for group_value, summary in list(groups.values()) + unhashable_groups:
+            current = {}
+
+            if self.group is not None:
+                current[self.group] = group_value
+
+            for aggregate, state in summary.items():
+                current.update(zip(aggregate.names(), aggregate.finish(state)))
+
+            result.append(current)
+
+        return result
+
+
+class DirectiveGroup(object):
+    """
+    Group results by the value of a key.
+    Combined with the aggregate directives that follow it.
+    """
+    def __init__(self, key):
+        if not isinstance(key, str):
+            raise CompilerException('__group__: expected a key as argument.')
+
+        self.key = key
+
+    def match(self, data):
+        return DirectiveAggregate(self.key, []).match(data)
+
+
+class DirectiveCount(object):
+    """
+    Count the results.
+    """
+    def __init__(self, value):
+        if value is not True:
+            raise CompilerException('__count__: expected true as argument.')
+
+    def names(self):
+        return ['count']
+
+    def start(self):
+        return [0]
+
+    def add(self, state, value):
+        state[0] += 1
+
+    def finish(self, state):
+        return state
+
+    def match(self, data):
+        return DirectiveAggregate(None, [self]).match(data)
+
+
+class DirectiveFieldAggregate(object):
     """
-    Combine two constraints into a single one
-    returning True/False depending on whether both match.
+    Base class for aggregates over the values of some keys
+    in the results. Results without the key are ignored.
     """
-    def __init__(self, constraint_a, constraint_b):
-        self.constraint_a = constraint_a
-        self.constraint_b = constraint_b
+    name = None
+
+    def __init__(self, key_or_keys):
+        if isinstance(key_or_keys, str):
+            key_or_keys = [key_or_keys]
+
+        if not isinstance(key_or_keys, list) or not all(isinstance(key, str) for key in key_or_keys):
+            raise CompilerException('{}: expected a key or a list of keys as argument.'.format(self.name))
+
+        self.keys = key_or_keys
+
+    def names(self):
+        suffix = self.name.strip('_')
+        return ['{} {}'.format(key, suffix) for key in self.keys]
+
+    def start(self):
+        return [NoMatch] * len(self.keys)
+
+    def add(self, state, value):
+        for position, key in enumerate(self.keys):
+            if key in value:
+                if state[position] is NoMatch:
+                    state[position] = value[key]
+                else:
+                    state[position] = self.combine(state[position], value[key])
+
+    def finish(self, state):
+        return [None if total is NoMatch else total for total in state]
 
     def match(self, data):
-        return self.constraint_a.match(data) and self.constraint_b.match(data)
+        return DirectiveAggregate(None, [self]).match(data)
+
+
+class DirectiveSum(DirectiveFieldAggregate):
+    """
+    Sum the values of a key (or list of keys) in the results.
+    """
+    name = '__sum__'
+
+    def combine(self, total, value):
+        return total + value
+
+    def finish(self, state):
+        return [0 if total is NoMatch else total for total in state]
+
+
+class DirectiveMin(DirectiveFieldAggregate):
+    """
+    Minimum value of a key (or list of keys) in the results.
+    """
+    name = '__min__'
+
+    def combine(self, total, value):
+        return value if value < total else total
+
+
+class DirectiveMax(DirectiveFieldAggregate):
+    """
+    Maximum value of a key (or list of keys) in the results.
+    """
+    name = '__max__'
+
+    def combine(self, total, value):
+        return value if value > total else total
 
 
 # Compiler utils:
@@ -508,13 +1514,41 @@ class Compiler(object):
 
     directives = {
         '__limit__' : DirectiveLimit,
+        '__offset__': DirectiveOffset,
+        '__join__'  : DirectiveJoin,
         '__order__' : DirectiveOrder,
         '__sort__'  : DirectiveSort,
+        '__sample__': DirectiveSample,
+        '__group__' : DirectiveGroup,
+        '__count__' : DirectiveCount,
+        '__sum__'   : DirectiveSum,
+        '__min__'   : DirectiveMin,
+        '__max__'   : DirectiveMax,
     }
 
 
-    def __init__(self):
-        pass
+    def __init__(self, sort_buffer = None, limits = None, adapt = False, views = False, datasets = None):
+        self.sort_buffer = sort_buffer
+        self.limits = limits
+        self.adapt = adapt
+        self.views = views
+        self.datasets = datasets
+
+    def settings(self):
+        """
+        Return the settings that change compiled patterns as a tuple
+        that can be used as a key (see PlanCache). Limits and datasets
+        are described by their values and names, not their contents.
+        """
+        limits = None
+        if self.limits is not None:
+            limits = (self.limits.timeout, self.limits.max_steps)
+
+        datasets = None
+        if self.datasets is not None:
+            datasets = tuple(sorted(self.datasets))
+
+        return (self.sort_buffer, limits, self.adapt, self.views, datasets)
 
     def compile(self, pattern):
         """
@@ -602,7 +1636,7 @@ class Compiler(object):
 
             # directive?
             if key in self.directives:
-                directive = self.directives[key](value)
+                directive = self.compile_directive(key, value)
                 directives.append(directive)
                 continue
 
@@ -639,116 +1673,3654 @@ class Compiler(object):
                     prefix_class = self.constraint_prefixes[prefix]
                     constraint = prefix_class(constraint)
 
-                # key already in the dict? combine with the previous constraint:
-                if constraint_key in constraints:
-                    constraint = WrapConstraintsAnd(constraint, constraints[constraint_key])
-
-                constraints[constraint_key] = constraint
+                # keys can have many constraints, combined later:
+                constraints.setdefault(constraint_key, []).append(constraint)
                 continue
 
             # regular matcher:
             matchers[key] = self.compile(value)
 
-        return MatchDict(matchers, constraints, directives, additional_keys)
+        for key, key_constraints in constraints.items():
+            constraints[key] = self.optimize_constraints(key_constraints)
 
-    def compile_list(self, pattern):
+        directives = self.optimize_directives(directives)
+        return MatchDict(matchers, constraints, directives, additional_keys, self.limits, self.adapt, self.views)
+
+    def compile_directive(self, key, value):
         """
-        Lists are compiled into either MatchEmptyList or MatchList instances.
+        Instantiate a directive, passing the compiler settings it uses.
         """
-        # optimize empty patterns:
-        if pattern == []:
-            return MatchEmptyList()
+        directive = self.directives[key](value)
 
-        matchers = [self.compile(value) for value in pattern]
-        return MatchList(matchers)
+        if isinstance(directive, DirectiveSort):
+            directive.buffer_size = self.sort_buffer
 
-    def compile_unknown(self, pattern):
+        if isinstance(directive, DirectiveJoin):
+            if self.datasets is None or not directive.name in self.datasets:
+                raise CompilerException('__join__: unknown dataset: {}.'.format(directive.name))
+
+            directive.datasets = self.datasets
+            directive.matcher = self.compile(directive.pattern)
+
+        return directive
+
+    def optimize_constraints(self, constraints):
         """
-        Not a JSON type, rely on Python equality (e.g. for datetime).
+        Combine all the constraints for a key into a single one:
+            - Double negations are removed: not != is ==, not == is !=.
+            - Comparisons (>, >=, <, <=) are merged into a ConstraintRange.
+            - == and in are merged into a ConstraintIn (set lookups)
+              with the values allowed by all of them, != and ranges.
+            - Contradictions (no value can match) become a ConstraintNever.
+
+        Constraints that can't raise errors (==, in, !=) are tested first.
+        The rest keep their order, with the range in place of the first
+        comparison (it raises for the same data as that comparison). So rewriting never raises errors for data that
+        wasn't raising them, but can avoid some (e.g. a contradiction
+        doesn't compare anything).
         """
-        return MatchEqual(pattern)
+        equal = None
+        lower = upper = None
+        lower_inclusive = upper_inclusive = False
+        comparisons = []
+        not_equal = []
+        others = []
+
+        # where the range goes in 'others':
+        range_position = object()
+
+        def kind(value):
+            """ Values that can be ordered between them. """
+            if isinstance(value, (bool, int, float)) and value == value:
+                return 'number'
+            if isinstance(value, str):
+                return 'str'
+            return None
+
+        # the last constraint for a key was always tested first, keep that:
+        for constraint in map(self.remove_negations, reversed(constraints)):
+            cls = type(constraint)
+
+            # allowed values:
+            if cls is ConstraintEqualTo or (cls is ConstraintIn and isinstance(constraint.values, list)):
+                values = [constraint.value] if cls is ConstraintEqualTo else constraint.values
+
+                if equal is None:
+                    equal = values
+                else:
+                    equal = [value for value in equal if value in values]
+                continue
 
+            if cls is ConstraintNotEqualTo:
+                not_equal.append(constraint)
+                continue
 
-# Higher-level pattern classes:
+            # bounds of the same kind:
+            if cls in (ConstraintMoreThan, ConstraintMoreOrEqualTo, ConstraintLessThan, ConstraintLessOrEqualTo):
+                value = constraint.value
+                bounds = [it for it in (lower, upper) if it is not None]
 
-class Pattern(object):
-    """
-    A raw (Python object) pattern.
-    """
-    def __init__(self, data):
-        self._compiler = Compiler()
-        self._data = data
-        self._pattern_compiled = None
+                if kind(value) is not None and all(kind(it) == kind(value) for it in bounds):
+                    inclusive = cls in (ConstraintMoreOrEqualTo, ConstraintLessOrEqualTo)
 
-    def compile(self):
-        """
-        Compile this pattern.
-        """
-        self._pattern_compiled = self._compiler.compile(self._data)
+                    if cls in (ConstraintMoreThan, ConstraintMoreOrEqualTo):
+                        if lower is None or value > lower or (value == lower and not inclusive):
+                            lower, lower_inclusive = value, inclusive
+                    else:
+                        if upper is None or value < upper or (value == upper and not inclusive):
+                            upper, upper_inclusive = value, inclusive
 
-    def match(self, data):
-        """
-        Execute this pattern against the given data.
-        """
-        if self._pattern_compiled is None:
-            self.compile()
+                    # the range goes where the first comparison was:
+                    if len(comparisons) == 0:
+                        others.append(range_position)
 
-        return self._pattern_compiled.match(data)
+                    comparisons.append(constraint)
+                    continue
 
+            others.append(constraint)
 
-class JSONPattern(object):
-    """
-    A JSON pattern.
-    """
-    def __init__(self, jsondata):
-        self._decoder = JSONDecoder(object_pairs_hook = OrderedDict)
-        self._jsondata = jsondata
-        self._pattern_decoded = None
+        # contradicting bounds?
+        if lower is not None and upper is not None:
+            if lower > upper or (lower == upper and not (lower_inclusive and upper_inclusive)):
+                return ConstraintNever()
 
-    def decode(self):
-        """
-        Decode the JSON.
-        """
-        self._pattern_decoded = Pattern(self._decoder.decode(self._jsondata))
+        bounds = None
+        if len(comparisons) == 1:
+            bounds = comparisons[0]
+        elif len(comparisons) > 1:
+            bounds = ConstraintRange(lower, lower_inclusive, upper, upper_inclusive)
 
-    def match(self, data):
-        """
-        Execute this pattern against the given data.
-        """
-        if self._pattern_decoded is None:
-            self.decode()
+        result = []
 
-        return self._pattern_decoded.match(data)
+        if equal is not None:
 
+            # keep the values that pass != and the bounds,
+            # so they don't need to be tested again:
+            equal = [value for value in equal if all(value != it.value for it in not_equal)]
+            not_equal = []
 
-# IO utils and formatting JSON:
-# (part of the API because the shell will use them too)
+            if bounds is not None:
+                try:
+                    equal = [value for value in equal if bounds.match(value)]
+                    bounds = None
 
-NEWLINES = {
-    'dos'    : '\r\n',
-    'mac'    : '\r',
-    'unix'   : '\n',
-    'system' : os.linesep,
-}
+                # values that can't be compared, keep testing them:
+                except TypeError:
+                    pass
 
+            if len(equal) == 0:
+                return ConstraintNever()
 
-def binary_stdin_read_utf8():
-    """ Read from stdin as UTF-8 (allowing an optional BOM). """
-    content = sys.stdin.buffer.read()
-    return content.decode('utf-8-sig')
+            if len(equal) == 1:
+                result.append(ConstraintEqualTo(equal[0]))
+            else:
+                result.append(ConstraintIn(equal))
 
+        result += not_equal
 
-def binary_stdout_write_utf8(text):
-    """ Write 'text' to stdout as UTF-8. """
-    content = text.encode('utf-8')
-    sys.stdout.buffer.write(content)
+        for constraint in others:
+            if constraint is range_position:
+                if bounds is not None:
+                    result.append(bounds)
+            else:
+                result.append(constraint)
 
+        if len(result) == 1:
+            return result[0]
 
-class JSONFormatter(object):
-    """
-    A helper to print JSON to stdout in a desired format.
-    It's just a wrapper over json.dumps() with configurable newlines.
-    """
+        return ConstraintSuffixAll(result)
+
+    def remove_negations(self, constraint):
+        """
+        Remove double negations: not not, not ==, not !=.
+        """
+        while isinstance(constraint, ConstraintPrefixNot):
+            negated = constraint.constraint
+
+            if isinstance(negated, ConstraintPrefixNot):
+                constraint = negated.constraint
+
+            elif isinstance(negated, ConstraintEqualTo):
+                constraint = ConstraintNotEqualTo(negated.value)
+
+            elif isinstance(negated, ConstraintNotEqualTo):
+                constraint = ConstraintEqualTo(negated.value)
+
+            else:
+                break
+
+        return constraint
+
+    def optimize_directives(self, directives):
+        """
+        Fuse __sort__ with a following reverse __order__ or __limit__
+        (also __offset__ and __limit__) so that sorting doesn't need
+        to materialize all the results.
+
+        Consecutive aggregate directives (__group__, __count__, ...)
+        are combined into a single DirectiveAggregate.
+
+        A random __order__ followed by __limit__ is replaced
+        by __sample__, which doesn't shuffle all the results.
+        """
+        result = []
+
+        for directive in directives:
+            previous = result[-1] if len(result) > 0 else None
+
+            if isinstance(directive, DirectiveGroup):
+                if isinstance(previous, DirectiveAggregate) and previous.group is None:
+                    previous.group = directive.key
+                else:
+                    result.append(DirectiveAggregate(directive.key, []))
+                continue
+
+            if isinstance(directive, (DirectiveCount, DirectiveFieldAggregate)):
+                if isinstance(previous, DirectiveAggregate):
+                    previous.aggregates.append(directive)
+                else:
+                    result.append(DirectiveAggregate(None, [directive]))
+                continue
+
+            if (isinstance(previous, DirectiveOrder) and previous.order == 'random'
+                and isinstance(directive, DirectiveLimit)
+                and isinstance(directive.limit, int) and directive.limit >= 0):
+                result[-1] = DirectiveSample(directive.limit)
+                continue
+
+            if isinstance(previous, DirectiveSort) and previous.limit is None:
+
+                if isinstance(directive, DirectiveOrder) and directive.order == 'reverse' and not previous.reverse:
+                    previous.reverse = True
+                    continue
+
+                if isinstance(directive, DirectiveLimit) and isinstance(directive.limit, int) and directive.limit >= 0:
+                    previous.limit = directive.limit
+                    continue
+
+            # __sort__, __offset__, __limit__: only offset + limit results are needed:
+            if (isinstance(previous, DirectiveOffset) and len(result) > 1
+                and isinstance(result[-2], DirectiveSort) and result[-2].limit is None
+                and isinstance(directive, DirectiveLimit)
+                and isinstance(directive.limit, int) and directive.limit >= 0):
+                result[-2].limit = previous.offset + directive.limit
+                continue
+
+            result.append(directive)
+
+        return result
+
+    def compile_list(self, pattern):
+        """
+        Lists are compiled into either MatchEmptyList or MatchList instances.
+        """
+        # optimize empty patterns:
+        if pattern == []:
+            return MatchEmptyList()
+
+        matchers = [self.compile(value) for value in pattern]
+        return MatchList(matchers, self.limits, self.adapt)
+
+    def compile_unknown(self, pattern):
+        """
+        Not a JSON type, rely on Python equality (e.g. for datetime).
+        """
+        return MatchEqual(pattern)
+
+
+# Compact data:
+# Loading helpers that reduce the memory used by big datasets
+# made of many dicts with the same keys.
+
+class KeyBits(object):
+    """
+    Assigns a bit to every key, so that a set of keys is an integer mask.
+    Each CompactLoader has its own, shared by all the Shapes it creates.
+    """
+    def __init__(self):
+        self.bits = {}
+
+        # required keys -> (mask, number of bits or None when complete):
+        self.required_masks = {}
+
+        # for ShapedDicts that gained keys, every bit set so nothing is rejected:
+        self.unknown = Shape((), self)
+        self.unknown.mask = -1
+
+    def mask(self, keys, add = True):
+        """
+        Return the bitmask for a list of keys.
+        When 'add' is False, keys without a bit are left out.
+        """
+        bits = self.bits
+        mask = 0
+
+        for key in keys:
+            bit = bits.get(key)
+
+            if bit is None:
+                if not add:
+                    continue
+
+                # (setdefault keeps the first bit if two threads add the same key)
+                bit = bits.setdefault(key, 1 << len(bits))
+
+            mask |= bit
+
+        return mask
+
+    def required(self, keys, max_masks = 4096):
+        """
+        Return the bitmask for the keys that a MatchDict requires.
+        Keys without a bit are left out, until they get one.
+        Cached here, so that matchers shared between loaders
+        (or threads) are never modified.
+        """
+        bits = self.bits
+        cached = self.required_masks.get(keys)
+
+        if cached is not None and (cached[1] is None or cached[1] == len(bits)):
+            return cached[0]
+
+        mask = self.mask(keys, add = False)
+
+        if len(self.required_masks) < max_masks:
+            complete = all(key in bits for key in keys)
+            self.required_masks[keys] = (mask, None if complete else len(bits))
+
+        return mask
+
+    def __getstate__(self):
+        return self.bits
+
+    def __setstate__(self, bits):
+        self.__init__()
+        self.bits = bits
+
+
+class Shape(object):
+    """
+    The keys of a Row or a ShapedDict, shared by all the records
+    that have the same keys. The mask is used to test for
+    required keys with a single operation.
+    """
+    __slots__ = ('keys', 'positions', 'bits', 'mask')
+
+    def __init__(self, keys, bits):
+        self.keys = keys
+        self.positions = { key: position for position, key in enumerate(keys) }
+        self.bits = bits
+        self.mask = bits.mask(keys)
+
+    def __getstate__(self):
+        return (self.keys, self.bits)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class ShapedDict(dict):
+    """
+    A regular dict that knows its Shape.
+    (loaded by a CompactLoader when not using rows)
+
+    Adding keys forgets the shape, so that MatchDict
+    checks every key again.
+    """
+    __slots__ = ('_shape',)
+
+    def __setitem__(self, key, value):
+        if not key in self:
+            self._shape = self._shape.bits.unknown
+
+        dict.__setitem__(self, key, value)
+
+    def __ior__(self, other):
+        self._shape = self._shape.bits.unknown
+        return dict.__ior__(self, other)
+
+    def setdefault(self, key, default = None):
+        if not key in self:
+            self._shape = self._shape.bits.unknown
+
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._shape = self._shape.bits.unknown
+        dict.update(self, *args, **kwargs)
+
+    def __reduce__(self):
+        return (shaped_dict, (dict(self), self._shape))
+
+
+def shaped_dict(items, shape):
+    """
+    Create a ShapedDict (used when unpickling).
+    """
+    result = ShapedDict(items)
+    result._shape = shape
+    return result
+
+
+class Row(Mapping):
+    """
+    A read-only dict-like record.
+    Values are stored in a tuple, keys are shared using a Shape.
+    """
+    __slots__ = ('_shape', '_values')
+
+    def __init__(self, shape, values):
+        self._shape = shape
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._shape.positions[key]]
+
+    def __contains__(self, key):
+        return key in self._shape.positions
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+SHAPED_TYPES = (Row, ShapedDict)
+
+
+class CompactLoader(object):
+    """
+    An object_pairs_hook for JSON decoders that:
+        - Interns dict keys.
+        - Shares short string values between all the loaded dicts
+          (up to 'max_strings' distinct values).
+        - Gives every dict a Shape, as a ShapedDict or a Row
+          (when rows is True).
+
+    A single loader should be used for all the documents in a dataset
+    (e.g. every line in a NDJSON file) so that they share memory.
+    """
+    def __init__(self, rows = False, max_string_length = 32, max_shapes = 4096, max_strings = 65536):
+        self.rows = rows
+        self.max_string_length = max_string_length
+        self.max_strings = max_strings
+        self.max_shapes = max_shapes
+
+        self.strings = {}
+        self.shapes = {}
+        self.key_bits = KeyBits()
+
+    def __call__(self, pairs):
+        strings = self.strings
+        max_string_length = self.max_string_length
+        max_strings = self.max_strings
+
+        keys = []
+        values = []
+
+        for key, value in pairs:
+            keys.append(sys.intern(key))
+
+            if isinstance(value, str) and len(value) <= max_string_length:
+                shared = strings.get(value)
+
+                # when full, only share the strings already seen:
+                if shared is not None:
+                    value = shared
+                elif len(strings) < max_strings:
+                    strings[value] = value
+
+            values.append(value)
+
+        if len(keys) == 0:
+            return {}
+
+        keys = tuple(keys)
+        shape = self.shapes.get(keys)
+
+        if shape is None:
+
+            # too many distinct shapes or repeated keys, use a regular dict:
+            if len(self.shapes) >= self.max_shapes or len(set(keys)) != len(keys):
+                return dict(zip(keys, values))
+
+            shape = Shape(keys, self.key_bits)
+            self.shapes[keys] = shape
+
+        if self.rows:
+            return Row(shape, tuple(values))
+
+        return shaped_dict(zip(keys, values), shape)
+
+
+# Adapters:
+# Let patterns match Python objects directly, without converting them
+# to dicts and lists first (see Compiler(adapt = True)).
+
+# field names for each adapted type, or None when the type can't be adapted:
+ADAPTED_FIELDS = {}
+
+
+def object_fields(cls):
+    """
+    Return the field names for instances of 'cls' as a dict (for ordered
+    and fast lookups) or None when they aren't known.
+    """
+    # dataclasses:
+    if hasattr(cls, '__dataclass_fields__'):
+        import dataclasses
+        return dict.fromkeys(field.name for field in dataclasses.fields(cls))
+
+    # namedtuples:
+    if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        return dict.fromkeys(cls._fields)
+
+    # __slots__, in every base class:
+    names = []
+
+    for base in reversed(cls.__mro__):
+        slots = base.__dict__.get('__slots__', ())
+
+        if isinstance(slots, str):
+            slots = [slots]
+
+        names += [name for name in slots if not name in ('__dict__', '__weakref__')]
+
+    if len(names) > 0:
+        return dict.fromkeys(names)
+
+    return None
+
+
+class AttributeView(Mapping):
+    """
+    A read-only dict-like view over the fields of an object.
+    Unset __slots__ are treated as missing keys.
+    """
+    __slots__ = ('_object', '_fields')
+
+    def __init__(self, instance, fields):
+        self._object = instance
+        self._fields = fields
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self._object, key)
+            except AttributeError:
+                pass
+
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self._object, key)
+
+    def __iter__(self):
+        return (name for name in self._fields if hasattr(self._object, name))
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def adapt_mapping(data):
+    """
+    Return something that can be matched like a dict for 'data' or None:
+        - Mappings are returned as they are.
+        - Dataclasses, namedtuples and __slots__ objects are wrapped
+          in an AttributeView. Their fields are cached per type.
+    """
+    if isinstance(data, Mapping):
+        return data
+
+    cls = type(data)
+
+    try:
+        fields = ADAPTED_FIELDS[cls]
+    except KeyError:
+        fields = ADAPTED_FIELDS.setdefault(cls, object_fields(cls))
+
+    if fields is None:
+        return None
+
+    return AttributeView(data, fields)
+
+
+def is_adaptable_sequence(data):
+    """
+    Whether 'data' can be matched like a list.
+    Strings and bytes are sequences, but not lists of values.
+    """
+    return isinstance(data, Sequence) and not isinstance(data, (str, bytes, bytearray))
+
+
+# Projection views:
+# With Compiler(views = True), dict patterns return read-only views
+# of the matched data instead of copying the selected keys to new dicts.
+
+class ProjectionView(Mapping):
+    """
+    A read-only dict-like result that references the matched data.
+    'values' has the results of the matchers that are not null
+    (or None), every other key is read from the data when needed.
+
+    Views see later changes to the data. Use dict(view) to get a copy.
+    They are pickled as dicts.
+    """
+    __slots__ = ('_data', '_matcher', '_values')
+
+    def __init__(self, data, matcher, values):
+        self._data = data
+        self._matcher = matcher
+        self._values = values
+
+    def __getitem__(self, key):
+        values = self._values
+
+        if values is not None and key in values:
+            return values[key]
+
+        if key in self:
+            return self._data[key]
+
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        matcher = self._matcher
+
+        if key in matcher.projected_key_set:
+            return True
+
+        if matcher.additional_keys == '*' or key in matcher.extra_key_set:
+            return key in self._data
+
+        return False
+
+    def __iter__(self):
+        matcher = self._matcher
+        data = self._data
+
+        yield from matcher.projected_keys
+
+        if matcher.additional_keys == '*':
+            for key in data:
+                if not key in matcher.projected_key_set:
+                    yield key
+        else:
+            for key in matcher.extra_keys:
+                if key in data:
+                    yield key
+
+    def __len__(self):
+        matcher = self._matcher
+
+        # the projected keys are always in the data:
+        if matcher.additional_keys == '*':
+            return len(self._data)
+
+        return len(matcher.projected_keys) + sum(1 for key in matcher.extra_keys if key in self._data)
+
+    def materialize(self):
+        """
+        Return a dict copy, faster than dict(view).
+        """
+        matcher = self._matcher
+        data = self._data
+
+        # keys keep their position when updated:
+        result = { key: data[key] for key in matcher.projected_keys }
+
+        if matcher.additional_keys == '*':
+            result.update(data)
+        else:
+            for key in matcher.extra_keys:
+                if key in data:
+                    result[key] = data[key]
+
+        if self._values is not None:
+            result.update(self._values)
+
+        return result
+
+    def __reduce__(self):
+        return dict, (self.materialize(),)
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+
+# Iterative evaluation:
+# Runs the same compiled nodes without recursion, for deeply nested
+# data and patterns. Nodes with children are evaluated by generators
+# (frames) that yield (node, data, mode) requests for their children
+# and receive the results. A loop keeps the frames in a list.
+
+# what a request wants:
+EVALUATE_MATCH = 0        # node.match(data), for matchers
+EVALUATE_TEST = 1         # node.test(data), for matchers
+EVALUATE_CONSTRAINT = 2   # node.match(data), for constraints
+
+
+def evaluate(node, data, mode = EVALUATE_MATCH):
+    """
+    Evaluate 'node' for 'data' without recursion.
+    Returns the same as node.match(data) or node.test(data).
+    """
+    frame = evaluate_frame(node, data, mode)
+
+    if frame is None:
+        return evaluate_leaf(node, data, mode)
+
+    frames = [frame]
+    value = None
+
+    while True:
+        try:
+            node, data, mode = frames[-1].send(value)
+
+        # the frame is done, pass the result to the previous one:
+        except StopIteration as stop:
+            frames.pop()
+            value = stop.value
+
+            if len(frames) == 0:
+                return value
+
+            continue
+
+        frame = evaluate_frame(node, data, mode)
+
+        if frame is None:
+            value = evaluate_leaf(node, data, mode)
+        else:
+            frames.append(frame)
+            value = None
+
+
+def evaluate_leaf(node, data, mode):
+    """ Evaluate a node that has no children. """
+    if mode == EVALUATE_TEST:
+        return node.test(data)
+
+    return node.match(data)
+
+
+def evaluate_frame(node, data, mode):
+    """ Return a frame for a node with children or None. """
+    cls = type(node)
+
+    if mode == EVALUATE_CONSTRAINT:
+        if cls is ConstraintMatch:
+            return evaluate_constraint_match(node, data)
+
+        if cls is ConstraintPrefixNot:
+            return evaluate_constraint_not(node, data)
+
+        if cls in (ConstraintSuffixAll, ConstraintSuffixAny, ConstraintSuffixOne):
+            return evaluate_constraint_suffix(node, data)
+
+        return None
+
+    if cls is MatchDict:
+        return evaluate_dict(node, data, mode == EVALUATE_TEST)
+
+    if cls is MatchList:
+        return evaluate_list(node, data, mode == EVALUATE_TEST)
+
+    return None
+
+
+def evaluate_constraint_match(constraint, data):
+    """ Same as ConstraintMatch.match(). """
+    return (yield constraint.matcher, data, EVALUATE_TEST)
+
+
+def evaluate_constraint_not(constraint, data):
+    """ Same as ConstraintPrefixNot.match(). """
+    return not (yield constraint.constraint, data, EVALUATE_CONSTRAINT)
+
+
+def evaluate_constraint_suffix(constraint, data):
+    """ Same as the match() of all, any and one. """
+    cls = type(constraint)
+    matched = 0
+
+    for current in constraint.constraints:
+        if (yield current, data, EVALUATE_CONSTRAINT):
+            matched += 1
+
+            if cls is ConstraintSuffixAny:
+                return True
+
+            if cls is ConstraintSuffixOne and matched > 1:
+                return False
+
+        elif cls is ConstraintSuffixAll:
+            return False
+
+    if cls is ConstraintSuffixOne:
+        return matched == 1
+
+    return cls is not ConstraintSuffixAny
+
+
+def evaluate_dict(matcher, data, test):
+    """ Same as MatchDict.match() or MatchDict.test(). """
+    failed = False if test else NoMatch
+    data = matcher.prepare(data)
+
+    if data is None:
+        return failed
+
+    # constraints match?
+    for key, constraint in matcher.constraints:
+        if not key in data or not (yield constraint, data[key], EVALUATE_CONSTRAINT):
+            return failed
+
+    # matchers match?
+    if test:
+        for key, submatcher in matcher.matchers:
+            if not key in data or not (yield submatcher, data[key], EVALUATE_TEST):
+                return False
+
+        return True
+
+    if matcher.views:
+        values = None
+
+        for key, submatcher in matcher.matchers:
+            if not key in data:
+                return NoMatch
+
+            if type(submatcher) is MatchAny:
+                continue
+
+            current = yield submatcher, data[key], EVALUATE_MATCH
+
+            if current is NoMatch:
+                return NoMatch
+
+            if values is None:
+                values = {}
+
+            values[key] = current
+
+        return ProjectionView(data, matcher, values)
+
+    result = {}
+    for key, submatcher in matcher.matchers:
+        if not key in data:
+            return NoMatch
+
+        current = yield submatcher, data[key], EVALUATE_MATCH
+
+        if current is NoMatch:
+            return NoMatch
+
+        result[key] = current
+
+    # add all the data keys to the result if needed:
+    return matcher.complete(data, result)
+
+
+def evaluate_list(matcher, data, test):
+    """ Same as MatchList.match() or MatchList.test(). """
+    failed = False if test else NoMatch
+
+    if matcher.unsatisfiable:
+        return failed
+
+    # not a list?
+    if not isinstance(data, list) and not (matcher.adapt and is_adaptable_sequence(data)):
+        return failed
+
+    if matcher.limits is not None:
+        matcher.limits.tick(len(data) * len(matcher.matchers))
+
+    result = []
+    for submatcher in matcher.matchers:
+
+        # without directives, the values are evaluated by this frame:
+        if len(getattr(submatcher, 'directives', [])) == 0:
+
+            # stop at the first value when testing:
+            if test:
+                for value in data:
+                    if (yield submatcher, value, EVALUATE_TEST):
+                        break
+                else:
+                    return False
+
+                continue
+
+            matcher_results = []
+            for value in data:
+                current = yield submatcher, value, EVALUATE_MATCH
+
+                if current is not NoMatch:
+                    matcher_results.append(current)
+
+        # directives pull the results lazily, like in MatchList:
+        else:
+            matcher_results = matcher.apply_directives(submatcher, evaluate_results(submatcher, data))
+
+            if test:
+                if next(iter(matcher_results), NoMatch) is NoMatch:
+                    return False
+
+                continue
+
+            matcher_results = list(matcher_results)
+
+        # at least one match?
+        if len(matcher_results) == 0:
+            return NoMatch
+
+        result += matcher_results
+
+    return True if test else result
+
+
+def evaluate_results(matcher, data):
+    """
+    Yield the results of a matcher for every value in 'data', lazily,
+    so that directives can stop early (e.g. __limit__). Each value
+    is evaluated by its own evaluate() loop, so only lists with
+    directives add to the Python stack (a few frames each).
+    """
+    if getattr(matcher, 'unsatisfiable', False):
+        return
+
+    for value in data:
+        current = evaluate(matcher, value)
+
+        if current is not NoMatch:
+            yield current
+
+
+# Paging:
+# Results can be read in pages. A page token records where the scan
+# stopped in the input, so the next page resumes from there instead
+# of matching the records before it again.
+
+class PageTokenException(Exception):
+    """
+    Raised for invalid page tokens and for tokens created
+    for another pattern or another version of the data.
+    """
+    pass
+
+
+# change when the token contents change:
+PAGE_TOKEN_FORMAT = 1
+
+
+def page_digest(value):
+    """
+    A short digest that identifies a pattern or a data version.
+    Values that are not JSON use their repr().
+    """
+    import hashlib
+
+    text = json.dumps(value, default = repr)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_page_token(pattern_digest, version_digest, position):
+    """
+    Return an opaque (base64) token for a scan position.
+    """
+    import base64
+
+    text = json.dumps([PAGE_TOKEN_FORMAT, pattern_digest, version_digest, position])
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token, pattern_digest, version_digest):
+    """
+    Return the scan position in a token, checking that it was created
+    for the same pattern and data version.
+    """
+    import base64
+
+    try:
+        text = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+        token_format, token_pattern, token_version, position = json.loads(text)
+
+    except (AttributeError, TypeError, ValueError):
+        raise PageTokenException('invalid page token.')
+
+    if token_format != PAGE_TOKEN_FORMAT or not isinstance(position, int) or position < 0:
+        raise PageTokenException('invalid page token.')
+
+    if token_pattern != pattern_digest:
+        raise PageTokenException('the page token was created for another pattern.')
+
+    if token_version != version_digest:
+        raise PageTokenException('the page token was created for another version of the data.')
+
+    return position
+
+
+# Higher-level pattern classes:
+
+class Pattern(object):
+    """
+    A raw (Python object) pattern.
+    An optional compiler can be given to change the compiler settings.
+
+    Patterns are compiled when created and the compiled nodes
+    are never modified when matching, so a single pattern
+    can be shared between threads.
+    """
+    def __init__(self, data, compiler = None, compiled = None):
+        self._compiler = compiler or Compiler()
+        self._data = data
+
+        if compiled is None:
+            compiled = self._compiler.compile(data)
+
+        self._pattern_compiled = compiled
+
+    def compile(self):
+        """
+        Does nothing, patterns are compiled when created.
+        Kept for compatibility with older versions.
+        """
+        pass
+
+    def compiled(self):
+        """
+        Return the compiled node tree for this pattern.
+        """
+        return self._pattern_compiled
+
+    def start_limits(self):
+        """
+        Start counting the limits for a new execution (if any).
+        Returns the execution (a LimitsExecution) or None,
+        so that other threads can join it (see match_batch()).
+        """
+        limits = getattr(self._pattern_compiled, 'limits', None)
+
+        if limits is None:
+            return None
+
+        return limits.start()
+
+    def match(self, data):
+        """
+        Execute this pattern against the given data.
+        """
+        self.start_limits()
+        return self._pattern_compiled.match(data)
+
+    def exists(self, data):
+        """
+        Test whether this pattern matches the given data,
+        stopping as soon as possible without building results.
+        """
+        self.start_limits()
+        return self._pattern_compiled.test(data)
+
+    def count(self, data):
+        """
+        Return the number of results for the given data without
+        building them: the length of the result list for list patterns,
+        1 or 0 for any other pattern.
+        """
+        compiled = self._pattern_compiled
+        self.start_limits()
+
+        if isinstance(compiled, MatchList):
+            if not isinstance(data, list) and not (compiled.adapt and is_adaptable_sequence(data)):
+                return 0
+
+            return compiled.count(data)
+
+        return 1 if compiled.test(data) else 0
+
+    def match_iterative(self, data):
+        """
+        Like match(), evaluating nodes without recursion. Slower,
+        but nested data and patterns are only limited by memory
+        (compiling a pattern is still recursive).
+        """
+        self.start_limits()
+        return evaluate(self._pattern_compiled, data)
+
+    def exists_iterative(self, data):
+        """
+        Like exists(), evaluating nodes without recursion.
+        """
+        self.start_limits()
+        return evaluate(self._pattern_compiled, data, EVALUATE_TEST)
+
+    def digest(self):
+        """
+        Return a short digest that identifies this pattern (see page()).
+        """
+        import pickle
+
+        # loaded from a plan cache, only the compiled nodes are known:
+        if self._data is None:
+            return page_digest(pickle.dumps(self._pattern_compiled).hex())
+
+        return page_digest(self._data)
+
+    def pageable(self):
+        """
+        Return True when page() can be used with this pattern:
+        a list with a single matcher and no directives.
+        """
+        compiled = self._pattern_compiled
+
+        return (isinstance(compiled, MatchList) and len(compiled.matchers) == 1
+            and len(getattr(compiled.matchers[0], 'directives', [])) == 0)
+
+    def page(self, data, size, token = None, version = None):
+        """
+        Match a list of records, returning at most 'size' results
+        and a token to get the next page: (results, token).
+        The token is None when all the records were scanned
+        (so the last page can be empty).
+
+        Pass the token to get the next page. The scan resumes where
+        the previous one stopped. 'version' identifies the data
+        (e.g. a file modification time). Tokens are only accepted for
+        the same pattern and version, otherwise PageTokenException
+        is raised.
+        """
+        if not self.pageable():
+            raise CompilerException('paging requires a list pattern with a single matcher and no directives.')
+
+        if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+            raise ValueError('the page size must be a positive integer.')
+
+        pattern_digest = self.digest()
+        version_digest = page_digest(version)
+
+        position = 0
+        if token is not None:
+            position = decode_page_token(token, pattern_digest, version_digest)
+
+        compiled = self._pattern_compiled
+        matcher = compiled.matchers[0]
+        limits = compiled.limits
+
+        # not a list?
+        if not isinstance(data, list) and not (compiled.adapt and is_adaptable_sequence(data)):
+            return [], None
+
+        self.start_limits()
+
+        results = []
+        end = len(data)
+
+        while position < end and len(results) < size:
+            if limits is not None:
+                limits.tick(1)
+
+            current = matcher.match(data[position])
+            position += 1
+
+            if current is not NoMatch:
+                results.append(current)
+
+        if position >= end:
+            return results, None
+
+        return results, encode_page_token(pattern_digest, version_digest, position)
+
+    def streamable(self):
+        """
+        Return the compiled list pattern when it can be streamed
+        (a list with a single matcher), raise CompilerException otherwise.
+        """
+        compiled = self._pattern_compiled
+
+        if not isinstance(compiled, MatchList) or len(compiled.matchers) != 1:
+            raise CompilerException('streaming requires a list pattern with a single matcher.')
+
+        self.start_limits()
+        return compiled
+
+    def stream(self, data):
+        """
+        Execute this pattern against an iterable of values,
+        yielding results lazily. The pattern must be a list
+        with a single matcher, e.g.: [{ "name": null }].
+        """
+        return self.streamable().stream(data)
+
+    def stream_exists(self, data):
+        """
+        Like exists(), for an iterable of values. See stream().
+        """
+        return self.streamable().test_values(data)
+
+    def stream_count(self, data):
+        """
+        Like count(), for an iterable of values. See stream().
+        """
+        return self.streamable().count(data)
+
+    def match_parallel(self, data, executor, chunk_size = 10000):
+        """
+        Execute this pattern against the given data, matching chunks
+        of 'chunk_size' elements of a list in an executor.
+        Returns the same results as match().
+
+        A ThreadPoolExecutor gets a real speedup on free-threaded
+        Python builds. A ProcessPoolExecutor works everywhere,
+        but has to pickle the pattern and the data.
+        """
+        compiled = self._pattern_compiled
+        execution = self.start_limits()
+
+        # only lists can be split:
+        if not isinstance(compiled, MatchList) or not isinstance(data, list):
+            return compiled.match(data)
+
+        data = compiled.counted(data)
+
+        chunks = [data[position : position + chunk_size] for position in range(0, len(data), chunk_size)]
+
+        result = []
+        for matcher in compiled.matchers:
+            matcher_results = []
+
+            batches = executor.map(match_batch, itertools.repeat(matcher), chunks, itertools.repeat(execution))
+            for batch in batches:
+                matcher_results += batch
+
+            matcher_results = list(compiled.apply_directives(matcher, matcher_results))
+
+            # at least one match?
+            if len(matcher_results) == 0:
+                return NoMatch
+
+            result += matcher_results
+
+        return result
+
+    async def match_async(self, source, batch_size = 1000, executor = None):
+        """
+        Execute this pattern against an async iterable of values
+        (e.g. records or NDJSON lines from an asyncio.StreamReader),
+        yielding results as an async generator.
+
+        Control is given back to the event loop every 'batch_size' values.
+        When 'executor' is given, batches are decoded and matched in it
+        instead of blocking the event loop.
+
+        Like stream(), the pattern must be a list with a single matcher.
+        Results are yielded after each batch. Directives are applied
+        lazily in the event loop default executor (see AsyncDirectives).
+
+        Limits apply to the whole source and cancel() stops it.
+        """
+        import asyncio
+
+        compiled = self.streamable()
+        execution = self.start_limits()
+
+        matcher = compiled.matchers[0]
+        loop = asyncio.get_running_loop()
+
+        async def run_batch(batch):
+            if executor is None:
+                results = decode_match_batch(matcher, batch, execution)
+                await asyncio.sleep(0)
+                return results
+            else:
+                return await loop.run_in_executor(executor, decode_match_batch, matcher, batch, execution)
+
+        async def batches():
+            batch = []
+
+            async for value in source:
+                batch.append(value)
+
+                if len(batch) >= batch_size:
+                    yield await run_batch(batch)
+                    batch = []
+
+            if len(batch) > 0:
+                yield await run_batch(batch)
+
+        if isinstance(matcher, MatchDict) and len(matcher.directives) > 0:
+            results = AsyncDirectives(compiled, matcher, execution, batch_size).run(batches())
+
+            async for result in results:
+                yield result
+
+        else:
+            async for results in batches():
+                for result in results:
+                    yield result
+
+
+class AsyncDirectives(object):
+    """
+    Apply the directives of a matcher to results that arrive
+    in batches from an async iterable (see Pattern.match_async()).
+
+    Directives pull results lazily, so they run in the event loop
+    default executor (a thread pool), waiting for batches. Batches
+    can't be matched in that executor, it could run out of threads.
+    At most 'queue_depth' batches wait, so e.g. __limit__ stops
+    reading the source early and __count__ doesn't keep every
+    result in memory.
+    """
+    def __init__(self, compiled, matcher, execution = None, flush_size = 1000, queue_depth = 2):
+        import queue
+        import threading
+
+        self.compiled = compiled
+        self.matcher = matcher
+        self.execution = execution
+        self.flush_size = flush_size
+        self.queue_depth = queue_depth
+
+        # result lists for the thread, None at the end:
+        self.batches = queue.Queue()
+
+        # results not sent to the event loop yet:
+        self.pending = []
+        self.stopped = threading.Event()
+
+    def send(self, item):
+        """ Pass an item to the event loop, unless it's closed. """
+        try:
+            self.loop.call_soon_threadsafe(self.output.put_nowait, item)
+        except RuntimeError:
+            pass
+
+    def flush(self):
+        """ Send the pending results to the event loop. """
+        if len(self.pending) > 0:
+            self.send(('results', self.pending))
+            self.pending = []
+
+    def feed(self):
+        """
+        Yield the results of each batch, in the executor.
+        Pending results are sent before waiting for the next batch.
+        """
+        while True:
+            if self.batches.empty():
+                self.flush()
+
+            results = self.batches.get()
+
+            if results is None:
+                return
+
+            self.loop.call_soon_threadsafe(self.slots.release)
+            yield from results
+
+    def apply(self):
+        """
+        Apply the directives to every batch, in the executor.
+        Ends with ('end', None) or ('error', exception).
+        """
+        try:
+            limits = getattr(self.matcher, 'limits', None)
+
+            if limits is not None and self.execution is not None:
+                limits.start(execution = self.execution)
+
+            for result in self.compiled.apply_directives(self.matcher, self.feed()):
+                if self.stopped.is_set():
+                    return
+
+                self.pending.append(result)
+
+                if len(self.pending) >= self.flush_size:
+                    self.flush()
+
+            self.flush()
+            self.send(('end', None))
+
+        except Exception as err:
+            self.send(('error', err))
+
+    async def read(self, batches):
+        """
+        Pass every batch from an async iterable to the executor.
+        """
+        try:
+            async for results in batches:
+                await self.slots.acquire()
+
+                if self.stopped.is_set():
+                    break
+
+                self.batches.put(results)
+
+            self.batches.put(None)
+
+        except Exception as err:
+            self.output.put_nowait(('error', err))
+
+        finally:
+            if hasattr(batches, 'aclose'):
+                await batches.aclose()
+
+    async def run(self, batches):
+        """
+        Yield the results of applying the directives to an async
+        iterable of result lists, as an async generator.
+        """
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.output = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.queue_depth)
+
+        self.loop.run_in_executor(None, self.apply)
+        reader = asyncio.ensure_future(self.read(batches))
+
+        try:
+            while True:
+                kind, value = await self.output.get()
+
+                if kind == 'error':
+                    raise value
+
+                if kind == 'end':
+                    break
+
+                for result in value:
+                    yield result
+
+        # stop reading, apply() ends with the next result or batch:
+        finally:
+            self.stopped.set()
+            self.batches.put(None)
+            reader.cancel()
+
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
+
+
+class JSONPattern(Pattern):
+    """
+    A JSON pattern.
+    """
+    def __init__(self, jsondata, compiler = None):
+        decoder = JSONDecoder(object_pairs_hook = OrderedDict)
+        Pattern.__init__(self, decoder.decode(jsondata), compiler)
+
+    def decode(self):
+        """
+        Does nothing, JSON patterns are decoded when created.
+        Kept for compatibility with older versions.
+        """
+        pass
+
+
+# Pattern sets:
+# Match every record against many patterns, evaluating only the patterns
+# that could match it. Each dict pattern is indexed by one necessary
+# condition (an anchor): an equality or "in" lookup on a key, a numeric
+# range on a key or just a key that must be present.
+
+class IntervalTree(object):
+    """
+    A static centered interval tree that finds the intervals
+    containing a number in O(log n + results).
+
+    Intervals are tuples: (lower, lower_inclusive, upper, upper_inclusive, item)
+    using -inf and inf for unbounded sides.
+    """
+    def __init__(self, intervals):
+        self.root = self.build(list(intervals))
+
+    def build(self, intervals):
+        """
+        Build a node: (center, intervals containing the center sorted
+        by lower and by upper bound, left node, right node).
+        """
+        import math
+
+        if len(intervals) == 0:
+            return None
+
+        endpoints = sorted(point for interval in intervals
+            for point in (interval[0], interval[2]) if not math.isinf(point))
+
+        # the median endpoint belongs to at least one interval, so every node keeps some:
+        center = endpoints[len(endpoints) // 2] if len(endpoints) > 0 else 0
+
+        here = [interval for interval in intervals if interval[0] <= center <= interval[2]]
+        left = [interval for interval in intervals if interval[2] < center]
+        right = [interval for interval in intervals if interval[0] > center]
+
+        by_lower = sorted(here, key = lambda interval: interval[0])
+        by_upper = sorted(here, key = lambda interval: interval[2], reverse = True)
+
+        return center, by_lower, by_upper, self.build(left), self.build(right)
+
+    def find(self, value):
+        """
+        Return the items of the intervals that contain 'value'.
+        """
+        found = []
+        node = self.root
+
+        while node is not None:
+            center, by_lower, by_upper, left, right = node
+
+            # every interval here ends after the value, check where they start:
+            if value < center:
+                for lower, lower_inclusive, upper, upper_inclusive, item in by_lower:
+                    if lower > value:
+                        break
+
+                    if lower < value or lower_inclusive:
+                        found.append(item)
+
+                node = left
+
+            # every interval here starts before the value, check where they end:
+            elif value > center:
+                for lower, lower_inclusive, upper, upper_inclusive, item in by_upper:
+                    if upper < value:
+                        break
+
+                    if upper > value or upper_inclusive:
+                        found.append(item)
+
+                node = right
+
+            # the center itself (or NaN), intervals on the sides can't contain it:
+            else:
+                for lower, lower_inclusive, upper, upper_inclusive, item in by_lower:
+                    if ((lower < value or (lower == value and lower_inclusive)) and
+                        (upper > value or (upper == value and upper_inclusive))):
+                        found.append(item)
+
+                break
+
+        return found
+
+
+class PatternSet(object):
+    """
+    A set of patterns, each one with an id, that match records.
+    match() returns the ids of the patterns that match a record
+    (or their results), evaluating only the candidates that
+    could match it (see candidates()).
+
+    Patterns with comparisons are only evaluated for numbers,
+    so errors (e.g. comparing a string with a number) may not be raised.
+    Patterns can't be added or removed while matching in other threads.
+    """
+    def __init__(self, compiler = None):
+        self.compiler = compiler or Compiler()
+
+        # id -> (pattern, anchor, position):
+        self.patterns = {}
+        self.added = 0
+
+        # indexes:
+        self.equal = {}
+        self.ranges = {}
+        self.keys = {}
+        self.always = set()
+
+        # interval trees for self.ranges, built when needed:
+        self.trees = {}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, pattern_id):
+        return pattern_id in self.patterns
+
+    def add(self, pattern_id, pattern):
+        """
+        Add a pattern (a Pattern or raw pattern data), replacing
+        any pattern with the same id.
+        """
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern, self.compiler)
+
+        if pattern_id in self.patterns:
+            self.remove(pattern_id)
+
+        anchor = self.anchor(pattern.compiled())
+        self.patterns[pattern_id] = (pattern, anchor, self.added)
+        self.added += 1
+
+        kind, key, value = anchor
+
+        if kind == 'equal':
+            for it in value:
+                self.equal.setdefault(key, {}).setdefault(it, set()).add(pattern_id)
+
+        elif kind == 'range':
+            self.ranges.setdefault(key, {})[pattern_id] = value
+            self.trees.pop(key, None)
+
+        elif kind == 'key':
+            self.keys.setdefault(key, set()).add(pattern_id)
+
+        elif kind == 'always':
+            self.always.add(pattern_id)
+
+    def remove(self, pattern_id):
+        """
+        Remove the pattern with a given id. Raises KeyError when missing.
+        """
+        pattern, (kind, key, value), position = self.patterns.pop(pattern_id)
+
+        if kind == 'equal':
+            for it in value:
+                self.equal[key][it].discard(pattern_id)
+
+        elif kind == 'range':
+            del self.ranges[key][pattern_id]
+            self.trees.pop(key, None)
+
+        elif kind == 'key':
+            self.keys[key].discard(pattern_id)
+
+        elif kind == 'always':
+            self.always.discard(pattern_id)
+
+    def anchor(self, compiled):
+        """
+        Return a condition that records must meet to match a compiled pattern:
+        (kind, key, value), where kind is "equal" (value is a set),
+        "range" (value is an interval), "key", "always" or "never".
+        """
+        import math
+
+        if not isinstance(compiled, MatchDict):
+            return 'always', None, None
+
+        if compiled.unsatisfiable:
+            return 'never', None, None
+
+        equal = []
+        ranges = []
+
+        def number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+
+        def collect(key, constraint):
+            cls = type(constraint)
+
+            if cls is ConstraintEqualTo:
+                constraint = MatchEqual(constraint.value)
+                cls = MatchEqual
+
+            if cls is MatchEqual:
+                try:
+                    equal.append((key, set([constraint.value])))
+                except TypeError:
+                    pass
+
+            elif cls is ConstraintIn and constraint.hashable is not None and len(constraint.unhashable) == 0:
+                equal.append((key, constraint.hashable))
+
+            elif cls is ConstraintRange:
+                lower = -math.inf if constraint.lower is None else constraint.lower
+                upper = math.inf if constraint.upper is None else constraint.upper
+
+                # every bound given must be a number (e.g. not a string range):
+                bounds = [bound for bound in (constraint.lower, constraint.upper) if bound is not None]
+
+                if len(bounds) > 0 and all(number(bound) for bound in bounds):
+                    ranges.append((key, (lower, constraint.lower_inclusive, upper, constraint.upper_inclusive)))
+
+            elif cls in (ConstraintMoreThan, ConstraintMoreOrEqualTo) and number(constraint.value):
+                ranges.append((key, (constraint.value, cls is ConstraintMoreOrEqualTo, math.inf, False)))
+
+            elif cls in (ConstraintLessThan, ConstraintLessOrEqualTo) and number(constraint.value):
+                ranges.append((key, (-math.inf, False, constraint.value, cls is ConstraintLessOrEqualTo)))
+
+            # all of them must match, any of them is necessary:
+            elif cls is ConstraintSuffixAll:
+                for it in constraint.constraints:
+                    collect(key, it)
+
+        for key, constraint in compiled.constraints:
+            collect(key, constraint)
+
+        for key, matcher in compiled.matchers:
+            collect(key, matcher)
+
+        # the most selective condition:
+        if len(equal) > 0:
+            key, values = min(equal, key = lambda it: len(it[1]))
+            return 'equal', key, values
+
+        if len(ranges) > 0:
+            key, interval = ranges[0]
+            return 'range', key, interval
+
+        required = [key for key, constraint in compiled.constraints] + [key for key, matcher in compiled.matchers]
+
+        # spread patterns between keys:
+        if len(required) > 0:
+            key = min(required, key = lambda key: len(self.keys.get(key, ())))
+            return 'key', key, None
+
+        return 'always', None, None
+
+    def tree(self, key):
+        """
+        Return the interval tree for the ranges on a key.
+        """
+        tree = self.trees.get(key)
+
+        if tree is None:
+            intervals = [interval + (pattern_id,) for pattern_id, interval in self.ranges[key].items()]
+            tree = self.trees[key] = IntervalTree(intervals)
+
+        return tree
+
+    def candidates(self, record):
+        """
+        Return the ids of the patterns that could match 'record'.
+        """
+        found = set(self.always)
+
+        if not isinstance(record, Mapping):
+            record = adapt_mapping(record) if self.compiler.adapt else None
+
+            if record is None:
+                return found
+
+        for key, index in self.equal.items():
+            if key in record:
+                try:
+                    found.update(index.get(record[key], ()))
+
+                # unhashable, can't be equal to any value:
+                except TypeError:
+                    pass
+
+        for key, ranges in self.ranges.items():
+            if key in record and len(ranges) > 0:
+                value = record[key]
+
+                if isinstance(value, (int, float)):
+                    found.update(self.tree(key).find(value))
+
+                # other types (e.g. Decimal) may compare with numbers:
+                elif not isinstance(value, (str, list, dict, type(None))):
+                    found.update(ranges)
+
+        for key, ids in self.keys.items():
+            if key in record:
+                found.update(ids)
+
+        return found
+
+    def match(self, record, results = False):
+        """
+        Return the ids of the patterns that match 'record',
+        in the order they were added. When 'results' is True,
+        return a dict of { id: result } instead.
+        """
+        matched = {} if results else []
+
+        patterns = self.patterns
+        candidates = sorted(self.candidates(record), key = lambda pattern_id: patterns[pattern_id][2])
+
+        for pattern_id in candidates:
+            pattern = patterns[pattern_id][0]
+
+            if results:
+                result = pattern.match(record)
+
+                if result is not NoMatch:
+                    matched[pattern_id] = result
+
+            elif pattern.exists(record):
+                matched.append(pattern_id)
+
+        return matched
+
+
+# Compiled plans cache:
+
+class PlanCache(object):
+    """
+    Store compiled patterns in a directory, so that running
+    the same pattern again doesn't need to decode and compile it.
+
+    Plans are keyed by the pattern text, the compiler settings,
+    the MQLite version and the plan format. Plans are stored using
+    pickle, so they are only loaded when the directory and the plan
+    belong to the current user and nobody else can write to them.
+
+    The compiler limits and datasets are not stored in plans,
+    loaded plans use the ones in the compiler.
+    """
+    # change when compiled nodes change, so that old plans are not loaded:
+    format = 3
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, jsondata, compiler):
+        """
+        Get the path for the plan of a given pattern.
+        """
+        import hashlib
+
+        key = repr((__version__, self.format, __name__, type(compiler).__name__, compiler.settings(), jsondata))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.directory, digest + '.plan')
+
+    def pattern(self, jsondata, compiler):
+        """
+        Return a pattern for 'jsondata', loading its compiled plan
+        from the cache or compiling it and storing it.
+        """
+        import pickle
+
+        path = self.path(jsondata, compiler)
+
+        # objects shared with the compiler are stored by name:
+        shared = { 'limits': compiler.limits, 'datasets': compiler.datasets }
+
+        def persistent_id(value):
+            for name, shared_value in shared.items():
+                if value is shared_value and shared_value is not None:
+                    return name
+
+            return None
+
+        try:
+            if self.private(os.stat(self.directory)):
+                with open(path, 'rb') as descriptor:
+                    if self.private(os.fstat(descriptor.fileno())):
+                        unpickler = pickle.Unpickler(descriptor)
+                        unpickler.persistent_load = shared.__getitem__
+
+                        return Pattern(None, compiler, unpickler.load())
+
+        # missing, old or damaged plans are compiled again:
+        except (OSError, EOFError, ImportError, AttributeError, LookupError, TypeError, ValueError, pickle.UnpicklingError):
+            pass
+
+        pattern = JSONPattern(jsondata, compiler)
+        compiled = pattern.compiled()
+
+        # the cache is optional, don't fail when it can't be written:
+        try:
+            os.makedirs(self.directory, 0o700, exist_ok = True)
+
+            if not self.private(os.stat(self.directory)):
+                return pattern
+
+            temporary = '{}.{}.tmp'.format(path, os.getpid())
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+            try:
+                with os.fdopen(os.open(temporary, flags, 0o600), 'wb') as descriptor:
+                    pickler = pickle.Pickler(descriptor, pickle.HIGHEST_PROTOCOL)
+                    pickler.persistent_id = persistent_id
+                    pickler.dump(compiled)
+
+                os.replace(temporary, path)
+
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+
+        except (OSError, TypeError, AttributeError, pickle.PicklingError):
+            pass
+
+        return pattern
+
+    def private(self, status):
+        """
+        True when a file or directory (an os.stat() result) belongs to
+        the current user and only they can write to it. Ownership is
+        only checked on systems with user ids.
+        """
+        import stat
+
+        if hasattr(os, 'getuid') and status.st_uid != os.getuid():
+            return False
+
+        return status.st_mode & (stat.S_IWGRP | stat.S_IWOTH) == 0
+
+
+# SQLite storage:
+# Records are stored as JSON text in a SQLite database and queried
+# in place. The parts of a pattern that SQLite understands are translated
+# to a WHERE clause that returns a superset of the matching records,
+# then the full pattern runs on them. Skipped records are never compared,
+# so errors (e.g. comparing a string with a number) may not be raised.
+
+SQL_COMPARISONS = {
+    ConstraintMoreThan      : '>',
+    ConstraintMoreOrEqualTo : '>=',
+    ConstraintLessThan      : '<',
+    ConstraintLessOrEqualTo : '<=',
+}
+
+# JSON types (as returned by json_type) for ConstraintIs:
+SQL_JSON_TYPES = {
+    bool  : ('true', 'false'),
+    int   : ('integer', 'true', 'false'),
+    float : ('real',),
+    str   : ('text',),
+    list  : ('array',),
+    dict  : ('object',),
+}
+
+SQL_NUMBERS = "('integer', 'real', 'true', 'false')"
+
+
+def sql_literal(text):
+    """ Quote 'text' as a SQL string literal. """
+    return "'" + text.replace("'", "''") + "'"
+
+
+def sql_path(keys):
+    """
+    Return a JSON path for nested keys as a SQL literal or None when
+    a key can't be used in a path. Paths are literals (not parameters)
+    so that queries can use expression indexes.
+    """
+    path = '$'
+
+    for key in keys:
+        if not isinstance(key, str) or '"' in key or '\\' in key:
+            return None
+
+        path += '."{}"'.format(key)
+
+    return sql_literal(path)
+
+
+def sql_scalar(value):
+    """
+    Return 'value' as a SQL parameter or None when SQLite
+    can't compare it exactly like Python (lists, dicts, huge numbers).
+    """
+    if isinstance(value, bool):
+        return int(value)
+
+    if isinstance(value, int) and abs(value) <= 2 ** 53:
+        return value
+
+    if isinstance(value, float) and abs(value) <= 2 ** 53:
+        return value
+
+    if isinstance(value, str):
+        return value
+
+    return None
+
+
+class SQLCondition(object):
+    """
+    A translated condition: SQL text with its parameters.
+    'exact' means that the condition is true for the same values
+    as in Python, so it can be negated.
+    """
+    def __init__(self, sql, parameters = (), exact = False):
+        self.sql = sql
+        self.parameters = list(parameters)
+        self.exact = exact
+
+    @staticmethod
+    def join(conditions, operator):
+        """ Combine conditions with AND or OR. """
+        sql = '(' + ' {} '.format(operator).join(condition.sql for condition in conditions) + ')'
+        parameters = [parameter for condition in conditions for parameter in condition.parameters]
+        exact = all(condition.exact for condition in conditions)
+
+        return SQLCondition(sql, parameters, exact)
+
+
+class SQLTranslator(object):
+    """
+    Translate matchers and constraints to SQL conditions
+    for the JSON values at a given path.
+    """
+    def __init__(self, path):
+        self.type = 'json_type(data, {})'.format(path)
+        self.value = 'json_extract(data, {})'.format(path)
+
+    def exists(self):
+        return SQLCondition('{} IS NOT NULL'.format(self.type), exact = True)
+
+    def equal(self, value):
+        """ Values == 'value' or None. """
+        if value is None:
+            return SQLCondition("{} = 'null'".format(self.type), exact = True)
+
+        return self.equal_any([value])
+
+    def equal_any(self, values):
+        """ Values equal to any of 'values' or None. """
+        numbers = []
+        strings = []
+        conditions = []
+
+        for value in values:
+            if value is None:
+                conditions.append(SQLCondition("{} = 'null'".format(self.type), exact = True))
+                continue
+
+            parameter = sql_scalar(value)
+
+            if parameter is None:
+                return None
+
+            if isinstance(value, str):
+                strings.append(parameter)
+            else:
+                numbers.append(parameter)
+
+        for types, parameters in ((SQL_NUMBERS, numbers), ("('text')", strings)):
+            if len(parameters) > 0:
+                placeholders = ', '.join('?' * len(parameters))
+                sql = '({} IN {} AND {} IN ({}))'.format(self.type, types, self.value, placeholders)
+                conditions.append(SQLCondition(sql, parameters, exact = True))
+
+        if len(conditions) == 0:
+            return SQLCondition('0', exact = True)
+
+        return SQLCondition.join(conditions, 'OR')
+
+    def negate(self, condition):
+        """ Existing values that don't match an exact condition. """
+        if condition is None or not condition.exact:
+            return None
+
+        sql = '({} IS NOT NULL AND NOT COALESCE({}, 0))'.format(self.type, condition.sql)
+        return SQLCondition(sql, condition.parameters, exact = True)
+
+    def compare(self, operator, value):
+        """
+        Values that compare True with 'value' or None.
+        (not exact, other types raise errors in Python)
+        """
+        parameter = sql_scalar(value)
+
+        if parameter is None:
+            return None
+
+        types = "('text')" if isinstance(value, str) else SQL_NUMBERS
+        sql = '({} IN {} AND {} {} ?)'.format(self.type, types, self.value, operator)
+
+        return SQLCondition(sql, [parameter])
+
+    def constraint(self, constraint):
+        """
+        Translate a constraint or return None when it can't be done.
+        """
+        cls = type(constraint)
+
+        if cls in SQL_COMPARISONS:
+            return self.compare(SQL_COMPARISONS[cls], constraint.value)
+
+        if cls is ConstraintRange:
+            conditions = []
+
+            if constraint.lower is not None:
+                conditions.append(self.compare('>=' if constraint.lower_inclusive else '>', constraint.lower))
+
+            if constraint.upper is not None:
+                conditions.append(self.compare('<=' if constraint.upper_inclusive else '<', constraint.upper))
+
+            if None in conditions:
+                return None
+
+            return SQLCondition.join(conditions, 'AND')
+
+        if cls is ConstraintNever:
+            return SQLCondition('0', exact = True)
+
+        if cls is ConstraintEqualTo:
+            return self.equal(constraint.value)
+
+        if cls is ConstraintNotEqualTo:
+            return self.negate(self.equal(constraint.value))
+
+        if cls is ConstraintIn and isinstance(constraint.values, list):
+            return self.equal_any(constraint.values)
+
+        if cls is ConstraintIs:
+            if constraint.theclass is object:
+                return self.exists()
+
+            if constraint.theclass in SQL_JSON_TYPES:
+                types = ', '.join(map(sql_literal, SQL_JSON_TYPES[constraint.theclass]))
+                return SQLCondition('{} IN ({})'.format(self.type, types), exact = True)
+
+            return None
+
+        if cls is ConstraintPrefixNot:
+            return self.negate(self.constraint(constraint.constraint))
+
+        if cls is ConstraintSuffixAll:
+            conditions = [self.constraint(it) for it in constraint.constraints]
+            translated = [it for it in conditions if it is not None]
+
+            if len(translated) == 0:
+                return None
+
+            # the untranslated ones are just left out:
+            condition = SQLCondition.join(translated, 'AND')
+            condition.exact = condition.exact and len(translated) == len(conditions)
+            return condition
+
+        if cls in (ConstraintSuffixAny, ConstraintSuffixOne):
+            conditions = [self.constraint(it) for it in constraint.constraints]
+
+            if len(conditions) == 0 or None in conditions:
+                return None
+
+            condition = SQLCondition.join(conditions, 'OR')
+            condition.exact = condition.exact and cls is ConstraintSuffixAny
+            return condition
+
+        return None
+
+
+def sql_matcher(matcher, keys = ()):
+    """
+    Translate a matcher for the value at 'keys' to a list of SQL conditions
+    that must all be true for a record to match.
+    """
+    path = sql_path(keys)
+
+    if path is None:
+        return []
+
+    translator = SQLTranslator(path)
+
+    if isinstance(matcher, MatchEqual):
+        condition = translator.equal(matcher.value)
+        return [condition] if condition is not None else []
+
+    if isinstance(matcher, (MatchEmptyDict, MatchEmptyList)):
+        json_type = 'object' if isinstance(matcher, MatchEmptyDict) else 'array'
+        return [SQLCondition("{} = '{}'".format(translator.type, json_type))]
+
+    if isinstance(matcher, MatchList):
+        return [SQLCondition("{} = 'array'".format(translator.type))]
+
+    if not isinstance(matcher, MatchDict):
+        return [translator.exists()] if len(keys) > 0 else []
+
+    conditions = [SQLCondition("{} = 'object'".format(translator.type))]
+
+    for key, constraint in matcher.constraints:
+        key_path = sql_path(keys + (key,))
+
+        if key_path is None:
+            continue
+
+        key_translator = SQLTranslator(key_path)
+        condition = key_translator.constraint(constraint)
+        conditions.append(condition if condition is not None else key_translator.exists())
+
+    for key, submatcher in matcher.matchers:
+        conditions += sql_matcher(submatcher, keys + (key,))
+
+    return conditions
+
+
+class SQLiteStore(object):
+    """
+    Store JSON records in a SQLite database and match patterns against
+    them without loading everything in memory.
+
+    Patterns are matched like against a list with all the records.
+    Records are returned in the order they were inserted.
+    Requires a SQLite with JSON functions (3.38+ or the JSON1 extension).
+    """
+    def __init__(self, filepath, object_pairs_hook = None):
+        import sqlite3
+
+        self.filepath = filepath
+        self.object_pairs_hook = object_pairs_hook
+
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def insert(self, records):
+        """
+        Add an iterable of JSON values. Returns the number added.
+        """
+        rows = ((json.dumps(record, default = json_default),) for record in records)
+
+        with self.connection:
+            cursor = self.connection.executemany('INSERT INTO records (data) VALUES (?)', rows)
+
+        return cursor.rowcount
+
+    def import_file(self, filepath = None, ndjson = False):
+        """
+        Add the records in a JSON list (or a single value) or a NDJSON file
+        (stdin when None). Compressed files are supported.
+        Returns the number added.
+        """
+        with open_binary_input(filepath) as stream:
+            if ndjson:
+                return self.insert(binary_read_ndjson(stream))
+
+            jsondata = json.loads(binary_read_utf8(stream))
+
+        return self.insert(jsondata if isinstance(jsondata, list) else [jsondata])
+
+    def index(self, key):
+        """
+        Create indexes for the value (and the JSON type) of a key.
+        Nested keys can be given as a tuple.
+        """
+        keys = key if isinstance(key, tuple) else (key,)
+        path = sql_path(keys)
+
+        if path is None:
+            raise ValueError('can\'t index key: {}'.format(key))
+
+        import hashlib
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+
+        with self.connection:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS mqlite_value_{} ON records (json_extract(data, {}))'.format(name, path))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS mqlite_type_{} ON records (json_type(data, {}))'.format(name, path))
+
+    def where(self, matcher):
+        """
+        Return a WHERE clause and its parameters selecting
+        the records that can match 'matcher'.
+        """
+        conditions = sql_matcher(matcher)
+
+        if len(conditions) == 0:
+            return '1', []
+
+        condition = SQLCondition.join(conditions, 'AND')
+        return condition.sql, condition.parameters
+
+    def records(self, where = '1', parameters = ()):
+        """
+        Yield the records for a WHERE clause, lazily.
+        """
+        query = 'SELECT data FROM records WHERE {} ORDER BY id'.format(where)
+
+        for data, in self.connection.execute(query, list(parameters)):
+            yield json.loads(data, object_pairs_hook = self.object_pairs_hook)
+
+    def select(self, matcher):
+        """
+        Yield the records that can match 'matcher', lazily.
+        """
+        return self.records(*self.where(matcher))
+
+    def match(self, pattern):
+        """
+        Execute a pattern against all the records.
+        Each matcher in a list pattern only reads the records it can match.
+        """
+        compiled = pattern.compiled()
+        pattern.start_limits()
+
+        if not isinstance(compiled, MatchList):
+            return compiled.match(list(self.records()))
+
+        result = []
+        for matcher in compiled.matchers:
+            matcher_results = list(compiled.match_matcher(matcher, compiled.counted(self.select(matcher), 1)))
+
+            # at least one match?
+            if len(matcher_results) == 0:
+                return NoMatch
+
+            result += matcher_results
+
+        return result
+
+
+# NDJSON indexes:
+# A sidecar file (FILE.mqindex) with the offset of every record in a
+# newline-delimited JSON file and, for some keys, the minimum and maximum
+# values in every block of records. Records are read by slicing a memory
+# mapping of the file, so only the ones needed are decoded, and blocks
+# whose statistics rule out a pattern are skipped without being read.
+# Like with SQLite, skipped records are never compared.
+
+# operators for the constraints that block statistics can rule out:
+INDEX_OPERATORS = {
+    ConstraintMoreThan      : '>',
+    ConstraintMoreOrEqualTo : '>=',
+    ConstraintLessThan      : '<',
+    ConstraintLessOrEqualTo : '<=',
+    ConstraintEqualTo       : '==',
+    MatchEqual              : '==',
+}
+
+
+def block_may_contain(entry, operator, value):
+    """
+    Test whether a block can have a value that compares True with 'value'.
+    'entry' is [numbers min, numbers max, strings min, strings max]
+    for the values of a key in the block (None when there are none).
+    """
+    if isinstance(value, str):
+        low, high = entry[2], entry[3]
+    elif isinstance(value, (int, float)):
+        low, high = entry[0], entry[1]
+
+    # other types are not in the statistics:
+    else:
+        return True
+
+    if low is None:
+        return False
+
+    if operator == '>':
+        return high > value
+    if operator == '>=':
+        return high >= value
+    if operator == '<':
+        return low < value
+    if operator == '<=':
+        return low <= value
+
+    return low <= value <= high
+
+
+def block_may_match(constraint, entry):
+    """
+    Test whether a block can have a value matching a constraint
+    (or a MatchEqual) given its statistics entry for the key.
+    """
+    cls = type(constraint)
+
+    if cls in INDEX_OPERATORS:
+        return block_may_contain(entry, INDEX_OPERATORS[cls], constraint.value)
+
+    if cls is ConstraintNever:
+        return False
+
+    if cls is ConstraintIn and constraint.hashable is not None:
+        if len(constraint.unhashable) > 0:
+            return True
+
+        return any(block_may_contain(entry, '==', value) for value in constraint.hashable)
+
+    if cls is ConstraintRange:
+        if constraint.lower is not None:
+            if not block_may_contain(entry, '>=' if constraint.lower_inclusive else '>', constraint.lower):
+                return False
+
+        if constraint.upper is not None:
+            if not block_may_contain(entry, '<=' if constraint.upper_inclusive else '<', constraint.upper):
+                return False
+
+        return True
+
+    if cls is ConstraintSuffixAll:
+        return all(block_may_match(it, entry) for it in constraint.constraints)
+
+    if cls in (ConstraintSuffixAny, ConstraintSuffixOne):
+        return any(block_may_match(it, entry) for it in constraint.constraints)
+
+    return True
+
+
+def match_file_range(matcher, filepath, start, end, object_pairs_hook = None, execution = None):
+    """
+    Match the NDJSON records between two byte offsets of a file,
+    return a list of results.
+    (a module-level function, so that process pools can pickle it)
+    """
+    with open(filepath, 'rb') as descriptor:
+        descriptor.seek(start)
+        lines = descriptor.read(end - start).split(b'\n')
+
+    records = [json.loads(line, object_pairs_hook = object_pairs_hook) for line in lines if line.strip()]
+    return match_batch(matcher, records, execution)
+
+
+class NDJSONIndex(object):
+    """
+    Index a newline-delimited JSON file to read its records on demand.
+
+    The index is stored next to the file (FILE.mqindex) and rebuilt
+    when the file changes. 'keys' are top-level keys to keep statistics
+    for, so that patterns comparing them skip blocks of 'block_size'
+    records that can't match. Compressed files can't be indexed.
+
+    Patterns are matched like against a list with all the records.
+    """
+    # change when the index file contents change:
+    format = 1
+
+    def __init__(self, filepath, keys = (), block_size = 1024, object_pairs_hook = None):
+        import mmap
+
+        if not isinstance(block_size, int) or isinstance(block_size, bool) or block_size < 1:
+            raise ValueError('the block size must be a positive integer.')
+
+        self.filepath = filepath
+        self.path = filepath + '.mqindex'
+        self.block_size = block_size
+        self.object_pairs_hook = object_pairs_hook
+
+        with open(filepath, 'rb') as descriptor:
+            if detect_compression(descriptor.read(8)) is not None:
+                raise ValueError('compressed files can\'t be indexed: {}'.format(filepath))
+
+            status = os.fstat(descriptor.fileno())
+            self.size = status.st_size
+            self.mtime = status.st_mtime_ns
+
+            # (empty files can't be mapped)
+            self.data = b''
+            if self.size > 0:
+                self.data = mmap.mmap(descriptor.fileno(), 0, access = mmap.ACCESS_READ)
+
+        self.offsets = None
+        self.stats = {}
+
+        if not self.load() or not set(keys) <= set(self.stats):
+            self.build(set(keys) | set(self.stats))
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            self.data.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        """
+        Decode the record at a given position.
+        """
+        if position < 0:
+            position += len(self)
+
+        if not 0 <= position < len(self):
+            raise IndexError('record index out of range')
+
+        line = self.data[self.offsets[position] : self.offsets[position + 1]]
+        return json.loads(line, object_pairs_hook = self.object_pairs_hook)
+
+    def blocks(self):
+        """
+        Return the number of blocks.
+        """
+        return (len(self) + self.block_size - 1) // self.block_size
+
+    def version(self):
+        """
+        Identify the indexed contents of the file (for page tokens).
+        """
+        return [self.size, self.mtime]
+
+    def load(self):
+        """
+        Load the index file. Returns False when it's missing,
+        unreadable or out of date.
+        """
+        from array import array
+
+        try:
+            with open(self.path, 'rb') as descriptor:
+                header = json.loads(descriptor.readline())
+
+                offsets = array('Q')
+                offsets.frombytes(descriptor.read())
+
+        except Exception:
+            return False
+
+        expected = {
+            'format'     : self.format,
+            'byteorder'  : sys.byteorder,
+            'size'       : self.size,
+            'mtime'      : self.mtime,
+            'block_size' : self.block_size,
+            'count'      : len(offsets) - 1,
+        }
+
+        if not isinstance(header, dict) or any(header.get(key) != value for key, value in expected.items()):
+            return False
+
+        self.offsets = offsets
+        self.stats = header.get('stats', {})
+
+        # one entry per block:
+        if not isinstance(self.stats, dict) or any(len(entries) != self.blocks() for entries in self.stats.values()):
+            self.stats = {}
+            return False
+
+        return True
+
+    def build(self, keys):
+        """
+        Scan the file to find the record offsets and compute
+        the statistics for 'keys'. Then store the index file.
+        """
+        from array import array
+
+        offsets = array('Q')
+        stats = { key: [] for key in keys }
+        entries = dict.fromkeys(stats)
+        position = 0
+
+        def add(entry, value):
+            if entry is None:
+                entry = [None, None, None, None]
+
+            if isinstance(value, str):
+                first = 2
+            elif isinstance(value, (int, float)) and value == value:
+                first = 0
+
+            # other types only record that the key is present:
+            else:
+                return entry
+
+            if entry[first] is None or value < entry[first]:
+                entry[first] = value
+
+            if entry[first + 1] is None or value > entry[first + 1]:
+                entry[first + 1] = value
+
+            return entry
+
+        with open(self.filepath, 'rb') as descriptor:
+            for line in descriptor:
+                if line.strip():
+                    offsets.append(position)
+
+                    if len(stats) > 0:
+                        record = json.loads(line)
+
+                        if isinstance(record, dict):
+                            for key in stats:
+                                if key in record:
+                                    entries[key] = add(entries[key], record[key])
+
+                        # end of a block:
+                        if len(offsets) % self.block_size == 0:
+                            for key in stats:
+                                stats[key].append(entries[key])
+                                entries[key] = None
+
+                position += len(line)
+
+        offsets.append(position)
+
+        # the last block:
+        if (len(offsets) - 1) % self.block_size != 0:
+            for key in stats:
+                stats[key].append(entries[key])
+
+        self.offsets = offsets
+        self.stats = stats
+        self.store()
+
+    def store(self):
+        """
+        Write the index file. The index is optional,
+        don't fail when it can't be written.
+        """
+        header = {
+            'format'     : self.format,
+            'byteorder'  : sys.byteorder,
+            'size'       : self.size,
+            'mtime'      : self.mtime,
+            'block_size' : self.block_size,
+            'count'      : len(self),
+            'stats'      : self.stats,
+        }
+
+        try:
+            temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+
+            with open(temporary, 'wb') as descriptor:
+                descriptor.write(json.dumps(header).encode('utf-8') + b'\n')
+                descriptor.write(self.offsets.tobytes())
+
+            os.replace(temporary, self.path)
+
+        except Exception:
+            pass
+
+    def index(self, key):
+        """
+        Keep statistics for a top-level key (scans the file again).
+        """
+        if not key in self.stats:
+            self.build(set(self.stats) | set([key]))
+
+    def candidate_blocks(self, matcher):
+        """
+        Return the blocks that can have records matching 'matcher'.
+        """
+        if getattr(matcher, 'unsatisfiable', False):
+            return []
+
+        if not isinstance(matcher, MatchDict):
+            return range(self.blocks())
+
+        # every constrained key is required:
+        checks = [(self.stats[key], constraint)
+            for key, constraint in matcher.constraints + matcher.matchers
+                if key in self.stats]
+
+        return [block for block in range(self.blocks())
+            if all(entries[block] is not None and block_may_match(constraint, entries[block])
+                for entries, constraint in checks)]
+
+    def read_block(self, block):
+        """
+        Decode the records in a block.
+        """
+        start = self.offsets[block * self.block_size]
+        end = self.offsets[min((block + 1) * self.block_size, len(self))]
+
+        lines = self.data[start:end].split(b'\n')
+        return [json.loads(line, object_pairs_hook = self.object_pairs_hook) for line in lines if line.strip()]
+
+    def records(self):
+        """
+        Yield all the records, lazily.
+        """
+        for block in range(self.blocks()):
+            yield from self.read_block(block)
+
+    def select(self, matcher):
+        """
+        Yield the records that can match 'matcher', lazily.
+        """
+        for block in self.candidate_blocks(matcher):
+            yield from self.read_block(block)
+
+    def match(self, pattern):
+        """
+        Execute a pattern against all the records.
+        Each matcher in a list pattern only reads the blocks it can match.
+        """
+        compiled = pattern.compiled()
+        pattern.start_limits()
+
+        if not isinstance(compiled, MatchList):
+            return compiled.match(list(self.records()))
+
+        result = []
+        for matcher in compiled.matchers:
+            matcher_results = list(compiled.match_matcher(matcher, compiled.counted(self.select(matcher), 1)))
+
+            # at least one match?
+            if len(matcher_results) == 0:
+                return NoMatch
+
+            result += matcher_results
+
+        return result
+
+    def sample(self, size, seed = None):
+        """
+        Return 'size' random records (or all of them when there are less),
+        in file order. Only the chosen records are decoded.
+        """
+        import random
+
+        chosen = random.Random(seed).sample(range(len(self)), min(size, len(self)))
+        return [self[position] for position in sorted(chosen)]
+
+    def page(self, pattern, size, token = None):
+        """
+        Like Pattern.page(), reading only the blocks that can match.
+        Tokens are rejected when the file changes.
+        """
+        if not pattern.pageable():
+            raise CompilerException('paging requires a list pattern with a single matcher and no directives.')
+
+        if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+            raise ValueError('the page size must be a positive integer.')
+
+        pattern_digest = pattern.digest()
+        version_digest = page_digest(self.version())
+
+        position = 0
+        if token is not None:
+            position = decode_page_token(token, pattern_digest, version_digest)
+
+        compiled = pattern.compiled()
+        matcher = compiled.matchers[0]
+        limits = compiled.limits
+
+        pattern.start_limits()
+        results = []
+
+        for block in self.candidate_blocks(matcher):
+            start = block * self.block_size
+
+            if start + self.block_size <= position:
+                continue
+
+            position = max(position, start)
+            records = self.read_block(block)
+
+            while position - start < len(records):
+                if len(results) >= size:
+                    return results, encode_page_token(pattern_digest, version_digest, position)
+
+                if limits is not None:
+                    limits.tick(1)
+
+                current = matcher.match(records[position - start])
+                position += 1
+
+                if current is not NoMatch:
+                    results.append(current)
+
+        return results, None
+
+    def match_parallel(self, pattern, executor, chunk_size = 10000):
+        """
+        Like Pattern.match_parallel(). Workers read contiguous
+        runs of candidate blocks (at most 'chunk_size' records)
+        from the file themselves, so only offsets are sent to them.
+        """
+        compiled = pattern.compiled()
+        execution = pattern.start_limits()
+
+        if not isinstance(compiled, MatchList):
+            return compiled.match(list(self.records()))
+
+        chunk_blocks = max(1, chunk_size // self.block_size)
+
+        result = []
+        for matcher in compiled.matchers:
+            ranges = []
+
+            for block in self.candidate_blocks(matcher):
+                if len(ranges) > 0 and ranges[-1][1] == block and block - ranges[-1][0] < chunk_blocks:
+                    ranges[-1][1] = block + 1
+                else:
+                    ranges.append([block, block + 1])
+
+            starts = [self.offsets[first * self.block_size] for first, last in ranges]
+            ends = [self.offsets[min(last * self.block_size, len(self))] for first, last in ranges]
+
+            matcher_results = []
+
+            batches = executor.map(match_file_range,
+                itertools.repeat(matcher), itertools.repeat(self.filepath), starts, ends,
+                itertools.repeat(self.object_pairs_hook), itertools.repeat(execution))
+
+            for batch in batches:
+                matcher_results += batch
+
+            matcher_results = list(compiled.apply_directives(matcher, matcher_results))
+
+            # at least one match?
+            if len(matcher_results) == 0:
+                return NoMatch
+
+            result += matcher_results
+
+        return result
+
+
+# Staged pipeline:
+# Matches newline-delimited JSON in stages that run in their own threads,
+# connected by bounded queues, so that reading, decoding, matching
+# and writing overlap: reader -> decoder(s) -> matcher -> writer.
+# Lines, records and results travel in batches to reduce locking.
+
+class StageStats(object):
+    """
+    Counters for a pipeline stage. A stall is a get() on an empty queue
+    (waiting for the previous stage) or a put() on a full queue
+    (waiting for the next stage).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.elapsed = 0.0
+        self.input_stalls = 0
+        self.input_wait = 0.0
+        self.output_stalls = 0
+        self.output_wait = 0.0
+
+    def report(self):
+        """ Return the counters as a JSON-serializable dict. """
+        busy = max(0.0, self.elapsed - self.input_wait - self.output_wait)
+
+        return {
+            'stage': self.name,
+            'batches': self.batches,
+            'items': self.items,
+            'items_per_second': round(self.items / busy) if busy > 0 else None,
+            'busy': round(busy, 6),
+            'input_stalls': self.input_stalls,
+            'input_wait': round(self.input_wait, 6),
+            'output_stalls': self.output_stalls,
+            'output_wait': round(self.output_wait, 6),
+        }
+
+
+class Pipeline(object):
+    """
+    Stream newline-delimited JSON through a pattern in stages.
+    See Pattern.stream() for the patterns that can be used.
+
+    Decoders only run in parallel on free-threaded Python builds,
+    but a single decoder already overlaps with I/O and writing.
+    """
+    def __init__(self, pattern, object_pairs_hook = None, queue_depth = 8, decoders = 1, batch_size = 1000):
+        import queue
+        import threading
+
+        self.pattern = pattern
+        self.object_pairs_hook = object_pairs_hook
+        self.decoders = decoders
+        self.batch_size = batch_size
+
+        self.lines = queue.Queue(queue_depth)
+        self.records = queue.Queue(queue_depth)
+        self.results = queue.Queue(queue_depth)
+
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.stats = [StageStats('read')]
+        self.stats += [StageStats('decode') for _ in range(decoders)]
+        self.stats += [StageStats('match'), StageStats('write')]
+
+    # queues:
+
+    def put(self, queue, item, stats):
+        """ Put an item in a queue, waiting while it's full unless stopped. """
+        import queue as queue_module
+        import time
+
+        if queue.full():
+            stats.output_stalls += 1
+
+        start = time.perf_counter()
+
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout = 0.1)
+                break
+            except queue_module.Full:
+                pass
+
+        stats.output_wait += time.perf_counter() - start
+
+    def get(self, queue, stats):
+        """
+        Get an item from a queue, waiting while it's empty.
+        Raises the error of any stage and returns None (the end) when stopped.
+        """
+        import queue as queue_module
+        import time
+
+        if queue.empty():
+            stats.input_stalls += 1
+
+        start = time.perf_counter()
+
+        item = None
+
+        while True:
+            if self.error is not None:
+                raise self.error
+
+            if self.stopped.is_set():
+                break
+
+            try:
+                item = queue.get(timeout = 0.1)
+                break
+            except queue_module.Empty:
+                pass
+
+        stats.input_wait += time.perf_counter() - start
+        return item
+
+    def stage(self, function, stats):
+        """
+        Run a stage, measuring time and stopping everything on errors.
+        """
+        import time
+
+        start = time.perf_counter()
+
+        try:
+            function(stats)
+
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+
+            self.stopped.set()
+
+        stats.elapsed = time.perf_counter() - start
+
+    # stages:
+
+    def read(self, stream, stats):
+        """
+        Read batches of lines, numbered so that decoders can run in any order.
+        """
+        index = 0
+
+        for batch in iter(lambda: list(itertools.islice(stream, self.batch_size)), []):
+            if self.stopped.is_set():
+                break
+
+            stats.batches += 1
+            stats.items += len(batch)
+
+            self.put(self.lines, (index, batch), stats)
+            index += 1
+
+        # one end marker for each decoder:
+        for _ in range(self.decoders):
+            self.put(self.lines, None, stats)
+
+    def decode(self, stats):
+        """
+        Decode batches of lines as UTF-8 JSON values.
+        """
+        while True:
+            item = self.get(self.lines, stats)
+
+            if item is None:
+                break
+
+            index, lines = item
+            records = []
+
+            for line in lines:
+                text = line.decode('utf-8-sig')
+
+                if text.strip():
+                    records.append(json.loads(text, object_pairs_hook = self.object_pairs_hook))
+
+            stats.batches += 1
+            stats.items += len(records)
+
+            self.put(self.records, (index, records), stats)
+
+        self.put(self.records, None, stats)
+
+    def match(self, stats):
+        """
+        Match decoded records in their original order.
+        Results are sent when a batch is full or when waiting for records.
+        """
+        output = []
+
+        def send():
+            if len(output) > 0:
+                stats.batches += 1
+                self.put(self.results, list(output), stats)
+                output.clear()
+
+        def records():
+            pending = {}
+            position = 0
+            finished = 0
+
+            while True:
+                if position in pending:
+                    batch = pending.pop(position)
+                    position += 1
+
+                    stats.items += len(batch)
+                    yield from batch
+                    continue
+
+                if finished == self.decoders:
+                    break
+
+                if self.records.empty():
+                    send()
+
+                item = self.get(self.records, stats)
+
+                if item is None:
+                    finished += 1
+                else:
+                    index, batch = item
+                    pending[index] = batch
+
+        # stream() starts the limits in this thread:
+        for result in self.pattern.stream(records()):
+            output.append(result)
+
+            if len(output) >= self.batch_size:
+                send()
+
+        send()
+        self.put(self.results, None, stats)
+
+    def write(self, formatter, output, stats):
+        """
+        Serialize results and write them to a binary stream as UTF-8,
+        one per line. Returns the number of results written.
+        """
+        import time
+
+        start = time.perf_counter()
+        count = 0
+
+        while True:
+            batch = self.get(self.results, stats)
+
+            if batch is None:
+                break
+
+            stats.batches += 1
+            stats.items += len(batch)
+
+            output.write(''.join(formatter.dump(result) + formatter.newline for result in batch).encode('utf-8'))
+            count += len(batch)
+
+        stats.elapsed = time.perf_counter() - start
+        return count
+
+    def run(self, stream, formatter, output = None):
+        """
+        Match every line in a binary stream, writing results to 'output'
+        (a binary stream, stdout by default) with 'formatter' from the
+        calling thread. Returns the number of results written.
+        """
+        import threading
+
+        if output is None:
+            output = sys.stdout.buffer
+
+        # fail early on patterns that can't be streamed:
+        self.pattern.streamable()
+
+        read_stats, *decode_stats, match_stats, write_stats = self.stats
+
+        threads = [threading.Thread(target = self.stage, args = (lambda stats: self.read(stream, stats), read_stats))]
+        threads += [threading.Thread(target = self.stage, args = (self.decode, stats)) for stats in decode_stats]
+        threads += [threading.Thread(target = self.stage, args = (self.match, match_stats))]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            return self.write(formatter, output, write_stats)
+
+        # stop the other stages when done (e.g. __limit__) or on errors:
+        # (the reader may be blocked reading, so it's not waited for)
+        finally:
+            self.stopped.set()
+
+            for thread in threads[1:]:
+                thread.join()
+
+    def report(self):
+        """ Return the counters for every stage as a JSON-serializable list. """
+        return [stats.report() for stats in self.stats]
+
+
+# Memory profiling:
+
+class MeasuredNode(object):
+    """
+    Base class for the measured copies of pattern nodes made by
+    a MemoryProfile. match() and test() count the calls and the memory
+    allocated by each one, minus what the nodes called from it allocated.
+    """
+    def match(self, data):
+        return self._profile.call(self._profile_stats, super().match, data)
+
+    def test(self, data):
+        return self._profile.call(self._profile_stats, super().test, data)
+
+
+# measured subclass for each node class:
+MEASURED_CLASSES = {}
+
+
+def measured_class(cls):
+    """ Return the MeasuredNode subclass for a node class. """
+    measured = MEASURED_CLASSES.get(cls)
+
+    if measured is None:
+        measured = type('Measured' + cls.__name__, (MeasuredNode, cls), {})
+        MEASURED_CLASSES[cls] = measured
+
+    return measured
+
+
+class MemoryProfile(object):
+    """
+    Measure the memory used by each phase of a run using tracemalloc.
+    Call start() before the phases and stop() after them.
+
+    For each phase, 'peak' is the maximum memory allocated over
+    the memory in use when the phase started and 'retained'
+    is the memory still in use when it ends. Both are in bytes.
+
+    match() runs a pattern on measured copies of its nodes (the pattern
+    itself is not modified), so for each node it also reports the calls
+    and the memory its results allocated, including the intermediate
+    results that were dropped later.
+    """
+    def __init__(self):
+        import tracemalloc
+        from array import array
+
+        self.tracemalloc = tracemalloc
+        self.phases = []
+        self.nodes = []
+        self.peak = 0
+
+        # bytes allocated by the calls that already returned:
+        self.attributed = array('q', [0])
+
+        # bytes that call() allocates itself, see calibrate():
+        self.overhead = 0
+
+    def start(self):
+        """
+        Start tracing memory allocations.
+        """
+        self.tracemalloc.start()
+        self.overhead = self.calibrate()
+
+    def stop(self):
+        """
+        Stop tracing memory allocations.
+        """
+        _, self.peak = self.tracemalloc.get_traced_memory()
+        self.tracemalloc.stop()
+
+    def phase(self, name):
+        """
+        A context manager that measures a phase.
+        """
+        import contextlib
+
+        @contextlib.contextmanager
+        def measure():
+            tracemalloc = self.tracemalloc
+
+            # Python 3.9+, otherwise peaks include previous phases:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+            start, _ = tracemalloc.get_traced_memory()
+            yield
+            current, peak = tracemalloc.get_traced_memory()
+
+            self.phases.append({
+                'phase': name,
+                'peak': max(0, peak - start),
+                'retained': current - start,
+            })
+
+        return measure()
+
+    def call(self, stats, method, data):
+        """
+        Call a node method, adding the call and the memory allocated
+        by it (but not by the nodes it called) to 'stats'.
+        """
+        attributed = self.attributed
+        before_attributed = attributed[0]
+        before = self.tracemalloc.get_traced_memory()[0]
+
+        try:
+            return method(data)
+
+        finally:
+            allocated = self.tracemalloc.get_traced_memory()[0] - before - self.overhead
+
+            stats[0] += 1
+            stats[1] += allocated - (attributed[0] - before_attributed)
+            attributed[0] = before_attributed + allocated
+
+    def calibrate(self, calls = 16):
+        """
+        Return the bytes that call() allocates itself (the integers
+        it keeps while a node runs), the least of some empty calls.
+        """
+        from array import array
+
+        stats = array('q', [0, 0])
+        overhead = None
+
+        for _ in range(calls):
+            before = stats[1]
+            self.call(stats, id, None)
+            allocated = stats[1] - before
+
+            if overhead is None or allocated < overhead:
+                overhead = allocated
+
+        return max(0, overhead)
+
+    def measured(self, node, stats, path = '$'):
+        """
+        Return a measured copy of a compiled pattern node and its
+        children, adding [path, node, stats] to 'stats' for each one.
+        """
+        import copy
+        from array import array
+
+        if not hasattr(node, 'match') or not hasattr(node, 'test'):
+            return node
+
+        measured = copy.copy(node)
+        measured.__class__ = measured_class(type(node))
+        measured._profile = self
+        measured._profile_stats = array('q', [0, 0])
+        stats.append((path, node, measured._profile_stats))
+
+        if isinstance(node, MatchList):
+            measured.matchers = [self.measured(matcher, stats, '{}[{}]'.format(path, position))
+                for position, matcher in enumerate(node.matchers)]
+
+        elif isinstance(node, MatchDict):
+            measured.matchers = [(key, self.measured(matcher, stats, '{}[{}]'.format(path, json.dumps(key))))
+                for key, matcher in node.matchers]
+
+        return measured
+
+    def match(self, pattern, data):
+        """
+        Execute a pattern like Pattern.match() does.
+
+        For list patterns, the results of each matcher are built
+        in a 'match' phase and the directives are applied to them
+        in a 'directives' phase, like match_parallel() does. Directives
+        in other patterns (e.g. nested lists) are part of the match phase.
+        """
+        stats = []
+        compiled = self.measured(pattern.compiled(), stats)
+        pattern.start_limits()
+
+        if not isinstance(compiled, MatchList):
+            with self.phase('match'):
+                result = compiled.match(data)
+
+            with self.phase('directives'):
+                pass
+
+        else:
+            with self.phase('match'):
+                matched = None
+
+                # like MatchList.match(), without directives:
+                if not compiled.unsatisfiable and (isinstance(data, list) or (compiled.adapt and is_adaptable_sequence(data))):
+                    values = compiled.counted(data)
+                    matched = []
+
+                    for matcher in compiled.matchers:
+                        if getattr(matcher, 'unsatisfiable', False):
+                            matcher_results = []
+                        else:
+                            matcher_results = [current for current in map(matcher.match, values) if current is not NoMatch]
+
+                        matched.append((matcher, matcher_results))
+
+            with self.phase('directives'):
+                result = NoMatch if matched is None else []
+
+                for matcher, matcher_results in matched or []:
+                    matcher_results = list(compiled.apply_directives(matcher, matcher_results))
+
+                    # at least one match?
+                    if len(matcher_results) == 0:
+                        result = NoMatch
+                        break
+
+                    result += matcher_results
+
+                del matched
+
+        self.nodes = [{ 'node': path, 'class': type(node).__name__, 'calls': node_stats[0], 'allocated': node_stats[1] }
+            for path, node, node_stats in stats if node_stats[0] > 0]
+
+        return result
+
+    def report(self):
+        """
+        Return the results as a JSON-serializable dict.
+        'peak' is the peak memory of the whole run (after stop()).
+        """
+        return {
+            'phases': self.phases,
+            'nodes': self.nodes,
+            'peak': self.peak,
+        }
+
+
+# IO utils and formatting JSON:
+# (part of the API because the shell will use them too)
+
+NEWLINES = {
+    'dos'    : '\r\n',
+    'mac'    : '\r',
+    'unix'   : '\n',
+    'system' : os.linesep,
+}
+
+
+# Compressed input:
+# Detected by the first bytes and decompressed in a background thread
+# that fills a bounded queue, so that decompression overlaps with
+# decoding and matching. zlib, bz2 and lzma release the GIL while working.
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+]
+
+
+def detect_compression(head):
+    """ Return the compression format for the first bytes of a stream or None. """
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def make_decompressor(compression):
+    """ Return a new incremental decompressor for a single stream. """
+    if compression == 'gzip':
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+
+    if compression == 'xz':
+        import lzma
+        return lzma.LZMADecompressor()
+
+    raise ValueError('unknown compression: {}'.format(compression))
+
+
+class DecompressedInput(io.RawIOBase):
+    """
+    A raw binary stream that decompresses 'stream' in a background thread.
+    Concatenated streams (e.g. from cat a.gz b.gz) are supported.
+    Use open_binary_input() to get a buffered reader.
+    """
+    def __init__(self, stream, compression, chunk_size = 2 ** 16, queue_depth = 16):
+        import queue
+        import threading
+
+        self.stream = stream
+        self.compression = compression
+        self.chunk_size = chunk_size
+
+        self.queue = queue.Queue(queue_depth)
+        self.pending = memoryview(b'')
+        self.finished = False
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target = self.decompress, daemon = True)
+        self.thread.start()
+
+    def put(self, item):
+        """ Add an item to the queue unless the reader was closed. """
+        import queue
+
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def decompress(self):
+        """
+        Decompress everything, putting chunks in the queue.
+        Ends with None or with the exception that stopped it.
+        """
+        try:
+            decompressor = make_decompressor(self.compression)
+            started = False
+
+            while not self.stopped.is_set():
+                data = self.stream.read(self.chunk_size)
+
+                if not data:
+                    break
+
+                while data:
+                    chunk = decompressor.decompress(data)
+                    started = True
+
+                    if chunk:
+                        self.put(chunk)
+
+                    # another stream follows:
+                    if decompressor.eof:
+                        data = decompressor.unused_data
+                        decompressor = make_decompressor(self.compression)
+                        started = False
+                    else:
+                        data = b''
+
+            if started:
+                raise EOFError('compressed input ended before the end of the stream')
+
+            self.put(None)
+
+        except Exception as err:
+            self.put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """ Fill 'buffer' with decompressed data, return the bytes written. """
+        while len(self.pending) == 0 and not self.finished:
+            item = self.queue.get()
+
+            if item is None:
+                self.finished = True
+
+            elif isinstance(item, Exception):
+                self.finished = True
+                raise item
+
+            else:
+                self.pending = memoryview(item)
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+
+        return size
+
+    def close(self):
+        """ Stop the background thread and close the compressed stream. """
+        if self.closed:
+            return
+
+        self.stopped.set()
+
+        # the thread may be blocked reading it, closing it stops the read:
+        try:
+            self.stream.close()
+        finally:
+            super().close()
+
+
+def open_binary_input(filepath = None):
+    """
+    Open 'filepath' (or stdin when None) for reading as bytes.
+    gzip, bz2 and xz content is detected and decompressed in a background thread.
+    """
+    if filepath is None:
+        return wrap_binary_input(sys.stdin.buffer)
+    else:
+        return wrap_binary_input(open(filepath, 'rb'))
+
+
+def wrap_binary_input(stream):
+    """
+    Return a binary stream that decompresses 'stream' when needed.
+    """
+    # peek needs a buffered stream:
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+
+    compression = detect_compression(stream.peek(8)[:8])
+
+    if compression is None:
+        return stream
+
+    return io.BufferedReader(DecompressedInput(stream, compression), 2 ** 16)
+
+
+def binary_read_utf8(stream):
+    """ Read a binary stream as UTF-8 (allowing an optional BOM). """
+    content = stream.read()
+    return content.decode('utf-8-sig')
+
+
+def binary_read_ndjson(stream, object_pairs_hook = None):
+    """ Read newline-delimited JSON values from a binary stream as UTF-8, lazily. """
+    for line in stream:
+        text = line.decode('utf-8-sig')
+
+        if text.strip():
+            yield json.loads(text, object_pairs_hook = object_pairs_hook)
+
+
+def binary_read_json_list(stream, object_pairs_hook = None, chunk_size = 2**16):
+    """
+    Parse a JSON list from a binary stream as UTF-8 incrementally,
+    yielding its elements as soon as they are read.
+    Raises ValueError when the content is not a valid list.
+    """
+    import codecs
+
+    decoder = JSONDecoder(object_pairs_hook = object_pairs_hook)
+    scan = decoder.scan_once
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+    separator = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill(size):
+        """ Read more text, dropping what was already parsed. """
+        nonlocal buffer, position, eof
+
+        chunk = stream.read(size)
+        eof = not chunk
+
+        buffer = buffer[position:] + text_decoder.decode(chunk, eof)
+        position = 0
+
+    def next_char():
+        """ Skip whitespace, return the next character ('' at the end). """
+        nonlocal position
+
+        while True:
+            position = whitespace.match(buffer, position).end()
+
+            if position < len(buffer) or eof:
+                return buffer[position : position + 1]
+
+            fill(chunk_size)
+
+    def next_value():
+        """ Decode the next value, reading more text when it's incomplete. """
+        nonlocal position
+
+        while True:
+            try:
+                value, end = scan(buffer, position)
+
+                # a number may continue in the next chunk (e.g. "1.5" of "1.5e3"):
+                if eof or (end < len(buffer) and not buffer[end] in '0123456789+-.eE'):
+                    position = end
+                    return value
+
+            except (StopIteration, ValueError):
+                skipped = whitespace.match(buffer, position).end()
+
+                if skipped > position:
+                    position = skipped
+                    continue
+
+                # raise the decoder error:
+                if eof:
+                    decoder.raw_decode(buffer, position)
+                    raise ValueError('expected a value in a JSON list')
+
+            # read as much as we have, so that big values are parsed a few times only:
+            fill(max(chunk_size, len(buffer) - position))
+
+    if next_char() != '[':
+        raise ValueError('expected a JSON list')
+
+    position += 1
+
+    if next_char() == ']':
+        position += 1
+
+    else:
+        while True:
+            yield next_value()
+
+            # usually the separator is already in the buffer:
+            match = separator.match(buffer, position)
+
+            if match is not None:
+                char = match.group(1)
+                position = match.end()
+            else:
+                char = next_char()
+                position += 1
+
+            if char == ']':
+                break
+
+            if char != ',':
+                raise ValueError('expected "," or "]" in a JSON list')
+
+    if next_char() != '':
+        raise ValueError('extra data after a JSON list')
+
+
+def binary_stdin_read_utf8():
+    """ Read from stdin as UTF-8 (allowing an optional BOM and compression). """
+    return binary_read_utf8(open_binary_input())
+
+
+def binary_stdin_read_ndjson(object_pairs_hook = None):
+    """ Read newline-delimited JSON values from stdin as UTF-8, lazily. """
+    return binary_read_ndjson(open_binary_input(), object_pairs_hook)
+
+
+def json_default(value):
+    """ Serialize dict-like values (e.g. Rows or AttributeViews) that JSON doesn't know about. """
+    if type(value) is ProjectionView:
+        return value.materialize()
+
+    if isinstance(value, Mapping):
+        return dict(value)
+
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def binary_stdout_write_utf8(text):
+    """ Write 'text' to stdout as UTF-8. """
+    content = text.encode('utf-8')
+    sys.stdout.buffer.write(content)
+
+
+class JSONFormatter(object):
+    """
+    A helper to print JSON to stdout in a desired format.
+    It's just a wrapper over json.dumps() with configurable newlines.
+    """
     def __init__(self, ensure_ascii, indent, sort_keys, newline):
         self.ensure_ascii = ensure_ascii
         self.indent = indent
@@ -761,7 +5333,7 @@ class JSONFormatter(object):
         using the formatter settings.
         """
         text = json.dumps(jsondata, ensure_ascii = self.ensure_ascii,
-            indent = self.indent, sort_keys = self.sort_keys)
+            indent = self.indent, sort_keys = self.sort_keys, default = json_default)
 
         # if not indenting, there are no newlines:
         if self.indent is None:
@@ -784,11 +5356,21 @@ class JSONFormatter(object):
         """
         binary_stdout_write_utf8(self.dump(jsondata))
 
+    def stdout_lines(self, iterable):
+        """
+        Serialize every element in 'iterable' and print them to stdout,
+        one per line. Returns the number of elements printed.
+        """
+        count = 0
+
+        for jsondata in iterable:
+            binary_stdout_write_utf8(self.dump(jsondata) + self.newline)
+            count += 1
 
-# Program (e.g. python -m MQLite ...)
+        return count
 
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+# Program (e.g. python -m MQLite ...)
 
 # Information and error messages:
 
@@ -804,7 +5386,36 @@ def errln(line):
 
 # Parser:
 
+# defaults for every option:
+DEFAULT_OPTIONS = {
+    'strict'      : False,
+    'exists'      : False,
+    'count'       : False,
+    'ndjson'      : False,
+    'input'       : None,
+    'index'       : False,
+    'index_key'   : None,
+    'compact'     : False,
+    'rows'        : False,
+    'sort_buffer' : None,
+    'views'       : False,
+    'cache_dir'   : os.environ.get('MQLITE_CACHE_DIR'),
+    'workers'     : None,
+    'queue_depth' : None,
+    'stage_stats' : False,
+    'timeout'     : None,
+    'max_steps'   : None,
+    'profile_memory' : False,
+    'ascii'       : False,
+    'indent'      : 4,
+    'sort_keys'   : False,
+    'newline'     : 'system',
+}
+
+
 def make_parser():
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
     parser = ArgumentParser(
         description = __doc__,
         formatter_class = RawDescriptionHelpFormatter,
@@ -820,6 +5431,83 @@ def make_parser():
         help = 'exit with an error message and status 1 when no match',
         action = 'store_true')
 
+    parser.add_argument('--exists',
+        help = 'print true or false (exit status 1), stop at the first match',
+        action = 'store_true')
+
+    parser.add_argument('--count',
+        help = 'print the number of results instead of the results',
+        action = 'store_true')
+
+    # optional, input and memory usage:
+    input_format = parser.add_argument_group('input and memory usage')
+
+    input_format.add_argument('--ndjson',
+        help = 'read stdin as newline-delimited JSON and print one result per line',
+        action = 'store_true')
+
+    input_format.add_argument('--input',
+        help = 'read FILE instead of stdin (gzip, bz2 and xz are detected in both)',
+        metavar = 'FILE')
+
+    input_format.add_argument('--index',
+        help = 'with --ndjson and --input, read records using an offset index stored in FILE.mqindex',
+        action = 'store_true')
+
+    input_format.add_argument('--index-key',
+        help = 'keep the min/max values of KEY in the index to skip blocks that can\'t match (can be repeated)',
+        metavar = 'KEY',
+        action = 'append')
+
+    input_format.add_argument('--compact',
+        help = 'share keys and short strings between records to save memory',
+        action = 'store_true')
+
+    input_format.add_argument('--rows',
+        help = 'store records with the same keys as tuple-backed rows (implies --compact)',
+        action = 'store_true')
+
+    input_format.add_argument('--sort-buffer',
+        help = 'sort at most N results in memory, spilling to temporary files',
+        metavar = 'N',
+        type = int)
+
+    input_format.add_argument('--views',
+        help = 'return results as read-only views of the input instead of copies',
+        action = 'store_true')
+
+    input_format.add_argument('--cache-dir',
+        help = 'store compiled patterns in DIR (default: $MQLITE_CACHE_DIR)',
+        metavar = 'DIR')
+
+    input_format.add_argument('--timeout',
+        help = 'stop with an error when matching takes more than N seconds',
+        metavar = 'N',
+        type = float)
+
+    input_format.add_argument('--max-steps',
+        help = 'stop with an error after evaluating N dicts or list elements',
+        metavar = 'N',
+        type = int)
+
+    input_format.add_argument('--profile-memory',
+        help = 'print the memory used by each phase to stderr, as JSON',
+        action = 'store_true')
+
+    input_format.add_argument('--workers',
+        help = 'match (or decode with --ndjson) using N threads (faster on free-threaded Python builds)',
+        metavar = 'N',
+        type = int)
+
+    input_format.add_argument('--queue-depth',
+        help = 'run --ndjson in stages connected by queues holding N batches',
+        metavar = 'N',
+        type = int)
+
+    input_format.add_argument('--stage-stats',
+        help = 'run --ndjson in stages and print counters for each one to stderr, as JSON',
+        action = 'store_true')
+
     # optional, output format:
     output_format = parser.add_argument_group('output format')
 
@@ -830,8 +5518,7 @@ def make_parser():
     output_format.add_argument('--indent',
         help = 'use N spaces of indentation (-1 to disable)',
         metavar = 'N',
-        type = int,
-        default = 4)
+        type = int)
 
     output_format.add_argument('--sort-keys',
         help = 'sort dictionaries by key before printing',
@@ -839,14 +5526,53 @@ def make_parser():
 
     output_format.add_argument('--newline',
         help = 'use a specific newline mode (default: system)',
-        choices = ['dos', 'mac', 'unix', 'system'],
-        default = 'system')
+        choices = ['dos', 'mac', 'unix', 'system'])
 
+    parser.set_defaults(**DEFAULT_OPTIONS)
     return parser
 
 
 # Entry point:
 
+def profile_main(options, compiler, loader, indent, newline):
+    """
+    Run with --profile-memory.
+    Prints the results to stdout and the profile to stderr.
+    """
+    profile = MemoryProfile()
+    profile.start()
+
+    try:
+        with profile.phase('read'):
+            data = binary_read_utf8(open_binary_input(options.input))
+
+        with profile.phase('decode'):
+            datajson = json.loads(data, object_pairs_hook = loader)
+            del data
+
+        with profile.phase('compile'):
+            if options.cache_dir:
+                pattern = PlanCache(options.cache_dir).pattern(options.pattern, compiler)
+            else:
+                pattern = JSONPattern(options.pattern, compiler)
+
+        result = profile.match(pattern, datajson)
+        formatter = JSONFormatter(options.ascii, indent, options.sort_keys, newline)
+
+        with profile.phase('serialize'):
+            text = '' if result is NoMatch else formatter.dump(result)
+
+    finally:
+        profile.stop()
+
+    binary_stdout_write_utf8(text)
+    print(json.dumps(profile.report()), file = sys.stderr, flush = True)
+
+    if result is NoMatch and options.strict:
+        errln('error: no match')
+        sys.exit(1)
+
+
 def main():
     parser = make_parser()
     options = parser.parse_args()
@@ -857,24 +5583,147 @@ def main():
     if options.indent < 0:
         indent = None
 
+    if options.sort_buffer is not None and options.sort_buffer < 1:
+        parser.error('--sort-buffer must be at least 1')
+
+    if options.workers is not None and options.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if options.queue_depth is not None and options.queue_depth < 1:
+        parser.error('--queue-depth must be at least 1')
+
+    if options.exists and options.count:
+        parser.error('--exists and --count can\'t be used together')
+
+    if (options.index or options.index_key) and not (options.ndjson and options.input):
+        parser.error('--index and --index-key require --ndjson and --input')
+
+    if (options.index or options.index_key) and (options.queue_depth is not None or options.stage_stats):
+        parser.error('--index can\'t be used with --queue-depth or --stage-stats')
+
+    if options.profile_memory and (options.ndjson or options.exists or options.count or options.workers is not None
+            or options.queue_depth is not None or options.stage_stats):
+        parser.error('--profile-memory can\'t be used with --ndjson, --exists, --count, --workers, --queue-depth or --stage-stats')
+
+    limits = None
+    if options.timeout is not None or options.max_steps is not None:
+        limits = Limits(options.timeout, options.max_steps)
+
+    compiler = Compiler(sort_buffer = options.sort_buffer, limits = limits, views = options.views)
+
+    loader = None
+    if options.compact or options.rows:
+        loader = CompactLoader(rows = options.rows)
+
+    index = None
+
     try:
-        data = binary_stdin_read_utf8()
-        datajson = json.loads(data)
+        if options.profile_memory:
+            profile_main(options, compiler, loader, indent, newline)
+            return
+
+        if options.cache_dir:
+            pattern = PlanCache(options.cache_dir).pattern(options.pattern, compiler)
+        else:
+            pattern = JSONPattern(options.pattern, compiler)
+
+        # only read the blocks that can match:
+        if options.index or options.index_key:
+            index = NDJSONIndex(options.input, options.index_key or (), object_pairs_hook = loader)
+            datajson = index.select(pattern.streamable().matchers[0])
+
+        # one record per line:
+        elif options.ndjson:
+            stream = open_binary_input(options.input)
+            datajson = binary_read_ndjson(stream, loader)
+        else:
+            stream = open_binary_input(options.input)
+            datajson = json.loads(binary_read_utf8(stream), object_pairs_hook = loader)
+
+        formatter = JSONFormatter(options.ascii, indent, options.sort_keys, newline)
+
+        # only test whether there is a match:
+        if options.exists:
+            if options.ndjson:
+                found = pattern.stream_exists(datajson)
+            else:
+                found = pattern.exists(datajson)
+
+            formatter.stdout(found)
+
+            if not found:
+                sys.exit(1)
+
+            return
+
+        # only count results:
+        if options.count:
+            if options.ndjson:
+                count = pattern.stream_count(datajson)
+            else:
+                count = pattern.count(datajson)
+
+            formatter.stdout(count)
+
+            if count == 0 and options.strict:
+                errln('error: no match')
+                sys.exit(1)
+
+            return
+
+        # one result per line:
+        if options.ndjson:
+            formatter = JSONFormatter(options.ascii, None, options.sort_keys, newline)
+
+            # workers read their part of the file:
+            if index is not None and options.workers is not None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                with ThreadPoolExecutor(options.workers) as executor:
+                    result = index.match_parallel(pattern, executor)
+
+                count = formatter.stdout_lines([] if result is NoMatch else result)
+
+            # in stages:
+            elif options.workers is not None or options.queue_depth is not None or options.stage_stats:
+                pipeline = Pipeline(pattern, loader, options.queue_depth or 8, options.workers or 1)
+                count = pipeline.run(stream, formatter)
+
+                if options.stage_stats:
+                    print(json.dumps(pipeline.report()), file = sys.stderr, flush = True)
 
-        result = JSONPattern(options.pattern).match(datajson)
+            else:
+                count = formatter.stdout_lines(pattern.stream(datajson))
+
+            if count == 0 and options.strict:
+                errln('error: no match')
+                sys.exit(1)
+
+            return
+
+        if options.workers is not None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(options.workers) as executor:
+                result = pattern.match_parallel(datajson, executor)
+        else:
+            result = pattern.match(datajson)
 
         if result is NoMatch:
             if options.strict:
                 errln('error: no match')
                 sys.exit(1)
         else:
-            formatter = JSONFormatter(options.ascii, indent, options.sort_keys, newline)
             formatter.stdout(result)
 
     except Exception as err:
         errln(str(err))
         sys.exit(1)
 
+    finally:
+        if index is not None:
+            index.close()
+
 
 if __name__ == '__main__':
     try:
@@ -10,8 +10,11 @@ An interactive shell for MQLite.
 import os
 import json
 import sys
+import threading
+import time
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections.abc import Mapping
 
 
 # Information and error messages:
@@ -29,41 +32,883 @@ def errln(line):
 # Non-builtin imports:
 
 try:
-    from MQLite import JSONFormatter, JSONPattern, NoMatch
+    from MQLite import (
+        Compiler, CompactLoader, JSONFormatter, JSONPattern, Limits, MemoryProfile, NDJSONIndex, NoMatch, SQLiteStore,
+        binary_read_json_list, binary_read_ndjson, binary_read_utf8, open_binary_input,
+        MatchAny, MatchDict, MatchEqual, MatchList,
+        ConstraintContain, ConstraintEqualTo, ConstraintIn, ConstraintLessOrEqualTo, ConstraintLessThan,
+        ConstraintMoreOrEqualTo, ConstraintMoreThan, ConstraintNever, ConstraintRange, ConstraintRegex,
+        ConstraintSuffixAll, ConstraintSuffixAny,
+    )
 
 except ImportError:
     errln('MQLiteSH requires the following modules:')
-    errln('MQLite 2015.04.04+ - <https://github.com/Beluki/MQLite>')
+    errln('MQLite 2026.10.18+ - <https://github.com/Beluki/MQLite>')
     sys.exit(1)
 
 
 # IO utils:
 
-def read_json_file(filepath):
+def read_json_file(filepath, object_pairs_hook = None):
     """
     Open 'filepath' as UTF-8 and parse the content as JSON.
-    Allows an optional BOM.
+    Allows an optional BOM, gzip, bz2 or xz compression
+    and a custom hook for dicts (e.g. a CompactLoader).
     """
-    with open(filepath, encoding = 'utf-8-sig') as descriptor:
-        return json.load(descriptor)
+    with open_binary_input(filepath) as stream:
+        return json.loads(binary_read_utf8(stream), object_pairs_hook = object_pairs_hook)
+
+
+def read_ndjson_file(filepath, object_pairs_hook = None):
+    """
+    Like read_json_file(), for newline-delimited JSON.
+    Returns a list with all the values.
+    """
+    with open_binary_input(filepath) as stream:
+        return list(binary_read_ndjson(stream, object_pairs_hook))
+
+
+class BackgroundLoader(object):
+    """
+    Load a JSON file in a background thread, so that queries can run
+    on the records loaded so far. JSON lists and newline-delimited JSON
+    are parsed incrementally, any other value is available at the end.
+    """
+    def __init__(self, filepath, ndjson, object_pairs_hook = None):
+        self.filepath = filepath
+        self.ndjson = ndjson
+        self.object_pairs_hook = object_pairs_hook
+
+        # grows while loading, 'data' is set at the end:
+        self.records = []
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            with open_binary_input(self.filepath) as stream:
+                if self.ndjson:
+                    values = binary_read_ndjson(stream, self.object_pairs_hook)
+
+                # a list? (skipping the BOM and whitespace)
+                elif stream.peek(64).lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'['):
+                    values = binary_read_json_list(stream, self.object_pairs_hook)
+
+                else:
+                    self.data = json.loads(binary_read_utf8(stream), object_pairs_hook = self.object_pairs_hook)
+                    values = []
+
+                # appending is atomic, readers see a consistent prefix:
+                for value in values:
+                    self.records.append(value)
+
+            if self.data is None:
+                self.data = self.records
+
+        except Exception as err:
+            self.error = err
+
+        finally:
+            self.done.set()
+
+    def loaded(self):
+        """
+        Return the data loaded so far and whether it's partial
+        (still loading or loading failed).
+        """
+        if self.done.is_set() and self.error is None:
+            return self.data, False
+
+        # a copy, so that queries see a fixed number of records:
+        return self.records[:], True
+
+    def wait(self):
+        """
+        Wait until loading finishes (CONTROL + C stops waiting).
+        """
+        while not self.done.wait(0.1):
+            pass
+
+
+# SQLite databases are opened instead of loaded:
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+def open_sqlite_store(filepath, sqlite, ndjson, object_pairs_hook = None):
+    """
+    Open 'filepath' as a SQLite database or import it into
+    a new 'sqlite' database. Returns the store or None.
+    """
+    if sqlite is None:
+        if not filepath.lower().endswith(SQLITE_EXTENSIONS):
+            return None
+
+        if not os.path.isfile(filepath):
+            raise ValueError('database not found: {}'.format(filepath))
+
+        return SQLiteStore(filepath, object_pairs_hook)
+
+    store = SQLiteStore(sqlite, object_pairs_hook)
+
+    if len(store) > 0:
+        raise ValueError('{} already has records, open it directly instead'.format(sqlite))
+
+    store.import_file(filepath, ndjson)
+    return store
+
+
+# Indexes:
+# Built on demand for a key in a list of records.
+# Indexes only narrow the records that can match,
+# the full pattern still runs on the candidates.
+
+def trigrams(text):
+    """
+    Return the set of 3 character substrings in 'text'.
+    """
+    return set(text[position : position + 3] for position in range(len(text) - 2))
+
+
+# hex digits after \x, \u and \U in regexes:
+REGEX_ESCAPE_LENGTHS = { 'x': 2, 'u': 4, 'U': 8 }
+
+
+def regex_literals(regex):
+    """
+    Return literal strings that appear in every string matching 'regex'.
+    Conservative: alternations and groups return no literals at all.
+    """
+    if '|' in regex or '(' in regex:
+        return []
+
+    literals = []
+    current = ''
+    position = 0
+
+    while position < len(regex):
+        char = regex[position]
+        position += 1
+
+        # escaped punctuation is a literal, classes (\d, \w...) are not:
+        if char == '\\':
+            escaped = regex[position : position + 1]
+            position += 1
+
+            if escaped and not escaped.isalnum():
+                current += escaped
+                continue
+
+            # skip the digits of \x41, \u0041, \U00000041, \N{...}, octals and backreferences:
+            if escaped in REGEX_ESCAPE_LENGTHS:
+                position += REGEX_ESCAPE_LENGTHS[escaped]
+
+            elif escaped == 'N' and regex[position : position + 1] == '{':
+                end = regex.find('}', position)
+                position = len(regex) if end == -1 else end + 1
+
+            elif escaped.isdigit():
+                while position < len(regex) and regex[position].isdigit():
+                    position += 1
+
+        # the previous character is optional:
+        elif char in '*?{':
+            current = current[:-1]
+
+            if char == '{':
+                end = regex.find('}', position)
+                position = len(regex) if end == -1 else end + 1
+
+        # skip character sets (a leading ] is part of the set):
+        elif char == '[':
+            if regex[position : position + 1] == '^':
+                position += 1
+
+            if regex[position : position + 1] == ']':
+                position += 1
+
+            while position < len(regex) and regex[position] != ']':
+                position += 2 if regex[position] == '\\' else 1
+
+            position += 1
+
+        elif not char in '.^$+':
+            current += char
+            continue
+
+        # end of the current literal:
+        if current:
+            literals.append(current)
+        current = ''
+
+    if current:
+        literals.append(current)
+
+    return literals
+
+
+class FieldIndex(object):
+    """
+    Index the values for a key in a list of records:
+        - Trigrams of string values (for regex and substring contain).
+        - Elements of list values (for contain and literal list patterns).
+    """
+    def __init__(self, data, key):
+        self.key = key
+
+        self.strings = set()
+        self.lists = set()
+        self.others = set()
+
+        self.trigrams = {}
+        self.elements = {}
+
+        for position, record in enumerate(data):
+            if not isinstance(record, Mapping) or not key in record:
+                continue
+
+            value = record[key]
+
+            if isinstance(value, str):
+                self.strings.add(position)
+
+                for trigram in trigrams(value):
+                    self.trigrams.setdefault(trigram, set()).add(position)
+
+            elif isinstance(value, list):
+                self.lists.add(position)
+
+                for element in value:
+                    try:
+                        self.elements.setdefault(element, set()).add(position)
+
+                    # lists and dicts can't be equal to a hashable value:
+                    except TypeError:
+                        pass
+
+            else:
+                self.others.add(position)
+
+    def strings_containing(self, literals):
+        """
+        Return the string records that contain all the literals.
+        """
+        candidates = self.strings
+
+        for literal in literals:
+            for trigram in trigrams(literal):
+                candidates = candidates & self.trigrams.get(trigram, set())
+
+        return candidates
+
+    def lists_containing(self, value):
+        """
+        Return the list records that contain a value.
+        """
+        try:
+            return self.elements.get(value, set())
+
+        # unhashable value, any list could contain it:
+        except TypeError:
+            return self.lists
+
+    def regex(self, regex):
+        """
+        Candidates for a regex constraint.
+        Values that are not strings are kept, so that errors are still raised.
+        """
+        return self.strings_containing(regex_literals(regex)) | self.lists | self.others
+
+    def contain(self, value):
+        """
+        Candidates for a contain constraint.
+        """
+        if isinstance(value, str):
+            strings = self.strings_containing([value])
+        else:
+            strings = self.strings
+
+        return strings | self.lists_containing(value) | self.others
+
+    def candidates(self, constraint):
+        """
+        Return the candidates for a constraint or None when
+        this index can't narrow them.
+        """
+        if isinstance(constraint, ConstraintRegex):
+            return self.regex(constraint.regex)
+
+        if isinstance(constraint, ConstraintContain):
+            return self.contain(constraint.value)
+
+        if isinstance(constraint, ConstraintNever):
+            return set()
+
+        # all: the constraints that can't be narrowed are left out:
+        if isinstance(constraint, ConstraintSuffixAll):
+            results = [self.candidates(it) for it in constraint.constraints]
+            results = [it for it in results if it is not None]
+
+            if len(results) == 0:
+                return None
+
+            return set.intersection(*results)
+
+        if isinstance(constraint, ConstraintSuffixAny):
+            results = [self.candidates(it) for it in constraint.constraints]
+
+            if len(results) == 0 or None in results:
+                return None
+
+            return set.union(*results)
+
+        return None
+
+    def list_pattern_candidates(self, matcher):
+        """
+        Candidates for a list pattern, e.g. ["chess", "basketball"].
+        Only literal elements are used.
+        """
+        candidates = None
+
+        for element in matcher.matchers:
+            if isinstance(element, MatchEqual):
+                current = self.lists_containing(element.value) & self.lists
+
+                if candidates is None:
+                    candidates = current
+                else:
+                    candidates = candidates & current
+
+        return candidates
+
+
+def index_candidates(indexes, matcher):
+    """
+    Return the positions of the records that can match a MatchDict
+    using the available indexes or None when no index can be used.
+    """
+    candidates = None
+
+    def narrow(current):
+        nonlocal candidates
+
+        if current is not None:
+            if candidates is None:
+                candidates = current
+            else:
+                candidates = candidates & current
+
+    for key, constraint in matcher.constraints:
+        if key in indexes:
+            narrow(indexes[key].candidates(constraint))
+
+    for key, submatcher in matcher.matchers:
+        if key in indexes and isinstance(submatcher, MatchList):
+            narrow(indexes[key].list_pattern_candidates(submatcher))
+
+    return candidates
+
+
+# Query refinement:
+# The shell remembers the records that matched the last few queries.
+# A query that provably matches a subset of the records of a previous one
+# (the same matchers plus more constraints or narrower ranges) only runs
+# on those records. The checks are conservative: when in doubt, all
+# the records are scanned.
+
+# number of previous queries to remember:
+REFINEMENTS = 4
+
+
+def same_node(a, b):
+    """
+    Compare two compiled nodes (or their values) structurally.
+    """
+    if a is b:
+        return True
+
+    if type(a) is not type(b):
+        return False
+
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(map(same_node, a, b))
+
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_node(a[key], b[key]) for key in a)
+
+    if hasattr(a, '__dict__'):
+        return same_node(vars(a), vars(b))
+
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def value_kind(value):
+    """
+    Return 'number' or 'string' for values that can be ordered, None otherwise.
+    """
+    if isinstance(value, str):
+        return 'string'
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+        return 'number'
+
+    return None
+
+
+def constraint_interval(constraint):
+    """
+    Return the values allowed by a comparison, range or equality
+    as (lower, lower_inclusive, upper, upper_inclusive) or None.
+    """
+    cls = type(constraint)
+
+    if cls is ConstraintMoreThan:
+        return constraint.value, False, None, False
+
+    if cls is ConstraintMoreOrEqualTo:
+        return constraint.value, True, None, False
+
+    if cls is ConstraintLessThan:
+        return None, False, constraint.value, False
+
+    if cls is ConstraintLessOrEqualTo:
+        return None, False, constraint.value, True
+
+    if cls is ConstraintRange:
+        return constraint.lower, constraint.lower_inclusive, constraint.upper, constraint.upper_inclusive
+
+    if cls is ConstraintEqualTo:
+        return constraint.value, True, constraint.value, True
+
+    return None
+
+
+def interval_within(new, old):
+    """
+    Test whether an interval is inside another one.
+    Bounds of different kinds (e.g. numbers and strings) are never inside.
+    """
+    new_lower, new_lower_inclusive, new_upper, new_upper_inclusive = new
+    old_lower, old_lower_inclusive, old_upper, old_upper_inclusive = old
+
+    kinds = set(value_kind(bound) for bound in (new_lower, new_upper, old_lower, old_upper) if bound is not None)
+
+    if len(kinds) != 1 or None in kinds:
+        return False
+
+    if old_lower is not None:
+        if new_lower is None or new_lower < old_lower:
+            return False
+
+        if new_lower == old_lower and new_lower_inclusive and not old_lower_inclusive:
+            return False
+
+    if old_upper is not None:
+        if new_upper is None or new_upper > old_upper:
+            return False
+
+        if new_upper == old_upper and new_upper_inclusive and not old_upper_inclusive:
+            return False
+
+    return True
+
+
+def constraint_values(constraint):
+    """
+    Return the only values allowed by an equality or "in" constraint or None.
+    """
+    if type(constraint) is ConstraintEqualTo:
+        return [constraint.value]
+
+    if type(constraint) is ConstraintIn and constraint.hashable is not None and len(constraint.unhashable) == 0:
+        return list(constraint.hashable)
+
+    return None
+
+
+def constraint_implies(new, old):
+    """
+    Test whether every value matching the 'new' constraint
+    also matches the 'old' one.
+    """
+    if type(new) is ConstraintNever or same_node(new, old):
+        return True
+
+    if type(old) is ConstraintSuffixAll:
+        return all(constraint_implies(new, it) for it in old.constraints)
+
+    if type(new) is ConstraintSuffixAll:
+        return any(constraint_implies(it, old) for it in new.constraints)
+
+    if type(old) is ConstraintSuffixAny:
+        return any(constraint_implies(new, it) for it in old.constraints)
+
+    values = constraint_values(new)
+
+    # every allowed value must be allowed by the old constraint:
+    if values is not None:
+        old_values = constraint_values(old)
+
+        if old_values is not None:
+            return all(value_kind(value) is not None and value in old_values for value in values)
+
+        old_interval = constraint_interval(old)
+
+        if old_interval is not None:
+            return all(interval_within((value, True, value, True), old_interval) for value in values)
+
+        return False
+
+    new_interval = constraint_interval(new)
+    old_interval = constraint_interval(old)
+
+    if new_interval is not None and old_interval is not None:
+        return interval_within(new_interval, old_interval)
+
+    return False
+
+
+def matcher_implies(new, old):
+    """
+    Test whether everything matching the 'new' matcher
+    also matches the 'old' one.
+    """
+    if getattr(new, 'unsatisfiable', False) or type(old) is MatchAny or same_node(new, old):
+        return True
+
+    if type(new) is not MatchDict or type(old) is not MatchDict or new.adapt != old.adapt:
+        return False
+
+    new_constraints = dict(new.constraints)
+    new_matchers = dict(new.matchers)
+
+    for key, constraint in old.constraints:
+        if key in new_constraints and constraint_implies(new_constraints[key], constraint):
+            continue
+
+        # literal values are equalities too:
+        if key in new_matchers and type(new_matchers[key]) is MatchEqual:
+            if constraint_implies(ConstraintEqualTo(new_matchers[key].value), constraint):
+                continue
+
+        return False
+
+    for key, matcher in old.matchers:
+
+        # the key just needs to be there:
+        if type(matcher) is MatchAny and (key in new_constraints or key in new_matchers):
+            continue
+
+        if key in new_matchers and matcher_implies(new_matchers[key], matcher):
+            continue
+
+        return False
+
+    return True
 
 
 # A simple read-eval-print-loop:
 
 class REPL(object):
 
-    def __init__(self, data, formatter):
+    def __init__(self, data, formatter, compiler = None, page_size = None, loader = None, timing = False):
         self.data = data
         self.formatter = formatter
+        self.compiler = compiler or Compiler()
+        self.indexes = {}
+
+        # (matcher, positions of the matched records) for previous queries,
+        # and (scanned, total, refined) for the last one:
+        self.refinements = []
+        self.scanned = None
+        self.timing = timing
+
+        # loading in the background? data is partial until done:
+        self.loader = loader
+        self.partial = False
+        self.refresh()
+
+        # show results in pages, (pattern, data, token) for :more:
+        self.page_size = page_size
+        self.cursor = None
 
-        self.intro = 'MQLite interactive shell (EOF to exit)'
+        self.intro = 'MQLite interactive shell (EOF to exit, :help for commands)'
         self.prompt = '>>> '
 
+        self.commands = {
+            'help'    : self.command_help,
+            'index'   : self.command_index,
+            'more'    : self.command_more,
+            'profile' : self.command_profile,
+            'sample'  : self.command_sample,
+            'wait'    : self.command_wait,
+        }
+
+    def refresh(self):
+        """
+        Use the records loaded so far by the background loader (if any).
+        """
+        if self.loader is None:
+            return
+
+        self.data, self.partial = self.loader.loaded()
+
+        if self.loader.done.is_set():
+            if self.loader.error is not None:
+                print('Error: loading stopped after {} records:'.format(len(self.data)), str(self.loader.error), file = sys.stderr)
+
+            self.loader = None
+
     def eval(self, text):
         """
         Parse and execute a given pattern against our data.
         """
-        return JSONPattern(text).match(self.data)
+        pattern = JSONPattern(text, self.compiler)
+        compiled = pattern.compiled()
+        data = self.data
+
+        self.cursor = None
+        self.scanned = None
+
+        paging = self.page_size is not None and pattern.pageable()
+
+        # a list of records and a single dict matcher can use indexes and previous results:
+        if (isinstance(self.data, list) and isinstance(compiled, MatchList)
+            and len(compiled.matchers) == 1 and isinstance(compiled.matchers[0], MatchDict)):
+
+            candidates, refined = self.candidates(compiled.matchers[0])
+            positions = range(len(self.data)) if candidates is None else candidates
+
+            if not paging:
+                self.scanned = (len(positions), len(self.data), refined)
+                return self.match_positions(pattern, positions)
+
+            if candidates is not None:
+                data = [self.data[position] for position in candidates]
+
+        # show the first page, :more continues where it stopped:
+        if paging and not isinstance(data, SQLiteStore):
+            self.cursor = (pattern, data, None)
+            return self.next_page()
+
+        # SQLite and NDJSON indexes only read the records that can match:
+        if isinstance(data, (SQLiteStore, NDJSONIndex)):
+            return data.match(pattern)
+
+        return pattern.match(data)
+
+    def candidates(self, matcher):
+        """
+        Return the sorted positions of the records that can match 'matcher'
+        (None for all of them) using the indexes and the previous queries,
+        and whether a previous query was used.
+        """
+        candidates = None
+        refined = False
+
+        if len(self.indexes) > 0:
+            found = index_candidates(self.indexes, matcher)
+
+            if found is not None:
+                candidates = sorted(found)
+
+        # the smallest superset wins:
+        for previous, positions in self.refinements:
+            if candidates is None or len(positions) < len(candidates):
+                if matcher_implies(matcher, previous):
+                    candidates = positions
+                    refined = True
+
+        return candidates, refined
+
+    def match_positions(self, pattern, positions):
+        """
+        Match a list pattern with a single dict against the records
+        at some positions, remembering which ones matched.
+        """
+        compiled = pattern.compiled()
+        matcher = compiled.matchers[0]
+        data = self.data
+
+        matched = []
+        complete = False
+
+        if getattr(matcher, 'unsatisfiable', False):
+            positions = ()
+
+        def results():
+            nonlocal complete
+
+            for position in positions:
+                current = matcher.match(data[position])
+
+                if current is not NoMatch:
+                    matched.append(position)
+                    yield current
+
+            complete = True
+
+        pattern.start_limits()
+
+        if compiled.limits is not None:
+            compiled.limits.tick(len(positions))
+
+        result = list(compiled.apply_directives(matcher, results()))
+
+        # directives can stop early (e.g. __limit__), matching everything doesn't help:
+        if complete and not self.partial and len(matched) < len(data):
+            self.refinements.insert(0, (matcher, matched))
+            del self.refinements[REFINEMENTS:]
+
+        if len(result) == 0:
+            return NoMatch
+
+        return result
+
+    def next_page(self):
+        """
+        Return the next page of results for the last pattern.
+        """
+        pattern, data, token = self.cursor
+
+        if isinstance(data, NDJSONIndex):
+            results, token = data.page(pattern, self.page_size, token)
+        else:
+            results, token = pattern.page(data, self.page_size, token)
+
+        self.cursor = None
+        if token is not None:
+            self.cursor = (pattern, data, token)
+
+        if len(results) == 0:
+            return NoMatch
+
+        return results
+
+    def command(self, line):
+        """
+        Execute a shell command, e.g. ":index name".
+        """
+        name, _, arguments = line[1:].partition(' ')
+
+        if not name in self.commands:
+            raise ValueError('unknown command, try :help')
+
+        self.commands[name](arguments.strip())
+
+    def command_help(self, arguments):
+        """
+        :help - show the available commands.
+        """
+        for name, command in sorted(self.commands.items()):
+            print(command.__doc__.strip().split('\n')[0])
+
+    def command_index(self, arguments):
+        """
+        :index [key ...] - index keys for regex and contain (SQLite and --index: comparisons), list indexed keys.
+        """
+        if isinstance(self.data, SQLiteStore):
+            for key in arguments.split():
+                self.data.index(key)
+                self.indexes[key] = None
+
+        # block statistics, including the ones already in the index file:
+        elif isinstance(self.data, NDJSONIndex):
+            for key in arguments.split():
+                self.data.index(key)
+
+            self.indexes = dict.fromkeys(self.data.stats)
+
+        elif self.partial:
+            raise ValueError('the input is not completely loaded, try :wait')
+
+        elif not isinstance(self.data, list):
+            raise ValueError('only lists of records can be indexed')
+
+        else:
+            for key in arguments.split():
+                self.indexes[key] = FieldIndex(self.data, key)
+
+        print('Indexed keys:', ', '.join(sorted(self.indexes)) or 'none')
+
+    def command_more(self, arguments):
+        """
+        :more - show the next page of results (see --page-size).
+        """
+        if self.cursor is None:
+            raise ValueError('no more results')
+
+        self.print_result(self.next_page())
+
+    def command_profile(self, arguments):
+        """
+        :profile pattern - print the memory used by each phase of a query, as JSON.
+        """
+        if isinstance(self.data, (SQLiteStore, NDJSONIndex)):
+            raise ValueError('profiling is not available for SQLite databases and indexed files')
+
+        profile = MemoryProfile()
+        profile.start()
+
+        try:
+            with profile.phase('compile'):
+                pattern = JSONPattern(arguments, self.compiler)
+
+            result = profile.match(pattern, self.data)
+
+            with profile.phase('serialize'):
+                text = '' if result is NoMatch else self.formatter.dump(result)
+
+            del result, text
+
+        finally:
+            profile.stop()
+
+        print(json.dumps(profile.report()))
+
+    def command_sample(self, arguments):
+        """
+        :sample n [seed] - show n random records (with --index, only those are read).
+        """
+        import random
+
+        arguments = [int(argument) for argument in arguments.split()]
+
+        if not 1 <= len(arguments) <= 2 or arguments[0] < 0:
+            raise ValueError('usage: :sample n [seed]')
+
+        size, seed = arguments[0], (arguments[1:] or [None])[0]
+
+        if isinstance(self.data, NDJSONIndex):
+            records = self.data.sample(size, seed)
+
+        elif isinstance(self.data, list):
+            chosen = random.Random(seed).sample(range(len(self.data)), min(size, len(self.data)))
+            records = [self.data[position] for position in sorted(chosen)]
+
+        else:
+            raise ValueError('only lists of records can be sampled')
+
+        self.print_json(records)
+        print('')
+
+    def command_wait(self, arguments):
+        """
+        :wait - wait until the input is completely loaded.
+        """
+        if self.loader is not None:
+            self.loader.wait()
+            self.refresh()
+
+        if isinstance(self.data, list):
+            print('Loaded {} records.'.format(len(self.data)))
 
     def print_json(self, jsondata):
         """
@@ -71,23 +916,68 @@ class REPL(object):
         """
         self.formatter.stdout(jsondata)
 
+    def print_result(self, result):
+        """
+        Print a result (if any) and whether there are more pages.
+        """
+        if not result is NoMatch:
+            self.print_json(result)
+            print('')
+
+        if self.cursor is not None:
+            print('(more results: :more)')
+
+        if self.partial:
+            print('(partial results: {} records loaded{})'.format(len(self.data), ', :wait to load the rest' if self.loader else ''))
+
+    def print_timing(self, elapsed):
+        """
+        Print the time used by the last query and the records it scanned.
+        """
+        if self.scanned is None:
+            print('(time: {:.2f} ms)'.format(elapsed * 1000))
+            return
+
+        scanned, total, refined = self.scanned
+        print('(time: {:.2f} ms, scanned {} of {} records{})'.format(
+            elapsed * 1000, scanned, total, ', refining a previous query' if refined else ''))
+
+    def current_prompt(self):
+        """
+        The prompt, with the loading progress when loading.
+        """
+        if self.loader is not None:
+            return '[{} loaded] {}'.format(len(self.loader.records), self.prompt)
+
+        return self.prompt
+
     def run(self):
         """
         Start the read-eval-print-loop.
         """
         print(self.intro)
 
+        if self.loader is not None:
+            print('Loading in the background, queries use the records loaded so far (:wait to load everything).')
+
         while True:
             # evaluate one line:
             try:
-                line = input(self.prompt)
+                line = input(self.current_prompt())
+                self.refresh()
 
-                if line:
+                if line.startswith(':'):
+                    self.command(line)
+
+                elif line:
+                    started = time.perf_counter()
                     result = self.eval(line)
+                    elapsed = time.perf_counter() - started
+
+                    self.print_result(result)
 
-                    if not result is NoMatch:
-                        self.print_json(result)
-                        print('')
+                    if self.timing:
+                        self.print_timing(elapsed)
 
             # CONTROL + Z: exit
             except EOFError:
@@ -112,9 +1002,56 @@ def make_parser():
 
     # required:
     parser.add_argument('filepath',
-        help = 'JSON file to use as input data on the REPL',
+        help = 'JSON file (may be compressed) or SQLite database (.db, .sqlite) to use as input data on the REPL',
         metavar = 'filepath')
 
+    # same memory options as in MQLite itself:
+    input_format = parser.add_argument_group('input and memory usage')
+
+    input_format.add_argument('--ndjson',
+        help = 'read the file as newline-delimited JSON',
+        action = 'store_true')
+
+    input_format.add_argument('--sqlite',
+        help = 'import the file into a new SQLite database DB and query it there',
+        metavar = 'DB')
+
+    input_format.add_argument('--index',
+        help = 'with --ndjson, read records on demand using an offset index stored in FILEPATH.mqindex',
+        action = 'store_true')
+
+    input_format.add_argument('--dataset',
+        help = 'also load PATH (JSON list or, with --ndjson, records) as NAME for __join__ (can be repeated)',
+        metavar = 'NAME=PATH',
+        action = 'append',
+        default = [])
+
+    input_format.add_argument('--wait',
+        help = 'load the file completely before showing the prompt (the default when not interactive)',
+        action = 'store_true')
+
+    input_format.add_argument('--compact',
+        help = 'share keys and short strings between records to save memory',
+        action = 'store_true')
+
+    input_format.add_argument('--rows',
+        help = 'store records with the same keys as tuple-backed rows (implies --compact)',
+        action = 'store_true')
+
+    input_format.add_argument('--views',
+        help = 'return results as read-only views of the records instead of copies',
+        action = 'store_true')
+
+    input_format.add_argument('--timeout',
+        help = 'stop queries that take more than N seconds',
+        metavar = 'N',
+        type = float)
+
+    input_format.add_argument('--max-steps',
+        help = 'stop queries after evaluating N dicts or list elements',
+        metavar = 'N',
+        type = int)
+
     # same output options as in MQLite itself
     # except that the REPL always uses os.linesep:
     output_format = parser.add_argument_group('output format')
@@ -133,6 +1070,15 @@ def make_parser():
         help = 'sort dictionaries by key before printing',
         action = 'store_true')
 
+    output_format.add_argument('--timing',
+        help = 'print the time used by each query and the number of records scanned',
+        action = 'store_true')
+
+    output_format.add_argument('--page-size',
+        help = 'show N results at a time for list patterns with a single matcher, :more shows the next ones',
+        metavar = 'N',
+        type = int)
+
     return parser
 
 
@@ -146,19 +1092,76 @@ def main():
     if options.indent < 0:
         indent = None
 
+    loader = None
+    if options.compact or options.rows:
+        loader = CompactLoader(rows = options.rows)
+
+    # load the input file in the background when interactive:
+    background = sys.stdin.isatty() and not options.wait
+
     # read the input file:
     jsondata = None
 
+    if options.index and not options.ndjson:
+        parser.error('--index requires --ndjson')
+
     try:
-        jsondata = read_json_file(options.filepath)
+        if options.index:
+            jsondata = NDJSONIndex(options.filepath, object_pairs_hook = loader)
+        else:
+            jsondata = open_sqlite_store(options.filepath, options.sqlite, options.ndjson, loader)
+
+        # fail early when it can't be opened:
+        if jsondata is None and background:
+            open(options.filepath, 'rb').close()
+
+        elif jsondata is None and options.ndjson:
+            jsondata = read_ndjson_file(options.filepath, loader)
+
+        elif jsondata is None:
+            jsondata = read_json_file(options.filepath, loader)
 
     except Exception as err:
         errln(str(err))
         sys.exit(1)
 
+    # named datasets for __join__:
+    datasets = {}
+
+    for argument in options.dataset:
+        name, separator, filepath = argument.partition('=')
+
+        if not name or not separator or not filepath:
+            parser.error('--dataset: expected NAME=PATH')
+
+        try:
+            if options.ndjson:
+                datasets[name] = read_ndjson_file(filepath, loader)
+            else:
+                datasets[name] = read_json_file(filepath, loader)
+
+        except Exception as err:
+            errln('{}: {}'.format(filepath, err))
+            sys.exit(1)
+
+        if not isinstance(datasets[name], list):
+            errln('{}: datasets must be lists of records'.format(filepath))
+            sys.exit(1)
+
+    limits = None
+    if options.timeout is not None or options.max_steps is not None:
+        limits = Limits(options.timeout, options.max_steps)
+
+    # datasets are loaded first, they share the CompactLoader:
+    background_loader = None
+    if jsondata is None:
+        background_loader = BackgroundLoader(options.filepath, options.ndjson, loader)
+
     # start the repl:
     formatter = JSONFormatter(options.ascii, indent, options.sort_keys, os.linesep)
-    repl = REPL(jsondata, formatter)
+    compiler = Compiler(limits = limits, views = options.views, datasets = datasets)
+
+    repl = REPL(jsondata, formatter, compiler, options.page_size, background_loader, options.timing)
     repl.run()
 
 
@@ -4,7 +4,7 @@ from setuptools import setup
 
 setup(
     name = 'MQLite',
-    version = '2016.02.02',
+    version = '2026.10.18',
     url = 'https://github.com/Beluki/MQLite',
     license = 'See Documentation/License',
     author = 'Beluki',
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+MQBench.
+Benchmarks for MQLite.
+"""
+
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Information and error messages:
+
+def outln(line):
+    """ Write 'line' to stdout, using the platform encoding and newline format. """
+    print(line, flush = True)
+
+
+def errln(line):
+    """ Write 'line' to stderr, using the platform encoding and newline format. """
+    print('MQBench.py: error:', line, file = sys.stderr, flush = True)
+
+
+# Non-builtin imports:
+
+try:
+    import MQLite
+
+except ImportError:
+    errln('MQBench requires the following modules:')
+    errln('MQLite 2026.10.18+ - <https://github.com/Beluki/MQLite>')
+    sys.exit(1)
+
+
+# Utils:
+
+def timeit(function, repeat):
+    """
+    Call 'function' 'repeat' times, return the best time in milliseconds.
+    """
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def report(name, milliseconds):
+    outln('{:<50} {:>10.2f} ms'.format(name, milliseconds))
+
+
+# Benchmarks:
+
+def bench_startup(repeat = 20):
+    """
+    Time complete MQLite.py runs with a tiny input.
+    """
+    script = MQLite.__file__
+    directory = os.path.dirname(os.path.abspath(script))
+    pattern = '[{ "name": null, "name regex": "^A" }]'
+
+    # plans are only worth caching for big patterns:
+    # (regular expressions are compiled again when loading a plan)
+    big = { 'k{}'.format(n): None for n in range(1500) }
+    big.update({ 'k{} in any'.format(n): [[n], [n + 1]] for n in range(1500) })
+    big_pattern = json.dumps([big])
+    stdin = b'[{ "name": "Anna" }]'
+
+    def run(arguments, environment = None):
+        env = dict(os.environ, PYTHONPATH = directory)
+        env.update(environment or {})
+
+        return lambda: subprocess.run([sys.executable] + arguments,
+            input = stdin, stdout = subprocess.DEVNULL, env = env, check = True)
+
+    with tempfile.TemporaryDirectory() as cache:
+        cases = [
+            ('startup: python -c pass (baseline)', run(['-c', 'pass'])),
+            ('startup: MQLite.py', run([script, pattern])),
+            ('startup: python -m MQLite', run(['-m', 'MQLite', pattern])),
+            ('startup: python -m MQLite, plan cache', run(['-m', 'MQLite', pattern], { 'MQLITE_CACHE_DIR': cache })),
+            ('startup: big pattern', run(['-m', 'MQLite', big_pattern])),
+            ('startup: big pattern, plan cache', run(['-m', 'MQLite', big_pattern], { 'MQLITE_CACHE_DIR': cache })),
+        ]
+
+        for name, function in cases:
+            report(name, timeit(function, repeat))
+
+
+def bench_parallel(repeat = 3, workers = 4):
+    """
+    Compare matching a big list with threads and processes.
+    Threads only run in parallel on free-threaded Python builds.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    data = [{ 'id': n, 'name': 'name{}'.format(n), 'tags': ['a', 'b', str(n % 7)] } for n in range(200000)]
+    pattern = MQLite.Pattern([{ 'id': None, 'name regex': '^name[0-9]*7$', 'tags contain': '3', 'id >': 1000 }])
+
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    report('parallel: sequential match (GIL {})'.format('on' if gil else 'off'), timeit(lambda: pattern.match(data), repeat))
+
+    with ThreadPoolExecutor(workers) as executor:
+        report('parallel: {} threads'.format(workers), timeit(lambda: pattern.match_parallel(data, executor), repeat))
+
+    with ProcessPoolExecutor(workers) as executor:
+        report('parallel: {} processes'.format(workers), timeit(lambda: pattern.match_parallel(data, executor), repeat))
+
+
+def bench_compressed(repeat = 3):
+    """
+    Compare streaming NDJSON from plain and compressed files.
+    Decompression runs in a background thread, so with more than one core
+    the compressed times should approach the slowest of both stages.
+    """
+    import bz2
+    import gzip
+    import lzma
+
+    records = [{ 'id': n, 'name': 'name{}'.format(n), 'tags': ['a', 'b', str(n % 7)] } for n in range(200000)]
+    content = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+    pattern = MQLite.Pattern([{ 'id': None, 'name regex': '^name[0-9]*7$' }])
+
+    def stream(filepath):
+        with MQLite.open_binary_input(filepath) as source:
+            return pattern.stream_count(MQLite.binary_read_ndjson(source))
+
+    def decompress(filepath):
+        with MQLite.open_binary_input(filepath) as source:
+            while source.read(2 ** 16):
+                pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        compressors = [('plain', lambda data: data), ('gzip', gzip.compress), ('bz2', bz2.compress), ('xz', lzma.compress)]
+
+        for name, compress in compressors:
+            filepath = os.path.join(directory, 'records.' + name)
+
+            with open(filepath, 'wb') as descriptor:
+                descriptor.write(compress(content))
+
+            if name != 'plain':
+                report('compressed: {}, decompress only'.format(name), timeit(lambda: decompress(filepath), repeat))
+
+            report('compressed: {}, --ndjson stream'.format(name), timeit(lambda: stream(filepath), repeat))
+
+
+def bench_pipeline(repeat = 3):
+    """
+    Compare --ndjson runs with and without stages.
+    """
+    script = MQLite.__file__
+    pattern = '[{ "id": null, "name regex": "^name[0-9]*7$" }]'
+
+    records = [{ 'id': n, 'name': 'name{}'.format(n), 'tags': ['a', 'b', str(n % 7)] } for n in range(200000)]
+    content = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+    def run(arguments):
+        return lambda: subprocess.run([sys.executable, script, pattern, '--ndjson'] + arguments,
+            input = content, stdout = subprocess.DEVNULL, check = True)
+
+    cases = [
+        ('pipeline: sequential', run([])),
+        ('pipeline: stages', run(['--queue-depth', '8'])),
+        ('pipeline: stages, 4 decoders', run(['--queue-depth', '8', '--workers', '4'])),
+    ]
+
+    for name, function in cases:
+        report(name, timeit(function, repeat))
+
+
+def bench_deep(repeat = 3):
+    """
+    Compare the recursive and the iterative evaluators on deeply nested data.
+    Recursive matching also uses the C stack, so it can't go much deeper
+    than the default recursion limit, even when raising it.
+    """
+    def nested(depth, leaf, wrap):
+        for _ in range(depth):
+            leaf = wrap(leaf)
+
+        return leaf
+
+    for depth in (10, 50, 150):
+        pattern = MQLite.Pattern(nested(depth, [{ 'name': None }], lambda pattern: [{ 'child': pattern, 'id >': 0 }]))
+
+        # a sibling on each level that doesn't match:
+        leaf = [{ 'name': 'leaf{}'.format(n) } for n in range(4)]
+        data = [nested(depth, leaf, lambda data: [{ 'child': data, 'id': 1 }, { 'id': 2 }]) for _ in range(20000 // depth)]
+
+        report('deep: depth {}, recursive'.format(depth), timeit(lambda: [pattern.match(it) for it in data], repeat))
+        report('deep: depth {}, iterative'.format(depth), timeit(lambda: [pattern.match_iterative(it) for it in data], repeat))
+
+    # compiling only uses Python frames, a higher limit is enough:
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+
+    try:
+        depth = 10000
+        pattern = MQLite.Pattern(nested(depth, [{ 'name': None }], lambda pattern: [{ 'child': pattern }]))
+        data = nested(depth, [{ 'name': 'leaf' }], lambda data: [{ 'child': data, 'id': 1 }])
+
+        report('deep: depth {}, iterative'.format(depth), timeit(lambda: pattern.match_iterative(data), repeat))
+
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def bench_paging(repeat = 3, size = 100):
+    """
+    Compare reading all the results in pages using __offset__
+    (every page matches the records before it again) and page tokens
+    (every page resumes where the previous one stopped).
+    """
+    data = [{ 'id': n, 'name': 'name{}'.format(n) } for n in range(20000)]
+    pattern = MQLite.Pattern([{ 'id': None, 'name regex': '.*[02468]$' }])
+    total = pattern.count(data)
+
+    def offsets():
+        for offset in range(0, total, size):
+            MQLite.Pattern([{ 'id': None, 'name regex': '.*[02468]$', '__offset__': offset, '__limit__': size }]).match(data)
+
+    def tokens():
+        page, token = pattern.page(data, size)
+
+        while token is not None:
+            page, token = pattern.page(data, size, token)
+
+    report('paging: {} pages, __offset__'.format(total // size), timeit(offsets, repeat))
+    report('paging: {} pages, tokens'.format(total // size), timeit(tokens, repeat))
+
+
+def bench_views(repeat = 3):
+    """
+    Compare copying results to new dicts with returning views,
+    for a pattern that selects every key ("*": "*").
+    """
+    import tracemalloc
+
+    data = [{ 'key{}'.format(key): n for key in range(20) } for n in range(50000)]
+    pattern = [{ 'key0': None, 'key1 >=': 0, '*': '*' }]
+
+    for name, compiler in (('copies', MQLite.Compiler()), ('views', MQLite.Compiler(views = True))):
+        compiled = MQLite.Pattern(pattern, compiler)
+        formatter = MQLite.JSONFormatter(False, None, False, '\n')
+
+        report('views: match, {}'.format(name), timeit(lambda: compiled.match(data), repeat))
+        report('views: match and serialize, {}'.format(name), timeit(lambda: formatter.dump(compiled.match(data)), repeat))
+
+        tracemalloc.start()
+        results = compiled.match(data)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del results
+
+        outln('{:<50} {:>10.2f} MB'.format('views: results memory, {}'.format(name), current / 2**20))
+
+
+def bench_pattern_set(repeat = 3):
+    """
+    Compare matching events against 5000 patterns one by one
+    and with a PatternSet.
+    """
+    import random
+
+    generator = random.Random(1)
+    services = ['service{}'.format(n) for n in range(200)]
+
+    patterns = []
+    for n in range(5000):
+        kind = n % 3
+
+        if kind == 0:
+            patterns.append({ 'service': generator.choice(services), 'level >=': generator.randint(1, 5) })
+        elif kind == 1:
+            lower = generator.randint(0, 990)
+            patterns.append({ 'latency >': lower, 'latency <=': lower + 10, 'service': None })
+        else:
+            patterns.append({ 'user{}'.format(n % 50): None, 'level ==': generator.randint(1, 5) })
+
+    events = [{ 'service': generator.choice(services), 'level': generator.randint(1, 5),
+                'latency': generator.uniform(0, 1000), 'user{}'.format(n % 500): 'x' } for n in range(200)]
+
+    compiled = [MQLite.Pattern(pattern) for pattern in patterns]
+    pattern_set = MQLite.PatternSet()
+
+    for position, pattern in enumerate(compiled):
+        pattern_set.add(position, pattern)
+
+    def one_by_one():
+        for event in events:
+            [position for position, pattern in enumerate(compiled) if pattern.exists(event)]
+
+    def indexed():
+        for event in events:
+            pattern_set.match(event)
+
+    report('pattern set: 200 events, one by one', timeit(one_by_one, repeat))
+    report('pattern set: 200 events, PatternSet', timeit(indexed, repeat))
+
+
+def bench_join(repeat = 3):
+    """
+    Compare joining users and orders with __join__ and with
+    a loop over the orders for every user.
+    """
+    users = [{ 'id': n, 'name': 'user{}'.format(n) } for n in range(2000)]
+    orders = [{ 'user': n % 2500, 'item': 'item{}'.format(n), 'price': n % 100 } for n in range(10000)]
+
+    compiler = MQLite.Compiler(datasets = { 'orders': orders })
+    pattern = MQLite.Pattern([{ 'id': None, 'name': None,
+        '__join__': { 'with': 'orders', 'on': 'id', 'to': 'user', 'pattern': { 'item': None, 'price >': 50 } } }], compiler)
+
+    order_pattern = MQLite.Pattern([{ 'user': None, 'item': None, 'price >': 50 }])
+
+    def nested_loop():
+        results = []
+        matched = order_pattern.match(orders)
+
+        for user in users:
+            matches = [{ 'item': order['item'] } for order in matched if order['user'] == user['id']]
+
+            if len(matches) > 0:
+                results.append(dict(user, orders = matches))
+
+        return results
+
+    report('join: 2000 users, 10000 orders, __join__', timeit(lambda: pattern.match(users), repeat))
+    report('join: 2000 users, 10000 orders, nested loop', timeit(nested_loop, 1))
+
+
+def bench_incremental(repeat = 3):
+    """
+    Compare parsing a JSON list at once and incrementally
+    (as MQLiteSH does in the background): time to the first
+    record and to the last one.
+    """
+    import io
+
+    data = [{ 'id': n, 'name': 'name{}'.format(n), 'tags': ['a', 'b'] } for n in range(200000)]
+    content = json.dumps(data).encode('utf-8')
+
+    def first():
+        return next(MQLite.binary_read_json_list(io.BytesIO(content)))
+
+    report('incremental: json.loads, all records', timeit(lambda: json.loads(MQLite.binary_read_utf8(io.BytesIO(content))), repeat))
+    report('incremental: incremental, all records', timeit(lambda: list(MQLite.binary_read_json_list(io.BytesIO(content))), repeat))
+    report('incremental: incremental, first record', timeit(first, repeat))
+
+
+def bench_index(repeat = 3):
+    """
+    Compare streaming a NDJSON file with reading it through an offset
+    index: a selective query on an indexed key, a page and a sample.
+    """
+    records = [{ 'id': n, 'name': 'name{}'.format(n), 'timestamp': 1600000000 + n } for n in range(200000)]
+    content = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+    pattern = MQLite.Pattern([{ 'id': None, 'timestamp >=': 1600199000 }])
+
+    def stream(filepath):
+        with MQLite.open_binary_input(filepath) as source:
+            return pattern.stream_count(MQLite.binary_read_ndjson(source))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'records.ndjson')
+
+        with open(filepath, 'wb') as descriptor:
+            descriptor.write(content)
+
+        report('index: --ndjson stream', timeit(lambda: stream(filepath), repeat))
+        report('index: build, no statistics', timeit(lambda: MQLite.NDJSONIndex(filepath).close(), 1))
+        report('index: build, timestamp statistics', timeit(lambda: MQLite.NDJSONIndex(filepath, ['timestamp']).close(), 1))
+        report('index: open existing index', timeit(lambda: MQLite.NDJSONIndex(filepath).close(), repeat))
+
+        index = MQLite.NDJSONIndex(filepath)
+
+        report('index: query, skipping blocks', timeit(lambda: index.match(pattern), repeat))
+        report('index: first page of 100', timeit(lambda: index.page(pattern, 100), repeat))
+        report('index: sample of 100', timeit(lambda: index.sample(100), repeat))
+
+        index.close()
+
+
+def bench_refinement(repeat = 3):
+    """
+    Compare refining a query in MQLiteSH (adding a constraint)
+    with and without reusing the records matched by the previous one.
+    """
+    import MQLiteSH
+
+    records = [{ 'id': n, 'name': 'name{}'.format(n), 'age': n % 90, 'student': n % 3 == 0 } for n in range(200000)]
+    formatter = MQLite.JSONFormatter(False, None, False, '\n')
+
+    first = '[{ "id": null, "age >": 80 }]'
+    refined = '[{ "id": null, "age >": 85, "student": true }]'
+
+    repl = MQLiteSH.REPL(records, formatter)
+    repl.eval(first)
+    previous = list(repl.refinements)
+
+    def refine(reuse):
+        repl.refinements = list(previous) if reuse else []
+        return repl.eval(refined)
+
+    report('refinement: first query', timeit(lambda: MQLiteSH.REPL(records, formatter).eval(first), repeat))
+    report('refinement: refined query, scanning everything', timeit(lambda: refine(False), repeat))
+    report('refinement: refined query, reusing candidates', timeit(lambda: refine(True), repeat))
+
+
+# Run the benchmarks:
+
+def main():
+    benchmarks = [value for key, value in sorted(globals().items()) if key.startswith('bench_')]
+
+    # run only some benchmarks, e.g.: MQBench.py startup parallel
+    names = sys.argv[1:]
+
+    for benchmark in benchmarks:
+        if not names or benchmark.__name__[len('bench_'):] in names:
+            benchmark()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
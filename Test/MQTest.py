@@ -8,8 +8,18 @@ A test suite for MQLite.
 """
 
 
+import asyncio
+import bz2
 import collections
+import dataclasses
+import io
+import json
+import os
 import sys
+import tempfile
+import types
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Information and error messages:
@@ -27,11 +37,17 @@ def errln(line):
 # Non-builtin imports:
 
 try:
-    from MQLite import NoMatch, Pattern
+    from MQLite import (
+        Compiler, CompactLoader, JSONFormatter, JSONPattern, LimitException, Limits, MemoryProfile, NDJSONIndex, NoMatch, PageTokenException, Pattern, PatternSet,
+        Pipeline, PlanCache, SQLiteStore,
+        binary_read_json_list, binary_read_utf8, decode_page_token, match_batch, page_digest, wrap_binary_input,
+    )
+
+    from MQLiteSH import REPL, FieldIndex, matcher_implies, regex_literals
 
 except ImportError:
     errln('MQTest requires the following modules:')
-    errln('MQLite 2015.04.04+ - <https://github.com/Beluki/MQLite>')
+    errln('MQLite 2026.10.18+ - <https://github.com/Beluki/MQLite>')
     sys.exit(1)
 
 
@@ -229,6 +245,967 @@ class Test22(object):
     pattern = [pattern]
     result = [{"age": 35}, {"age": 25}, {"age": 23}]
 
+class Test23(object):
+    """
+    __sort__ + __order__ spilling sorted runs to disk.
+    """
+    pattern = collections.OrderedDict(name = None, age = None)
+    pattern["__sort__"] = "age"
+    pattern["__order__"] = "reverse"
+
+    pattern = [pattern]
+    compiler = Compiler(sort_buffer = 1)
+    result = [{"name": "John", "age": 35}, {"name": "Anna", "age": 25}, {"name": "James", "age": 23}]
+
+class Test24(object):
+    """
+    __sort__ + __limit__ bigger than the sort buffer.
+    """
+    pattern = collections.OrderedDict(age = None)
+    pattern["__sort__"] = "age"
+    pattern["__limit__"] = 2
+
+    pattern = [pattern]
+    compiler = Compiler(sort_buffer = 1)
+    result = [{"age": 23}, {"age": 25}]
+
+
+class Test25(object):
+    """
+    __count__ + __sum__ + __min__ + __max__.
+    """
+    pattern = [{ "age": None, "student": True, "__count__": True, "__sum__": "age", "__min__": "age", "__max__": ["age", "name"] }]
+    result = [{"count": 2, "age sum": 60, "age min": 25, "age max": 35, "name max": None}]
+
+class Test26(object):
+    """
+    __group__ + __count__, always a summary without __group__.
+    """
+    pattern = [{ "student": None, "__group__": "student", "__count__": True }, { "age >": 99, "__count__": True }]
+    result = [{"student": True, "count": 2}, {"student": False, "count": 1}, {"count": 0}]
+
+
+class Test27(object):
+    """
+    Matching compact tuple-backed rows.
+    """
+    data = json.loads(json.dumps(DATA), object_pairs_hook = CompactLoader(rows = True))
+    pattern = [{ "name": None, "age >": 24, "grades": None, "hobbies contain": "chess" }]
+    result = [{"name": "Anna", "grades": {"chemistry": "A", "math": "C"}}]
+
+
+class Test28(object):
+    """
+    Constraint match uses the matchers test without building results.
+    """
+    pattern = [{ "name": None, "hobbies match": ["reading", "painting"], "grades not match": { "math": None } }]
+    result = [{"name": "John"}]
+
+
+class Test29(object):
+    """
+    Records missing required keys are rejected using their shape.
+    """
+    data = json.loads(json.dumps(DATA), object_pairs_hook = CompactLoader())
+    pattern = [{ "name": None, "grades": { "english": None }, "age >": 20 }]
+    result = [{"name": "John", "grades": {"english": "A"}}]
+
+
+class Test30(object):
+    """
+    __sample__ with a seed bigger than the results.
+    """
+    pattern = [{ "name": None, "age <": 30, "__sample__": { "size": 5, "seed": 1 }, "__sort__": "name" }]
+    result = [{"name": "Anna"}, {"name": "James"}]
+
+class Test31(object):
+    """
+    __sample__ takes N results.
+    """
+    pattern = [{ "name": None, "__sample__": { "size": 2, "seed": "qa" }, "__count__": True }]
+    result = [{"count": 2}]
+
+
+class Test32(object):
+    """
+    Limits that are not exceeded don't change results.
+    """
+    pattern = [{ "name": None, "hobbies match": ["chess"], "age <": 30 }]
+    compiler = Compiler(limits = Limits(timeout = 60, max_steps = 100))
+    result = [{"name": "Anna"}, {"name": "James"}]
+
+class Test33(object):
+    """
+    Exceeding the step limit raises LimitException.
+    """
+    pattern = [{ "name": None, "hobbies match": ["chess"] }]
+    compiler = Compiler(limits = Limits(max_steps = 5))
+    result = LimitException
+
+
+class Test34(object):
+    """
+    Compressed input is detected and decompressed.
+    """
+    pattern = [{ "name": None, "age >": 30 }]
+    data = json.loads(binary_read_utf8(wrap_binary_input(io.BytesIO(bz2.compress(json.dumps(DATA).encode('utf-8'))))))
+    result = [{"name": "John"}]
+
+
+@dataclasses.dataclass
+class Person(object):
+    name: str
+    age: int
+    hobbies: tuple
+
+class Grades(object):
+    __slots__ = ('chemistry', 'math')
+
+    def __init__(self, **grades):
+        for key, value in grades.items():
+            setattr(self, key, value)
+
+Hobby = collections.namedtuple('Hobby', ['name', 'outdoors'])
+
+
+class Test35(object):
+    """
+    Adapters match dataclasses and tuples.
+    """
+    pattern = [{ "name": None, "age >": 24, "hobbies": ["chess"] }]
+    compiler = Compiler(adapt = True)
+    data = (Person("Anna", 25, ("reading", "chess")), Person("James", 23, ("chess",)), Person("John", 35, ()))
+    result = [{"name": "Anna", "hobbies": ["chess"]}]
+
+class Test36(object):
+    """
+    Adapters match namedtuples, __slots__ (unset slots are missing keys) and mappings.
+    """
+    pattern = [{ "name": None, "grades": { "chemistry": "A", "*": "*" }, "hobby": { "outdoors": True, "name": None } }]
+    compiler = Compiler(adapt = True)
+    data = [
+        types.MappingProxyType({ "name": "Anna", "grades": Grades(chemistry = "A", math = "C"), "hobby": Hobby("swimming", True) }),
+        types.MappingProxyType({ "name": "John", "grades": Grades(chemistry = "A"), "hobby": Hobby("reading", False) }),
+        types.MappingProxyType({ "name": "Mary", "grades": Grades(chemistry = "A"), "hobby": Hobby("hiking", True) }),
+    ]
+    result = [{"name": "Anna", "grades": {"chemistry": "A", "math": "C"}, "hobby": {"name": "swimming", "outdoors": True}},
+              {"name": "Mary", "grades": {"chemistry": "A"}, "hobby": {"name": "hiking", "outdoors": True}}]
+
+class Test37(object):
+    """
+    Without adapters, only dicts and lists match.
+    """
+    pattern = [{ "name": None }]
+    data = (Person("Anna", 25, ()),)
+    result = NoMatch
+
+
+
+def sqlite_store():
+    """
+    Return a SQLite store in memory with DATA and an index for "age".
+    """
+    store = SQLiteStore(':memory:')
+    store.insert(DATA)
+    store.index('age')
+    return store
+
+class Test38(object):
+    """
+    SQLite pushdown: comparisons, equality, in and is.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "age >": 20, "age in": [23, 25, 35], "student is": "bool", "grades": { "chemistry": "A" } }])
+        matcher = pattern.compiled().matchers[0]
+        store = sqlite_store()
+
+        sql, parameters = store.where(matcher)
+
+        assert """json_extract(data, '$."age"') IN (?, ?, ?)""" in sql, sql
+        assert """json_type(data, '$."student"') IN ('true', 'false')""" in sql, sql
+        assert """json_extract(data, '$."grades"."chemistry"') IN (?)""" in sql, sql
+        assert parameters == [23, 25, 35, 'A'], parameters
+
+        assert list(store.select(matcher)) == [DATA[0]]
+        assert store.match(pattern) == [{"name": "Anna", "grades": {"chemistry": "A"}}] == pattern.match(DATA)
+
+class Test39(object):
+    """
+    SQLite pushdown: not, != and suffixes.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "name not in": ["James"], "age != any": [25, 35], "student not is": "str" }])
+        matcher = pattern.compiled().matchers[0]
+        store = sqlite_store()
+
+        sql, parameters = store.where(matcher)
+
+        assert """NOT COALESCE(((json_type(data, '$."name"') IN ('text') AND json_extract(data, '$."name"') IN (?))), 0)""" in sql, sql
+        assert """NOT COALESCE(json_type(data, '$."student"') IN ('text'), 0)""" in sql, sql
+        assert ') OR (' in sql, sql
+        assert parameters == ['James', 25, 35], parameters
+
+        assert list(store.select(matcher)) == [DATA[0], DATA[2]]
+        assert store.match(pattern) == [{"name": "Anna"}, {"name": "John"}] == pattern.match(DATA)
+
+
+class Test40(object):
+    """
+    Constraints on the same key are merged: ranges, == and in.
+    """
+    pattern = [{ "name": None, "age >": 20, "age <=": 35, "age in": [23, 25, 35, 40], "age !=": 23 }]
+    result = [{"name": "Anna"}, {"name": "John"}]
+
+class Test41(object):
+    """
+    Double negations are removed.
+    """
+    pattern = [{ "name": None, "age not !=": 23, "name not ==": "Anna" }]
+    result = [{"name": "James"}]
+
+class Test42(object):
+    """
+    Contradictions match nothing, without comparing any data.
+    """
+    pattern = [{ "name": None, "age >": 30, "age <": 20 }]
+    data = [{ "name": "Anna", "age": "unknown" }]
+    result = NoMatch
+
+class Test43(object):
+    """
+    Contradictions still run directives.
+    """
+    pattern = [{ "age in": [23, 25], "age ==": 35, "__count__": True }]
+    result = [{"count": 0}]
+
+
+def nested(depth, leaf, wrap):
+    """
+    Wrap 'leaf' 'depth' times using a function.
+    """
+    for _ in range(depth):
+        leaf = wrap(leaf)
+
+    return leaf
+
+class Test44(object):
+    """
+    Deeply nested lists and dicts.
+    """
+    pattern = nested(100, [{ "name": None, "name regex": "^l" }], lambda pattern: [{ "child": pattern, "other is": "int" }])
+    data = nested(100, [{ "name": "leaf" }, { "name": "other" }], lambda data: [{ "child": data, "other": 1 }])
+    result = nested(100, [{ "name": "leaf" }], lambda result: [{ "child": result }])
+
+
+class Test45(object):
+    """
+    __offset__ skips results (fused with __sort__ and __limit__).
+    """
+    pattern = [{ "name": None, "__sort__": "name", "__offset__": 1, "__limit__": 1 }]
+    result = [{"name": "James"}]
+
+
+class Test46(object):
+    """
+    Paging resumes where the previous page stopped.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "age >": 24, "*": ["age"] }])
+
+        results, token = pattern.page(DATA, 1, version = 1)
+        assert results == [{"name": "Anna", "age": 25}], results
+        assert decode_page_token(token, pattern.digest(), page_digest(1)) == 1, token
+
+        results, next_token = pattern.page(DATA, 1, token, version = 1)
+        assert results == [{"name": "John", "age": 35}], results
+        assert next_token is None, next_token
+
+        try:
+            pattern.page(DATA, 1, token, version = 2)
+            assert False, 'token accepted for another version'
+        except PageTokenException:
+            pass
+
+
+class Test47(object):
+    """
+    Views return the same results as copies.
+    """
+    pattern = [{ "name": None, "grades": { "chemistry": "A", "*": "*" }, "*": ["age", "age", "missing"] }]
+    compiler = Compiler(views = True)
+    result = [{"name": "Anna", "grades": {"chemistry": "A", "math": "C"}, "age": 25}]
+
+
+def check_pattern_set(patterns, expected):
+    """
+    Assert that a PatternSet with some patterns ({ id: pattern })
+    matches the 'expected' ids for every record in DATA, with the
+    same results as matching each pattern.
+    """
+    pattern_set = PatternSet()
+
+    for pattern_id, pattern in patterns.items():
+        pattern_set.add(pattern_id, pattern)
+
+    for record, ids in zip(DATA, expected):
+        assert pattern_set.match(record) == ids, (record['name'], pattern_set.match(record))
+
+        results = { pattern_id: Pattern(pattern).match(record) for pattern_id, pattern in patterns.items() }
+        results = { pattern_id: result for pattern_id, result in results.items() if result is not NoMatch }
+
+        assert pattern_set.match(record, results = True) == results, (record['name'], results)
+
+class Test48(object):
+    """
+    PatternSet: ranges.
+    """
+    def check(self):
+        patterns = { "range": { "name": None, "age >=": 25, "age <": 30 }, "equal": { "name": "John" }, "keys": { "grades": None } }
+        check_pattern_set(patterns, [["range", "keys"], [], ["equal", "keys"]])
+
+class Test49(object):
+    """
+    PatternSet: equality, in and required keys.
+    """
+    def check(self):
+        patterns = { "in": { "name in": ["John", "James"], "grades": { "*": "*" } }, "equal": { "name": "John" }, "keys": { "grades": None } }
+        check_pattern_set(patterns, [["keys"], [], ["in", "equal", "keys"]])
+
+
+CLUBS = [
+    { "member": "Anna", "club": "chess" },
+    { "member": "John", "club": "painting" },
+    { "member": "Anna", "club": "swimming" },
+    { "member": "Mary", "club": "chess" },
+]
+
+class Test50(object):
+    """
+    __join__ adds the matching records of another dataset.
+    """
+    pattern = [{ "name": None, "age >": 24, "__join__": { "with": "clubs", "on": "name", "to": "member", "pattern": { "club": None } } }]
+    compiler = Compiler(datasets = { "clubs": CLUBS })
+    result = [{"name": "Anna", "clubs": [{"club": "chess"}, {"club": "swimming"}]}, {"name": "John", "clubs": [{"club": "painting"}]}]
+
+class Test51(object):
+    """
+    __join__ with more results than records and optional matches.
+    """
+    pattern = [{ "name": None, "__join__": { "with": "clubs", "on": "name", "to": "member", "as": "chess", "pattern": { "club": "chess" }, "optional": True } }]
+    compiler = Compiler(datasets = { "clubs": CLUBS[:2] })
+    result = [{"name": "Anna", "chess": [{"club": "chess"}]}, {"name": "James", "chess": []}, {"name": "John", "chess": []}]
+
+class Test52(object):
+    """
+    Lists parsed incrementally, in small chunks, match like json.loads().
+    """
+    pattern = [{ "name": None, "grades": { "*": "*" } }]
+    data = list(binary_read_json_list(io.BytesIO(json.dumps(DATA, indent = 4).encode('utf-8')), chunk_size = 7))
+    result = Pattern(pattern).match(DATA)
+
+
+class CountingIndex(NDJSONIndex):
+    """
+    An NDJSON index that records the blocks read after it was built.
+    """
+    def __init__(self, *args, **kwargs):
+        self.read = []
+        NDJSONIndex.__init__(self, *args, **kwargs)
+        self.read = []
+
+    def read_block(self, block):
+        self.read.append(block)
+        return NDJSONIndex.read_block(self, block)
+
+def write_ndjson(directory, records):
+    """
+    Write records to a NDJSON file in 'directory', return its path.
+    """
+    filepath = os.path.join(directory, 'data.ndjson')
+
+    with open(filepath, 'w', encoding = 'utf-8') as descriptor:
+        descriptor.writelines(json.dumps(record) + '\n' for record in records)
+
+    return filepath
+
+class Test53(object):
+    """
+    NDJSON index: blocks are skipped using their min/max statistics.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "age >": 24, "age in": [23, 35, 40] }])
+        matcher = pattern.compiled().matchers[0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = CountingIndex(write_ndjson(directory, DATA), ['age'], block_size = 1)
+
+            try:
+                assert index.blocks() == 3
+                assert list(index.candidate_blocks(matcher)) == [2], list(index.candidate_blocks(matcher))
+                assert list(index.select(matcher)) == [DATA[2]]
+                assert index.match(pattern) == [{"name": "John"}] == pattern.match(DATA)
+                assert index.read == [2, 2], index.read
+
+            finally:
+                index.close()
+
+class Test54(object):
+    """
+    NDJSON index: paging skips blocks too.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "age <=": 25, "*": ["age"] }])
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = CountingIndex(write_ndjson(directory, DATA), ['age'], block_size = 1)
+
+            try:
+                first, token = index.page(pattern, 1)
+                assert first == [{"name": "Anna", "age": 25}] and token is not None, (first, token)
+
+                second, token = index.page(pattern, 1, token)
+                assert second == [{"name": "James", "age": 23}] and token is None, (second, token)
+
+                assert first + second == pattern.match(DATA)
+                assert not 2 in index.read, index.read
+
+            finally:
+                index.close()
+
+
+class Test55(object):
+    """
+    cancel() stops the running executions only, joined batches don't undo it.
+    """
+    def check(self):
+        compiler = Compiler(limits = Limits(timeout = 60))
+        pattern = Pattern([{ "name": None, "age >": 30 }], compiler)
+
+        # cancel an execution, start another one, then join the first one
+        # from another batch (like match_parallel() does):
+        execution = pattern.start_limits()
+        compiler.limits.cancel()
+        pattern.start_limits()
+
+        try:
+            match_batch(pattern.compiled().matchers[0], DATA, execution)
+            assert False, 'the cancelled execution was joined'
+        except LimitException as err:
+            assert str(err).startswith('cancelled'), str(err)
+
+        assert pattern.match(DATA) == [{"name": "John"}]
+
+
+class Test56(object):
+    """
+    PatternSet: string ranges are not numeric intervals.
+    """
+    def check(self):
+        patterns = { "strings": { "name": None, "name >": "A", "name >=": "J" }, "numbers": { "age >": 30 } }
+        check_pattern_set(patterns, [[], ["strings"], ["strings", "numbers"]])
+
+# (new, old, whether everything matching new matches old):
+IMPLICATIONS = [
+    ({ "name": None, "student": True }, { "name": None }, True),
+    ({ "age >": 24 }, { "age >": 20 }, True),
+    ({ "age >=": 21, "age <": 30 }, { "age >": 20, "age <=": 30 }, True),
+    ({ "age in": [23, 25] }, { "age >": 20, "age <": 30 }, True),
+    ({ "age in": [23, 25] }, { "age in": [23, 25, 35] }, True),
+    ({ "age": 25 }, { "age >=": 25 }, True),
+    ({ "age > all": [20, 24] }, { "age >": 22 }, True),
+    ({ "age >": 24 }, { "age > any": [22, 40] }, True),
+    ({ "name regex": "^J", "name !=": "John" }, { "name regex": "^J" }, True),
+    ({ "grades": { "math": None, "chemistry": None } }, { "grades": { "math": None } }, True),
+    ({ "age >": 20 }, { "age >": 24 }, False),
+    ({ "name": None }, { "name": None, "student": True }, False),
+    ({ "age >": "a" }, { "age >": 20 }, False),
+    ({ "age <": "z" }, { "age <": 30 }, False),
+    ({ "age >=": True }, { "age >": 0 }, False),
+    ({ "age in": [True] }, { "age in": [1, 2] }, False),
+    ({ "age not >": 30 }, { "age <=": 30 }, False),
+    ({ "age <=": 30 }, { "age not >": 30 }, False),
+    ({ "age > any": [22, 40] }, { "age >": 22 }, False),
+    ({ "hobbies": ["chess"] }, { "hobbies": ["reading"] }, False),
+]
+
+def refined(old, new):
+    """
+    Run 'old' and then 'new' in a MQLiteSH REPL over DATA.
+    Returns (results of new, (records scanned, total, refined)).
+    """
+    repl = REPL(DATA, None)
+    repl.eval(json.dumps([old]))
+    result = repl.eval(json.dumps([new]))
+
+    return result, repl.scanned
+
+async def ndjson_lines(records, read, cancel = None):
+    """
+    Yield records as NDJSON lines (with blank lines in between),
+    counting them in 'read'. Calls 'cancel' after the first one.
+    """
+    for record in records:
+        read.append(record)
+        yield json.dumps(record).encode('utf-8') + b'\n'
+        yield b'\n'
+
+        if cancel is not None:
+            cancel()
+
+def matched_async(pattern, compiler = None, executor = None, records = DATA, cancel = False):
+    """
+    Match some records with Pattern.match_async(), one line per batch.
+    Returns (results, records read). Exceptions are raised.
+    """
+    pattern = Pattern(pattern, compiler)
+    read = []
+    cancel = compiler.limits.cancel if cancel else None
+
+    async def run():
+        source = ndjson_lines(records, read, cancel)
+        return [result async for result in pattern.match_async(source, batch_size = 1, executor = executor)]
+
+    return asyncio.run(run()), len(read)
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor that records the names of the functions it runs.
+    """
+    def __init__(self, *args, **kwargs):
+        ThreadPoolExecutor.__init__(self, *args, **kwargs)
+        self.functions = []
+
+    def submit(self, function, *args, **kwargs):
+        self.functions.append(function.__name__)
+        return ThreadPoolExecutor.submit(self, function, *args, **kwargs)
+
+def run_pipeline(pattern, lines, compiler = None, decoders = 3):
+    """
+    Run NDJSON lines (bytes) through a Pipeline with small batches,
+    in a thread. Returns (results, stage counters) or raises the error
+    that stopped it (AssertionError when it doesn't end).
+    """
+    import threading
+
+    pipeline = Pipeline(Pattern(pattern, compiler), None, queue_depth = 2, decoders = decoders, batch_size = 2)
+    formatter = JSONFormatter(False, None, False, '\n')
+    output = io.BytesIO()
+    outcome = []
+
+    def run():
+        try:
+            pipeline.run(io.BytesIO(b''.join(lines)), formatter, output)
+            outcome.append(None)
+        except Exception as err:
+            outcome.append(err)
+
+    thread = threading.Thread(target = run, daemon = True)
+    thread.start()
+    thread.join(30)
+
+    assert len(outcome) > 0, 'the pipeline did not end'
+
+    if outcome[0] is not None:
+        raise outcome[0]
+
+    results = [json.loads(line) for line in output.getvalue().decode('utf-8').splitlines()]
+    return results, pipeline.report()
+
+# (regex, literals in every string it matches):
+REGEX_LITERALS = [
+    ("Anna", ["Anna"]),
+    ("^Jo.n$", ["Jo", "n"]),
+    ("James|John", []),
+    ("J(ames|ohn)", []),
+    ("colou?r", ["colo", "r"]),
+    ("ab*c", ["a", "c"]),
+    ("ab+c", ["ab", "c"]),
+    ("a{2}bc", ["bc"]),
+    ("[abc]def", ["def"]),
+    ("x[]a]y", ["x", "y"]),
+    ("x[^]a]y", ["x", "y"]),
+    (r"x[\]a]y", ["x", "y"]),
+    (r"a\.b", ["a.b"]),
+    (r"a\.?b", ["a", "b"]),
+    (r"\d+abc", ["abc"]),
+    (r"\x41bc", ["bc"]),
+    (r"\u0041bc", ["bc"]),
+    (r"\N{LATIN CAPITAL LETTER A}bc", ["bc"]),
+    (r"a\101bc", ["a", "bc"]),
+]
+
+class Test57(object):
+    """
+    PlanCache: plans are keyed by the compiler settings, not its objects.
+    """
+    def check(self):
+        pattern = [{ "name": None, "__join__": { "with": "clubs", "on": "name", "to": "member", "pattern": { "club": "chess" } } }]
+        compiler = Compiler(limits = Limits(timeout = 60), datasets = { "clubs": CLUBS })
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PlanCache(directory)
+            compiled = cache.pattern(json.dumps(pattern), compiler)
+            loaded = cache.pattern(json.dumps(pattern), compiler)
+
+            assert len(os.listdir(directory)) == 1, os.listdir(directory)
+
+        # the second pattern was loaded from the plan, not compiled:
+        assert compiled._data is not None
+        assert loaded._data is None
+
+        assert loaded.compiled().limits is compiler.limits
+        assert loaded.compiled().matchers[0].directives[0].datasets is compiler.datasets
+
+        assert loaded.match(DATA) == compiled.match(DATA) == [{"name": "Anna", "clubs": [{"club": "chess"}]}]
+
+class Test58(object):
+    """
+    Keys added to a loaded dict are not rejected by its old shape.
+    """
+    def check(self):
+        data = json.loads(json.dumps(DATA), object_pairs_hook = CompactLoader())
+        data[1]["grades"] = { "math": "B" }
+
+        assert "grades" in data[1], data[1]
+        assert data[1]["grades"] == { "math": "B" }, data[1]
+
+        result = Pattern([{ "name": None, "grades": { "math": None } }]).match(data)
+        assert result == [{"name": "Anna", "grades": {"math": "C"}}, {"name": "James", "grades": {"math": "B"}}], result
+
+class Test59(object):
+    """
+    Rows are dicts for "is", shared strings are bounded.
+    """
+    def check(self):
+        loader = CompactLoader(rows = True, max_strings = 4)
+        data = json.loads(json.dumps(DATA), object_pairs_hook = loader)
+
+        assert len(loader.strings) <= 4, loader.strings
+        assert not isinstance(data[0]["grades"], dict)
+
+        result = Pattern([{ "name": None, "grades is": "dict" }]).match(data)
+        assert result == [{"name": "Anna"}, {"name": "John"}], result
+
+class Test60(object):
+    """
+    MemoryProfile measures copies of the nodes, with a directives phase.
+    """
+    def check(self):
+        pattern = Pattern([{ "name": None, "hobbies": ["chess"], "grades": { "*": "*" }, "__limit__": 1 }])
+        compiled = pattern.compiled()
+        nodes = [compiled, compiled.matchers[0]] + [matcher for key, matcher in compiled.matchers[0].matchers]
+
+        profile = MemoryProfile()
+        profile.start()
+
+        try:
+            result = profile.match(pattern, DATA * 100)
+        finally:
+            profile.stop()
+
+        report = profile.report()
+        calls = { node['node']: node['calls'] for node in report['nodes'] }
+        allocated = { node['node']: node['allocated'] for node in report['nodes'] }
+
+        assert result == pattern.match(DATA * 100), result
+        assert [phase['phase'] for phase in report['phases']] == ['match', 'directives'], report['phases']
+        assert calls == { '$[0]': 300, '$[0]["name"]': 300, '$[0]["hobbies"]': 300, '$[0]["hobbies"][0]': 900, '$[0]["grades"]': 100 }, calls
+        assert allocated['$[0]["grades"]'] > 0 and allocated['$[0]["name"]'] == 0, allocated
+        assert report['peak'] > 0
+
+        # the pattern itself is not modified:
+        assert all(type(node).__name__.startswith('Match') for node in nodes)
+        assert all(not hasattr(node, '_profile') for node in nodes)
+
+class Test61(object):
+    """
+    Query refinement: which matchers imply others.
+    """
+    def check(self):
+        for new, old, expected in IMPLICATIONS:
+            new_matcher = Pattern([new]).compiled().matchers[0]
+            old_matcher = Pattern([old]).compiled().matchers[0]
+
+            assert matcher_implies(new_matcher, old_matcher) == expected, (new, old, expected)
+
+class Test62(object):
+    """
+    Query refinement: a refined query gives the full scan results.
+    """
+    def check(self):
+        new = { "name": None, "age >": 30, "hobbies contain": "reading" }
+        result, (scanned, total, reused) = refined({ "name": None, "age >": 24, "hobbies": None }, new)
+
+        assert result == [{"name": "John"}] and result == Pattern([new]).match(DATA), result
+        assert reused and (scanned, total) == (2, 3), (scanned, total, reused)
+
+class Test63(object):
+    """
+    Query refinement: __limit__ stops the scan, so nothing is reused.
+    """
+    def check(self):
+        new = { "name": None, "age >": 30 }
+        result, (scanned, total, reused) = refined({ "name": None, "age >": 24, "__limit__": 1 }, new)
+
+        assert result == [{"name": "John"}] and result == Pattern([new]).match(DATA), result
+        assert not reused and scanned == total, (scanned, total, reused)
+
+class Test64(object):
+    """
+    match_async() with NDJSON lines and lazy directives.
+    """
+    def check(self):
+        pattern = [{ "name": None, "age >": 20, "__sort__": "name", "__limit__": 2 }]
+        results, read = matched_async(pattern)
+
+        assert results == [{"name": "Anna"}, {"name": "James"}], results
+        assert results == Pattern(pattern).match(DATA)
+
+class Test65(object):
+    """
+    match_async() decoding and matching batches in an executor.
+    """
+    def check(self):
+        pattern = [{ "name": None, "hobbies contain": "reading", "__count__": True }]
+
+        with RecordingExecutor(2) as executor:
+            results, read = matched_async(pattern, executor = executor)
+
+        assert results == [{"count": 2}], results
+        assert executor.functions == ['decode_match_batch'] * len(DATA) * 2, executor.functions
+
+class Test66(object):
+    """
+    match_async() stops reading the source when __limit__ is done.
+    """
+    def check(self):
+        results, read = matched_async([{ "name": None, "__limit__": 1 }], records = DATA * 1000)
+
+        assert results == [{"name": "Anna"}], results
+        assert read < len(DATA) * 1000, 'every record was read'
+
+class Test67(object):
+    """
+    match_async() counts steps over the whole source, not per batch.
+    """
+    def check(self):
+        try:
+            matched_async([{ "name": None }], Compiler(limits = Limits(max_steps = 2)))
+            assert False, 'the step limit was not reached'
+        except LimitException as err:
+            assert err.steps == 3, err.steps
+
+class Test68(object):
+    """
+    match_async() stops when cancelled.
+    """
+    def check(self):
+        try:
+            matched_async([{ "name": None }], Compiler(limits = Limits(timeout = 60)), cancel = True)
+            assert False, 'cancel() did not stop it'
+        except LimitException as err:
+            assert str(err).startswith('cancelled'), str(err)
+
+class Test69(object):
+    """
+    match_parallel() with directives and many matchers
+    (after the old compile() and decode() calls).
+    """
+    def check(self):
+        pattern = JSONPattern(json.dumps([{ "name": None, "age": None, "age >": 20, "__sort__": "age", "__limit__": 2 }, { "name": None, "student": False }]))
+        pattern.decode()
+        pattern.compile()
+
+        with ThreadPoolExecutor(2) as executor:
+            result = pattern.match_parallel(DATA, executor, chunk_size = 1)
+
+        assert result == [{"name": "James", "age": 23}, {"name": "Anna", "age": 25}, {"name": "James", "student": False}], result
+        assert result == pattern.match(DATA)
+
+class Test70(object):
+    """
+    Pipeline: results in order with many decoders, counters add up.
+    """
+    def check(self):
+        pattern = [{ "name": None, "age >": 24 }]
+        records = DATA * 20
+        lines = [line for record in records for line in (json.dumps(record).encode('utf-8') + b'\n', b'\n')]
+
+        results, report = run_pipeline(pattern, lines)
+        read, *decoders, match, write = report
+
+        assert results == list(Pattern(pattern).stream(records)), results
+        assert read['items'] == len(lines), read
+        assert sum(decoder['items'] for decoder in decoders) == len(records), decoders
+        assert match['items'] == len(records), match
+        assert write['items'] == len(results) and write['batches'] > 0, write
+
+class Test71(object):
+    """
+    Pipeline: decode errors stop every stage.
+    """
+    def check(self):
+        lines = [b'{"name": "Anna"}\n'] * 20 + [b'{"name"\n'] + [b'{"name": "John"}\n'] * 20
+
+        try:
+            run_pipeline([{ "name": None }], lines)
+            assert False, 'bad JSON was not reported'
+        except ValueError:
+            pass
+
+class Test72(object):
+    """
+    Pipeline: LimitException stops every stage.
+    """
+    def check(self):
+        lines = [b'{"name": "Anna"}\n'] * 50
+
+        try:
+            run_pipeline([{ "name": None }], lines, Compiler(limits = Limits(max_steps = 5)))
+            assert False, 'the step limit was not reported'
+        except LimitException:
+            pass
+
+class Test73(object):
+    """
+    Literals that every string matching a regex contains.
+    """
+    def check(self):
+        for regex, expected in REGEX_LITERALS:
+            assert regex_literals(regex) == expected, (regex, regex_literals(regex))
+
+class Test74(object):
+    """
+    Regexes give the same results with and without an index.
+    """
+    def check(self):
+        repl = REPL(DATA, None)
+        repl.indexes["name"] = FieldIndex(DATA, "name")
+
+        for regex in ["J(ames|ohn)", "Jo?hn", "[AJ]nn?a", r"J\w+s", r"\x4anna", r"\x41nna", r"[\]A]nna", "(?i)anna", "J.*"]:
+            pattern = [{ "name": None, "name regex": regex }]
+            assert repl.eval(json.dumps(pattern)) == Pattern(pattern).match(DATA), regex
+
+class Test75(object):
+    """
+    Merged comparisons are tested where the first one was.
+    """
+    pattern = [{ "x >=": 0, "x <": "a", "x >": False }]
+    data = [{ "x": 0 }]
+    result = NoMatch
+
+class Test76(object):
+    """
+    Threads that join an execution share its step budget.
+    """
+    def check(self):
+        import threading
+
+        pattern = Pattern([{ "name": None }], Compiler(limits = Limits(max_steps = 3000)))
+        matcher = pattern.compiled().matchers[0]
+        execution = pattern.start_limits()
+        errors = []
+
+        def run():
+            try:
+                match_batch(matcher, DATA * 500, execution)
+            except LimitException as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target = run) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(errors) > 0, '4 threads matched 1500 records each with a budget of 3000 steps'
+        assert all(err.steps > 3000 for err in errors), [err.steps for err in errors]
+
+class Test77(object):
+    """
+    Limits are checked by every list-level path, not only by dicts.
+    """
+    def check(self):
+        pattern = Pattern([1], Compiler(limits = Limits(max_steps = 5)))
+        data = [2] * 10
+
+        for name, run in [
+            ('count', lambda: pattern.count(data)),
+            ('exists', lambda: pattern.exists(data)),
+            ('stream_exists', lambda: pattern.stream_exists(iter(data))),
+            ('stream_count', lambda: pattern.stream_count(iter(data))),
+        ]:
+            try:
+                run()
+                assert False, '{}() ignored the step limit'.format(name)
+            except LimitException:
+                pass
+
+        with ThreadPoolExecutor(2) as executor:
+            try:
+                pattern.match_parallel(data, executor)
+                assert False, 'match_parallel() ignored the step limit'
+            except LimitException:
+                pass
+
+        store = SQLiteStore(':memory:')
+        store.insert(DATA)
+
+        try:
+            store.match(Pattern([{ "name": None }], Compiler(limits = Limits(max_steps = 4))))
+            assert False, 'SQLiteStore.match() ignored the step limit'
+        except LimitException:
+            pass
+
+class Test78(object):
+    """
+    The iterative evaluator applies directives lazily, like match().
+    """
+    pattern = [{ "age": None, "age >": 20, "__offset__": 1, "__limit__": 1 }]
+    data = [{ "age": 25 }, { "age": 30 }, { "age": "unknown" }]
+    result = [{"age": 30}]
+
+class Test79(object):
+    """
+    PlanCache: only private plans are loaded, damaged ones are compiled again.
+    """
+    def check(self):
+        pattern = json.dumps([{ "name": None }])
+        compiler = Compiler()
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PlanCache(directory)
+            cache.pattern(pattern, compiler)
+
+            loaded = cache.pattern(pattern, compiler)
+            assert loaded.compiled() is not None and loaded.match(DATA) == Pattern(json.loads(pattern)).match(DATA)
+            assert loaded._data is None, 'the plan was not loaded'
+
+            # other users can write to the directory:
+            os.chmod(directory, 0o777)
+            assert cache.pattern(pattern, compiler)._data is not None, 'a plan was loaded from a shared directory'
+            os.chmod(directory, 0o700)
+
+            # damaged plan:
+            with open(cache.path(pattern, compiler), 'wb') as descriptor:
+                descriptor.write(b'damaged')
+
+            assert cache.pattern(pattern, compiler)._data is not None
+            assert cache.pattern(pattern, compiler)._data is None, 'the plan was not stored again'
+
+class Test80(object):
+    """
+    Closing decompressed input closes the compressed stream too.
+    """
+    def check(self):
+        compressed = io.BytesIO(bz2.compress(json.dumps(DATA).encode('utf-8')))
+        stream = wrap_binary_input(compressed)
+
+        assert json.loads(binary_read_utf8(stream)) == DATA
+        stream.close()
+
+        assert compressed.closed, 'the compressed stream is still open'
 
 # Run the tests:
 
@@ -237,8 +1214,34 @@ def main():
     errors = 0
 
     for test in tests:
-        pattern = Pattern(test.pattern)
-        result = pattern.match(DATA)
+
+        # tests that check more than the results:
+        if hasattr(test, 'check'):
+            try:
+                test.check()
+
+            except AssertionError as err:
+                errln('Test: {}'.format(test.__doc__.strip()))
+                errln('Failed: {}'.format(err))
+
+                errors += 1
+
+        if not hasattr(test, 'pattern'):
+            continue
+
+        pattern = Pattern(test.pattern, getattr(test, 'compiler', None))
+
+        try:
+            result = pattern.match(getattr(test, 'data', DATA))
+
+        # expected exceptions are tested as results:
+        except Exception as err:
+            result = type(err)
+
+            if result != test.result:
+                raise
+
+            continue
 
         if result != test.result:
             errln('Test: {}'.format(test.__doc__.strip()))
@@ -246,6 +1249,23 @@ def main():
 
             errors += 1
 
+        # exists() and count() must agree with match():
+        exists = result is not NoMatch
+        count = len(result) if exists and isinstance(test.pattern, list) else int(exists)
+
+        if pattern.exists(getattr(test, 'data', DATA)) != exists or pattern.count(getattr(test, 'data', DATA)) != count:
+            errln('Test: {}'.format(test.__doc__.strip()))
+            errln('exists() or count() disagree with match()')
+
+            errors += 1
+
+        # so must the iterative evaluator:
+        if pattern.match_iterative(getattr(test, 'data', DATA)) != result or pattern.exists_iterative(getattr(test, 'data', DATA)) != exists:
+            errln('Test: {}'.format(test.__doc__.strip()))
+            errln('match_iterative() or exists_iterative() disagree with match()')
+
+            errors += 1
+
     if errors > 0:
         errln('Errors: {}'.format(errors))
         sys.exit(1)